@@ -1,22 +1,36 @@
+import hashlib
+import hmac
 import os
+import secrets
 import uuid
 
 import gradio as gr
-from compressor import CompressionCancelled, VideoCompressor
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from compressor import MAX_JOB_CPU_SECONDS, CompressionCancelled, VideoCompressor
+from job_api import JobManager, create_job_router, live_response
 from utils import (
     compute_bitrate_plan,
-    estimate_video_bitrate,
     get_video_metadata,
     pick_auto_fps_cap,
     pick_auto_resolution,
 )
 
 compressor = VideoCompressor()
+jobs = JobManager(compressor)
 
 PRESETS = ["8 MB", "10 MB", "25 MB", "50 MB", "Custom"]
 RESOLUTION_CHOICES = ["Auto", "Original", "720p", "480p", "360p"]
 RESOLUTION_HEIGHTS = {"720p": 720, "480p": 480, "360p": 360}
 FPS_CHOICES = ["Auto", "On", "Off"]
+SPEED_CHOICES = ["Prioritize Speed", "Prioritize Quality", "Fit Time Budget"]
+# Label -> compressor.ENCODER_BACKENDS name.
+ENCODER_CHOICES = {"H.264": "libx264", "H.265 (HEVC)": "libx265", "AV1": "libsvtav1"}
+# Codecs the result player can show in every major browser. HEVC output is
+# tagged hvc1 so Safari and desktop players take it, but Chrome and Firefox
+# only play it with OS/hardware support, so the player may stay blank.
+BROWSER_PREVIEW_CODECS = {"H.264", "AV1"}
 LOW_BITRATE_WARN_KBPS = 200
 
 
@@ -70,11 +84,29 @@ def prepare_job():
     return uuid.uuid4().hex[:12]
 
 
-def processing_function(job_id, video_file, preset, custom_mb, remove_audio, speed_mode, output_resolution, fps_mode, start_time, end_time, progress=gr.Progress()):
+# Signs UI job ids for the /live link: knowing a job id isn't enough to
+# watch someone else's encode. Per process, so links die with it.
+_LIVE_LINK_KEY = secrets.token_bytes(32)
+
+
+def _live_token(job_id):
+    return hmac.new(_LIVE_LINK_KEY, job_id.encode(), hashlib.sha256).hexdigest()
+
+
+def _resolve_deadline(speed_mode, time_budget):
+    if speed_mode != "Fit Time Budget":
+        return None
+    if not time_budget or time_budget <= 0:
+        raise gr.Error("Enter a time budget in seconds.")
+    return float(time_budget)
+
+
+def processing_function(job_id, video_file, preset, custom_mb, remove_audio, speed_mode, time_budget, codec, output_resolution, fps_mode, start_time, end_time, single_pass, request: gr.Request, progress=gr.Progress()):
     if video_file is None:
         return None
 
     target_mb = _resolve_target_mb(preset, custom_mb)
+    deadline_seconds = _resolve_deadline(speed_mode, time_budget)
 
     try:
         return compressor.compress(
@@ -88,6 +120,12 @@ def processing_function(job_id, video_file, preset, custom_mb, remove_audio, spe
             output_resolution=output_resolution,
             fps_mode=fps_mode,
             progress_callback=progress,
+            deadline_seconds=deadline_seconds,
+            encoder=ENCODER_CHOICES.get(codec),
+            predictive=bool(single_pass),
+            # One browser session = one client for the compressor's
+            # per-client fairness.
+            client_id=request.session_hash if request else None,
         )
     except CompressionCancelled:
         return None
@@ -95,7 +133,46 @@ def processing_function(job_id, video_file, preset, custom_mb, remove_audio, spe
         raise gr.Error(f"Compression failed: {str(e)}")
 
 
-def make_result_message(output_path, original_path, preset, custom_mb):
+def preview_function(job_id, video_file, preset, custom_mb, remove_audio, speed_mode, time_budget, codec, output_resolution, fps_mode, start_time, end_time, request: gr.Request, progress=gr.Progress()):
+    """Encode a few short windows with the full job's settings (see
+    VideoCompressor.preview) and show them with their SSIM."""
+    if video_file is None:
+        return gr.update(value=None, visible=False), ""
+
+    target_mb = _resolve_target_mb(preset, custom_mb)
+    deadline_seconds = _resolve_deadline(speed_mode, time_budget)
+    try:
+        result = compressor.preview(
+            job_id=job_id,
+            input_path=video_file,
+            target_mb=target_mb,
+            remove_audio=remove_audio,
+            start_time=start_time,
+            end_time=end_time,
+            speed_mode=speed_mode,
+            output_resolution=output_resolution,
+            fps_mode=fps_mode,
+            progress_callback=progress,
+            deadline_seconds=deadline_seconds,
+            encoder=ENCODER_CHOICES.get(codec),
+            client_id=request.session_hash if request else None,
+        )
+    except CompressionCancelled:
+        return gr.update(value=None, visible=False), ""
+    except Exception as e:
+        raise gr.Error(f"Preview failed: {str(e)}")
+
+    if not result["windows"]:
+        return gr.update(value=None, visible=False), f"**{result['note']}**"
+    items = []
+    for window in result["windows"]:
+        start = int(window["start"])
+        ssim = f"SSIM {window['ssim']:.3f}" if window["ssim"] is not None else "SSIM N/A"
+        items.append((window["path"], f"{start // 60}:{start % 60:02d} · {ssim} · {window['video_kbps']} kbps"))
+    return gr.update(value=items, visible=True), ""
+
+
+def make_result_message(output_path, original_path, preset, custom_mb, codec="H.264"):
     """Compute the post-encode size summary. Runs in a separate .then() after
     processing_function so it isn't an output of the long-running compress
     event — otherwise Gradio paints a second progress overlay on result_md."""
@@ -121,7 +198,10 @@ def make_result_message(output_path, original_path, preset, custom_mb):
         status = f" (well under, {abs(delta):.1f} MB headroom)"
     else:
         status = " (on target)"
-    return f"**Output:** {size_mb:.2f} MB / {target_mb:g} MB target{status}"
+    message = f"**Output:** {size_mb:.2f} MB / {target_mb:g} MB target{status}"
+    if codec not in BROWSER_PREVIEW_CODECS:
+        message += f"\n\n{codec} may not play in this page's player (Chrome/Firefox) &mdash; download it to view."
+    return message
 
 
 def cancel_active_job(job_id):
@@ -130,7 +210,34 @@ def cancel_active_job(job_id):
     return gr.update(visible=True), gr.update(visible=False), None, ""
 
 
-def _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, start_time, end_time):
+def _codec_notes(speed_mode, codec):
+    """Caveats for the chosen codec: browser playback, and that only x264
+    honors a time budget (the others fall back to the Quality preset)."""
+    notes = []
+    if speed_mode == "Fit Time Budget" and ENCODER_CHOICES.get(codec) != "libx264":
+        notes.append(f"**Time budget:** not supported for {codec} &mdash; it uses the Prioritize Quality preset.")
+    if codec not in BROWSER_PREVIEW_CODECS:
+        notes.append(f"**Note:** {codec} may not play in this page's player (Chrome/Firefox) &mdash; download it to view.")
+    return notes
+
+
+def _format_eta(speed_mode, time_budget, codec, out_pixels, mpx_frames):
+    """ETA line from the compressor's cost model and current queue."""
+    deadline = time_budget if speed_mode == "Fit Time Budget" and time_budget and time_budget > 0 else None
+    encoder = ENCODER_CHOICES.get(codec)
+    ffmpeg_preset = compressor.resolve_preset(speed_mode, deadline, out_pixels, mpx_frames, encoder)
+    cpu_seconds, eta_seconds = compressor.estimate_seconds(ffmpeg_preset, mpx_frames, encoder)
+    if cpu_seconds > MAX_JOB_CPU_SECONDS:
+        return (
+            f"**ETA:** too expensive &mdash; ~{cpu_seconds / 60:.0f} CPU-minutes exceeds the "
+            f"{MAX_JOB_CPU_SECONDS / 60:.0f}-minute limit. Trim, lower the resolution, or use Prioritize Speed."
+        )
+    eta = f"~{eta_seconds / 60:.1f} min" if eta_seconds >= 90 else f"~{eta_seconds:.0f}s"
+    preset_note = f" &middot; preset {ffmpeg_preset}" if deadline else ""
+    return f"**ETA:** {eta} ({cpu_seconds / 60:.1f} CPU-min{preset_note})"
+
+
+def _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, start_time, end_time, speed_mode="Prioritize Speed", time_budget=None, codec="H.264"):
     if not meta:
         return ""
 
@@ -170,19 +277,29 @@ def _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fp
         )
         return "\n\n".join(lines)
 
+    # Mirror _compress_inner's cap: a trimmed section is capped at its own
+    # bitrate, read from the upload's packet index once the background build
+    # has finished (until then, fall back to the global bitrate).
+    source_bitrate_cap = meta.get("bitrate")
+    if is_trimmed and meta.get("path"):
+        packet_index = compressor.packet_indexes.get(meta["path"])
+        trim_bitrate = packet_index.trim_bitrate(s_time, e_time) if packet_index else None
+        if trim_bitrate:
+            source_bitrate_cap = trim_bitrate
+
     plan = compute_bitrate_plan(
         target_mb=target_mb,
         duration=effective_duration,
         has_audio=meta["has_audio"],
         remove_audio=remove_audio,
-        source_bitrate_cap=meta.get("bitrate"),
+        source_bitrate_cap=source_bitrate_cap,
     )
-    bitrate = estimate_video_bitrate(meta, target_mb, remove_audio, effective_duration)
-    if bitrate is None or plan is None:
+    if plan is None:
         return "\n\n".join(lines)
 
-    kbps = bitrate / 1000
     video_bps, audio_bps = plan
+    bitrate = video_bps
+    kbps = bitrate / 1000
     estimated_mb = (video_bps + audio_bps) * effective_duration / 8 / 1024 / 1024
 
     range_note = f" (trim: {s_time:.1f}s &ndash; {e_time:.1f}s)" if is_trimmed else ""
@@ -228,10 +345,16 @@ def _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fp
         elif fps_mode == "Auto" and source_fps > 30:
             lines.append(f"**Framerate:** Auto &rarr; keeping {source_fps:.0f} fps (bitrate is sufficient)")
 
+    if source_height and source_width:
+        out_pixels = effective_h * effective_h * source_width / source_height
+        mpx_frames = effective_duration * (effective_fps or 30) * out_pixels / 1e6
+        lines.append(_format_eta(speed_mode, time_budget, codec, out_pixels, mpx_frames))
+
+    lines.extend(_codec_notes(speed_mode, codec))
     return "\n\n".join(lines)
 
 
-def on_video_upload(video_path, preset, custom_mb, remove_audio, output_resolution, fps_mode, _start_time, _end_time):
+def on_video_upload(video_path, preset, custom_mb, remove_audio, output_resolution, fps_mode, _start_time, _end_time, speed_mode, time_budget, codec):
     # _start_time/_end_time are bound by the event but ignored: a new upload
     # resets trim to (0, full_duration), so we recompute the summary against
     # the source duration rather than carrying over the previous trim values.
@@ -240,6 +363,10 @@ def on_video_upload(video_path, preset, custom_mb, remove_audio, output_resoluti
     meta = get_video_metadata(video_path)
     if not meta:
         return None, "_Could not read video metadata._", gr.update(value=0), gr.update(value=None)
+    # Index packets in the background so trim edits can re-estimate from the
+    # trimmed section's real bitrate without spawning anything per keystroke.
+    meta["path"] = video_path
+    compressor.packet_indexes.request(video_path)
     duration = meta["duration"]
     start_update = gr.update(
         value=0,
@@ -251,20 +378,24 @@ def on_video_upload(video_path, preset, custom_mb, remove_audio, output_resoluti
         maximum=duration,
         label=f"End (sec) — source is {duration:.1f}s",
     )
-    summary = _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, 0, None)
+    summary = _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, 0, None, speed_mode, time_budget, codec)
     return meta, summary, start_update, end_update
 
 
-def on_settings_change(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, start_time, end_time):
+def on_settings_change(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, start_time, end_time, speed_mode, time_budget, codec):
     if not meta:
         return ""
-    return _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, start_time, end_time)
+    return _format_summary(meta, preset, custom_mb, remove_audio, output_resolution, fps_mode, start_time, end_time, speed_mode, time_budget, codec)
 
 
 def on_preset_change(preset):
     return gr.update(visible=(preset == "Custom"))
 
 
+def on_speed_mode_change(speed_mode):
+    return gr.update(visible=(speed_mode == "Fit Time Budget"))
+
+
 with gr.Blocks(title="Smart Video Compressor") as demo:
     gr.Markdown("# 📼 Smart Video Compressor")
     gr.Markdown("Compress videos to a specific size, inspired by 8mb.video.")
@@ -297,7 +428,7 @@ with gr.Blocks(title="Smart Video Compressor") as demo:
                     min_width=120,
                 )
                 speed_mode = gr.Dropdown(
-                    choices=["Prioritize Speed", "Prioritize Quality"],
+                    choices=SPEED_CHOICES,
                     value="Prioritize Speed",
                     label="Encoding Preset",
                     filterable=False,
@@ -305,6 +436,14 @@ with gr.Blocks(title="Smart Video Compressor") as demo:
                     scale=2,
                     min_width=140,
                 )
+                time_budget = gr.Number(
+                    label="Time budget (sec)",
+                    value=120,
+                    minimum=1,
+                    visible=False,
+                    scale=2,
+                    min_width=120,
+                )
 
             with gr.Row():
                 resolution = gr.Dropdown(
@@ -325,12 +464,28 @@ with gr.Blocks(title="Smart Video Compressor") as demo:
                     scale=2,
                     min_width=130,
                 )
+                codec = gr.Dropdown(
+                    choices=list(ENCODER_CHOICES),
+                    value="H.264",
+                    label="Codec",
+                    filterable=False,
+                    allow_custom_value=False,
+                    scale=2,
+                    min_width=120,
+                )
                 remove_audio = gr.Checkbox(
                     label="Remove Audio",
                     value=False,
                     scale=2,
                     min_width=130,
                 )
+                single_pass = gr.Checkbox(
+                    label="Single Pass",
+                    info="Predict quality from samples; skips the analysis pass (clips over a minute).",
+                    value=False,
+                    scale=2,
+                    min_width=130,
+                )
 
             with gr.Accordion("Trimming Options", open=True):
                 with gr.Row():
@@ -339,9 +494,11 @@ with gr.Blocks(title="Smart Video Compressor") as demo:
 
             with gr.Row():
                 btn = gr.Button("Compress", variant="primary", scale=3)
+                preview_btn = gr.Button("Preview", scale=1)
                 cancel_btn = gr.Button("Cancel", variant="stop", scale=1, visible=False)
 
         with gr.Column():
+            preview_gallery = gr.Gallery(label="Preview (same settings, short samples)", columns=3, height="auto", visible=False)
             video_output = gr.Video(label="Result", interactive=False)
             result_md = gr.Markdown("")
 
@@ -351,15 +508,21 @@ with gr.Blocks(title="Smart Video Compressor") as demo:
         outputs=target_custom,
     )
 
-    summary_inputs = [meta_state, target_preset, target_custom, remove_audio, resolution, fps_mode, start_t, end_t]
+    speed_mode.change(
+        fn=on_speed_mode_change,
+        inputs=speed_mode,
+        outputs=time_budget,
+    )
+
+    summary_inputs = [meta_state, target_preset, target_custom, remove_audio, resolution, fps_mode, start_t, end_t, speed_mode, time_budget, codec]
 
     video_input.change(
         fn=on_video_upload,
-        inputs=[video_input, target_preset, target_custom, remove_audio, resolution, fps_mode, start_t, end_t],
+        inputs=[video_input, target_preset, target_custom, remove_audio, resolution, fps_mode, start_t, end_t, speed_mode, time_budget, codec],
         outputs=[meta_state, summary_md, start_t, end_t],
     )
 
-    for component in (target_preset, target_custom, remove_audio, resolution, fps_mode, start_t, end_t):
+    for component in (target_preset, target_custom, remove_audio, resolution, fps_mode, start_t, end_t, speed_mode, time_budget, codec):
         trigger = component.input if hasattr(component, "input") else component.change
         trigger(
             fn=on_settings_change,
@@ -367,39 +530,112 @@ with gr.Blocks(title="Smart Video Compressor") as demo:
             outputs=summary_md,
         )
 
-    # Generate the job id, clear any stale result message, and flip the UI to
-    # "running" before the encode starts so the cancel button can call
-    # compressor.cancel(job_id) at any time.
+    # Generate the job id, swap any stale result message for a link to the
+    # live preview, and flip the UI to "running" before the encode starts so
+    # the cancel button can call compressor.cancel(job_id) at any time.
     prep_event = btn.click(
         fn=prepare_job,
         outputs=[active_job],
     ).then(
-        fn=lambda: (gr.update(visible=False), gr.update(visible=True), ""),
-        outputs=[btn, cancel_btn, result_md],
+        fn=lambda job_id: (
+            gr.update(visible=False), gr.update(visible=False), gr.update(visible=True),
+            f"[Preview while encoding](/live/{job_id}?token={_live_token(job_id)}) — plays what's been encoded so far.",
+        ),
+        inputs=[active_job],
+        outputs=[btn, preview_btn, cancel_btn, result_md],
     )
     # Capture this dependency explicitly so cancels= targets the encode step.
     # result_md is computed in a separate .then() (below) so Gradio doesn't
     # paint a second progress overlay on it during the long compress.
+    # concurrency_limit=None: let every queued compress reach the
+    # compressor, whose own scheduler bounds concurrent encodes and reports
+    # queue position. Gradio's default limit of 1 would serialize them
+    # before the scheduler ever saw them.
     compress_event = prep_event.then(
         fn=processing_function,
-        inputs=[active_job, video_input, target_preset, target_custom, remove_audio, speed_mode, resolution, fps_mode, start_t, end_t],
+        inputs=[active_job, video_input, target_preset, target_custom, remove_audio, speed_mode, time_budget, codec, resolution, fps_mode, start_t, end_t, single_pass],
         outputs=video_output,
+        concurrency_limit=None,
     )
     compress_event.then(
         fn=make_result_message,
-        inputs=[video_output, video_input, target_preset, target_custom],
+        inputs=[video_output, video_input, target_preset, target_custom, codec],
         outputs=result_md,
     ).then(
-        fn=lambda: (gr.update(visible=True), gr.update(visible=False), None),
-        outputs=[btn, cancel_btn, active_job],
+        fn=lambda: (gr.update(visible=True), gr.update(visible=True), gr.update(visible=False), None),
+        outputs=[btn, preview_btn, cancel_btn, active_job],
+    )
+
+    # Preview runs through the same job-id / cancel flow as Compress.
+    preview_event = preview_btn.click(
+        fn=prepare_job,
+        outputs=[active_job],
+    ).then(
+        fn=lambda: (gr.update(visible=False), gr.update(visible=False), gr.update(visible=True), ""),
+        outputs=[btn, preview_btn, cancel_btn, result_md],
+    ).then(
+        fn=preview_function,
+        inputs=[active_job, video_input, target_preset, target_custom, remove_audio, speed_mode, time_budget, codec, resolution, fps_mode, start_t, end_t],
+        outputs=[preview_gallery, result_md],
+        concurrency_limit=None,
+    )
+    preview_event.then(
+        fn=lambda: (gr.update(visible=True), gr.update(visible=True), gr.update(visible=False), None),
+        outputs=[btn, preview_btn, cancel_btn, active_job],
     )
 
     cancel_btn.click(
         fn=cancel_active_job,
         inputs=[active_job],
         outputs=[btn, cancel_btn, active_job, result_md],
-        cancels=[compress_event],
+        cancels=[compress_event, preview_event],
+    ).then(
+        fn=lambda: gr.update(visible=True),
+        outputs=preview_btn,
+    )
+
+# The Gradio UI is mounted on a plain FastAPI app so operational routes can
+# sit next to it on the same port. Routes registered before the mount take
+# precedence over Gradio's catch-all at "/".
+server = FastAPI()
+
+
+@server.get("/metrics")
+def metrics_prometheus():
+    """Per-phase timings, queue wait, active jobs and encode speed (Prometheus text)."""
+    return PlainTextResponse(
+        compressor.metrics.render_prometheus(compressor.metrics_gauges()),
+        media_type="text/plain; version=0.0.4",
     )
 
+
+@server.get("/metrics.json")
+def metrics_json():
+    """Same data as /metrics plus the most recent jobs' spans and the
+    cost model's fitted coefficients, as JSON."""
+    snapshot = compressor.metrics.snapshot(compressor.metrics_gauges())
+    snapshot["cost_model"] = compressor.cost_model.summary()
+    return JSONResponse(snapshot)
+
+
+@server.get("/live/{job_id}")
+def live_preview(job_id: str, request: Request, token: str = ""):
+    """The UI job's output so far, while pass 2 writes it (see job_api.live_response)."""
+    if not hmac.compare_digest(_live_token(job_id).encode(), token.encode()):
+        raise HTTPException(status_code=404, detail="Nothing is being encoded for this job right now.")
+    response = live_response(compressor, job_id, request)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Nothing is being encoded for this job right now.")
+    return response
+
+
+# Programmatic clients: submit/poll/cancel/download without the Gradio event
+# chain (see job_api.py).
+server.include_router(create_job_router(jobs))
+
+
+demo.queue(max_size=8)
+server = gr.mount_gradio_app(server, demo, path="/")
+
 if __name__ == "__main__":
-    demo.queue(max_size=8).launch(server_name="0.0.0.0", server_port=7860, inbrowser=True)
+    uvicorn.run(server, host="0.0.0.0", port=7860)
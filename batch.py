@@ -0,0 +1,318 @@
+"""Headless batch runner — compress many files without the Gradio UI.
+
+Reads a JSONL manifest (one job per line), runs the jobs through
+VideoCompressor in a process pool, and appends one JSONL result per job as
+each finishes:
+
+    uv run python -m batch jobs.jsonl --results results.jsonl --output-dir out/
+    uv run python -m batch --watch inbox/ --results results.jsonl --output-dir out/
+
+Manifest fields (only "input" is required; the rest default to the CLI flags):
+
+    {"id": "clip-1", "input": "a.mp4", "target_mb": 10, "trim": [5, 65],
+     "speed_mode": "Prioritize Speed", "resolution": "Auto", "fps_mode": "Auto",
+     "remove_audio": false, "deadline_s": 300, "encoder": "libx264",
+     "predictive": false}
+
+"target_mb" may also be a list ([10, 50]): the job then produces every size
+from one decode (VideoCompressor.compress_many), and its result line lists
+them under "outputs".
+
+An "id" names the job's working directory and output files, so it must be
+letters, digits, ".", "_" and "-" only, starting with a letter or digit.
+Jobs without an "id" get one derived from the line's contents, so re-running
+the same manifest is resumable: jobs that already have an "ok" line in the
+results file are skipped. Watch mode polls a folder, waits for each new
+file's size to settle, then compresses it with the CLI defaults; its job ids
+come from the file's path, size and mtime, so it resumes the same way.
+
+Each worker runs one job at a time with segmented mode off — the pool is the
+parallelism — and gets an equal slice of the CPU budget (cgroup quota and
+affinity mask, see cpu_budget.py), so workers don't fight over cores. If a
+worker process dies (e.g. the OOM killer), the jobs in flight are recorded
+as errors (so a re-run retries them) and the batch carries on in a fresh
+pool.
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from compressor import CompressionCancelled, VideoCompressor
+from cpu_budget import MIN_JOB_THREADS, detect_cpus
+from utils import file_signature
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".mkv", ".webm", ".avi", ".m4v"}
+
+WATCH_POLL_SECONDS = 5
+
+# Manifest ids become a directory under OUTPUT_DIR and part of the output
+# file names, so they must be one plain path component. No leading "." or
+# "_": "..", and the compressor's own _cache/_index directories, are out.
+JOB_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+_worker_compressor = None
+
+
+def _init_worker(cpus):
+    global _worker_compressor
+    _worker_compressor = VideoCompressor(max_concurrent_jobs=1, cpus=cpus)
+
+
+def default_workers():
+    return max(1, detect_cpus() // MIN_JOB_THREADS)
+
+
+def _worker_cpus(workers):
+    return max(1, detect_cpus() // workers)
+
+
+def job_id_for(job):
+    """Stable id for a manifest job: its own "id", else a hash of its fields."""
+    if job.get("id"):
+        return str(job["id"])
+    payload = json.dumps(job, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def run_job(job, defaults, output_dir):
+    """Compress one job inside a pool worker. Returns the JSONL result dict."""
+    job_id = job_id_for(job)
+    input_path = job["input"]
+    trim = job.get("trim") or [None, None]
+    target_mb = job.get("target_mb", defaults["target_mb"])
+    target_mb = [float(t) for t in target_mb] if isinstance(target_mb, list) else float(target_mb)
+    result = {"id": job_id, "input": input_path, "target_mb": target_mb}
+    options = dict(
+        job_id=job_id,
+        input_path=input_path,
+        remove_audio=bool(job.get("remove_audio", defaults["remove_audio"])),
+        start_time=trim[0],
+        end_time=trim[1],
+        speed_mode=job.get("speed_mode", defaults["speed_mode"]),
+        output_resolution=job.get("resolution", defaults["resolution"]),
+        fps_mode=job.get("fps_mode", defaults["fps_mode"]),
+        deadline_seconds=job.get("deadline_s", defaults["deadline_s"]),
+        encoder=job.get("encoder", defaults["encoder"]),
+        progress_callback=lambda *a, **k: None,
+    )
+    start = time.monotonic()
+    try:
+        # compress() writes to the TTL-pruned tempdir; copy out anything we
+        # want to keep.
+        if isinstance(target_mb, list):
+            outs = _worker_compressor.compress_many(target_mbs=target_mb, **options)
+            outputs = []
+            for size, out in zip(target_mb, outs):
+                dest = Path(output_dir) / f"{Path(input_path).stem}_{job_id}_{size:g}mb.mp4"
+                shutil.copyfile(out, dest)
+                outputs.append({
+                    "target_mb": size, "output": str(dest),
+                    "output_mb": round(dest.stat().st_size / 1024 / 1024, 3),
+                })
+            result.update(status="ok", outputs=outputs)
+        else:
+            out = _worker_compressor.compress(
+                target_mb=target_mb,
+                predictive=bool(job.get("predictive", defaults["predictive"])),
+                segmented=False,
+                **options,
+            )
+            dest = Path(output_dir) / f"{Path(input_path).stem}_{job_id}.mp4"
+            shutil.copyfile(out, dest)
+            result.update(status="ok", output=str(dest), output_mb=round(dest.stat().st_size / 1024 / 1024, 3))
+    except CompressionCancelled as e:
+        result.update(status="cancelled", error=str(e))
+    except Exception as e:
+        result.update(status="error", error=str(e))
+    result["elapsed_s"] = round(time.monotonic() - start, 2)
+    return result
+
+
+def load_done(results_path):
+    """Ids with an "ok" result already recorded in results_path."""
+    done = set()
+    if not results_path.exists():
+        return done
+    with results_path.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a half-written last line from an interrupted run
+            if row.get("status") == "ok":
+                done.add(row.get("id"))
+    return done
+
+
+def read_manifest(path):
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if "input" not in job:
+                raise SystemExit(f"{path}:{lineno}: job has no \"input\"")
+            if job.get("id") and not JOB_ID_PATTERN.fullmatch(str(job["id"])):
+                raise SystemExit(f"{path}:{lineno}: job id {job['id']!r} must match {JOB_ID_PATTERN.pattern}")
+            jobs.append(job)
+    return jobs
+
+
+def _append_result(results, row):
+    results.write(json.dumps(row) + "\n")
+    results.flush()
+    print(f"{row['status']:9s} {row['id']}  {row['input']}  {row.get('output_mb', '-')} MB  {row['elapsed_s']}s"
+          + (f"  ({row['error']})" if row.get("error") else ""))
+
+
+def _new_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(_worker_cpus(workers),))
+
+
+def _collect(results, future, job):
+    """Record a finished future's result line. Returns False if its worker
+    died, which breaks the whole pool."""
+    try:
+        _append_result(results, future.result())
+        return True
+    except BrokenProcessPool as e:
+        _append_result(results, {
+            "id": job_id_for(job), "input": job["input"], "status": "error",
+            "error": f"worker process died: {e}", "elapsed_s": 0.0,
+        })
+        return False
+
+
+def run_manifest(args, defaults):
+    jobs = read_manifest(args.manifest)
+    done = load_done(args.results)
+    pending = [job for job in jobs if job_id_for(job) not in done]
+    print(f"{len(jobs)} jobs in manifest, {len(jobs) - len(pending)} already done, "
+          f"running {len(pending)} on {args.workers} workers")
+
+    queue = pending[::-1]
+    with args.results.open("a", encoding="utf-8") as results:
+        pool = _new_pool(args.workers)
+        running = {}  # future -> job
+        try:
+            while queue or running:
+                # One job per worker in flight, so a worker that dies takes
+                # as few queued jobs down with it as possible.
+                while queue and len(running) < args.workers:
+                    job = queue.pop()
+                    running[pool.submit(run_job, job, defaults, args.output_dir)] = job
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                healthy = True
+                for future in finished:
+                    healthy &= _collect(results, future, running.pop(future))
+                if not healthy:
+                    # Every other job in flight fails with it; those results
+                    # arrive on the next rounds. New jobs need a new pool.
+                    pool.shutdown(wait=False)
+                    pool = _new_pool(args.workers)
+        finally:
+            pool.shutdown(wait=True)
+
+
+def watch_folder(args, defaults):
+    done = load_done(args.results)
+    submitted = set()
+    last_sizes = {}
+    print(f"Watching {args.watch} (Ctrl-C to stop)")
+
+    with args.results.open("a", encoding="utf-8") as results:
+        pool = _new_pool(args.workers)
+        running = {}  # future -> job
+        try:
+            while True:
+                for path in sorted(args.watch.iterdir()):
+                    if path.suffix.lower() not in VIDEO_EXTENSIONS:
+                        continue
+                    signature = file_signature(str(path))
+                    if signature is None:
+                        continue
+                    job = {"id": hashlib.sha1(repr(signature).encode("utf-8")).hexdigest()[:12], "input": str(path)}
+                    if job["id"] in done or job["id"] in submitted:
+                        continue
+                    # Only pick a file up once its size has held still for a
+                    # full poll — uploads/copies into the folder land gradually.
+                    size = signature[1]
+                    if last_sizes.get(path) != size:
+                        last_sizes[path] = size
+                        continue
+                    submitted.add(job["id"])
+                    running[pool.submit(run_job, job, defaults, args.output_dir)] = job
+
+                healthy = True
+                for future in [f for f in running if f.done()]:
+                    healthy &= _collect(results, future, running.pop(future))
+                if not healthy:
+                    pool.shutdown(wait=False)
+                    pool = _new_pool(args.workers)
+                time.sleep(WATCH_POLL_SECONDS)
+        except KeyboardInterrupt:
+            print("Stopping; waiting for running jobs...")
+            for future in list(running):
+                wait([future])
+                _collect(results, future, running.pop(future))
+        finally:
+            pool.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress videos in bulk without the web UI.")
+    parser.add_argument("manifest", nargs="?", type=Path, help="JSONL manifest of jobs.")
+    parser.add_argument("--watch", type=Path, default=None,
+                        help="Watch this folder and compress new videos as they arrive.")
+    parser.add_argument("--results", type=Path, default=Path("batch_results.jsonl"),
+                        help="JSONL results file; appended to, and read to skip finished jobs.")
+    parser.add_argument("--output-dir", type=Path, default=Path("batch_out"),
+                        help="Where finished outputs are copied.")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Concurrent jobs. Default: one per two cores.")
+    parser.add_argument("--target-mb", type=float, nargs="+", default=[10.0],
+                        help="Target size; give several (--target-mb 10 50) for one multi-size job per file.")
+    parser.add_argument("--speed-mode", default="Prioritize Speed",
+                        choices=["Prioritize Speed", "Prioritize Quality"])
+    parser.add_argument("--resolution", default="Auto",
+                        choices=["Auto", "Original", "720p", "480p", "360p"])
+    parser.add_argument("--fps-mode", default="Auto", choices=["Auto", "On", "Off"])
+    parser.add_argument("--remove-audio", action="store_true")
+    parser.add_argument("--encoder", default="libx264", choices=["libx264", "libx265", "libsvtav1"])
+    parser.add_argument("--predictive", action="store_true",
+                        help="Single capped-CRF pass predicted from sampled windows instead of two-pass.")
+    parser.add_argument("--deadline-s", type=float, default=None,
+                        help="Per-job time budget; picks the slowest preset predicted to fit.")
+    args = parser.parse_args()
+
+    if bool(args.manifest) == bool(args.watch):
+        parser.error("give either a manifest or --watch DIR")
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    defaults = {
+        "target_mb": args.target_mb[0] if len(args.target_mb) == 1 else args.target_mb,
+        "speed_mode": args.speed_mode,
+        "resolution": args.resolution,
+        "fps_mode": args.fps_mode,
+        "remove_audio": args.remove_audio,
+        "deadline_s": args.deadline_s,
+        "encoder": args.encoder,
+        "predictive": args.predictive,
+    }
+    if args.watch:
+        watch_folder(args, defaults)
+    else:
+        run_manifest(args, defaults)
+
+
+if __name__ == "__main__":
+    main()
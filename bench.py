@@ -2,11 +2,19 @@
 
 Encodes every sample in test/ with each config in CONFIGS, measures wall-clock
 encode time, output size, and quality vs the original. Writes a JSON results
-file and prints a summary table.
+file and prints a summary table. Each raw config's per-pass CPU time is also
+appended to the compressor's cost-model history (cost_model.py), so bench
+runs on a machine calibrate its admission limits and ETAs.
 
     uv run python bench.py
     uv run python bench.py --target-mb 5
     uv run python bench.py --configs current_speed,speed_2pass_superfast
+    uv run python bench.py --filter-plan
+
+--filter-plan also times the production filter plan (filter_plan.py) for
+each source at Auto resolution/fps: the CPU each stage adds on top of a bare
+decode, next to its planned Mpx/s, and the whole chain against the old
+scale-then-fps order.
 
 The bench bypasses VideoCompressor and invokes ffmpeg directly so experimental
 configs (different presets, tunes, rc-lookahead, etc.) can be tried without
@@ -38,6 +46,7 @@ import argparse
 import json
 import os
 import re
+import resource
 import subprocess
 import time
 import uuid
@@ -135,6 +144,25 @@ def build_two_pass(input_path, output_path, vbitrate, abitrate, preset_p1, prese
     return [p1, p2]
 
 
+def build_backend(input_path, output_path, vbitrate, abitrate, encoder, preset, log_prefix):
+    """Encode with one of the compressor's ENCODER_BACKENDS, using exactly the
+    args production passes, so backend comparisons match what users get."""
+    from compressor import ENCODER_BACKENDS
+    backend = ENCODER_BACKENDS[encoder]
+    cmds = []
+    for pass_number in backend.passes:
+        cmd = [
+            "ffmpeg", "-y", "-i", str(input_path),
+            *backend.args(preset, vbitrate, 2, pass_number, str(log_prefix)),
+        ]
+        if pass_number == 1:
+            cmd += ["-an", "-f", "mp4", os.devnull]
+        else:
+            cmd += _audio_args(abitrate) + [str(output_path)]
+        cmds.append(cmd)
+    return cmds
+
+
 # Each config is (name, builder). builder(input, output, vbitrate, abitrate, log_prefix) → list of cmds.
 # NOTE: libx264 requires the same -preset on both passes of a two-pass encode.
 # A pass-1 preset that strips features (ultrafast disables mbtree/cabac/etc.)
@@ -150,6 +178,16 @@ CONFIGS = [
         lambda i, o, vb, ab, lp: build_two_pass(i, o, vb, ab, "veryfast", "veryfast", lp)),
     ("current_quality_medium",
         lambda i, o, vb, ab, lp: build_two_pass(i, o, vb, ab, "medium", "medium", lp)),
+    ("x265_2pass_ultrafast",
+        lambda i, o, vb, ab, lp: build_backend(i, o, vb, ab, "libx265", "ultrafast", lp)),
+    ("x265_2pass_fast",
+        lambda i, o, vb, ab, lp: build_backend(i, o, vb, ab, "libx265", "fast", lp)),
+    ("svtav1_preset12",
+        lambda i, o, vb, ab, lp: build_backend(i, o, vb, ab, "libsvtav1", "12", lp)),
+    ("svtav1_preset10",
+        lambda i, o, vb, ab, lp: build_backend(i, o, vb, ab, "libsvtav1", "10", lp)),
+    ("svtav1_preset8",
+        lambda i, o, vb, ab, lp: build_backend(i, o, vb, ab, "libsvtav1", "8", lp)),
 ]
 
 # Pipeline configs route through VideoCompressor.compress so we measure the
@@ -157,11 +195,20 @@ CONFIGS = [
 # overhead buffer, etc.) — not just the raw ffmpeg encoder. Configs above
 # the dashed line stress the encoder; configs below stress the pipeline.
 # Each tuple: (name, speed_mode, output_resolution).
-# (name, speed_mode, output_resolution, fps_mode)
+# (name, speed_mode, output_resolution, fps_mode[, extra compress() kwargs])
+#
+# The predictive_* configs run single-pass CRF predicted from sampled windows;
+# read their size delta against the two-pass config of the same speed mode
+# (and the "Predicted CRF" / "Size correction" lines the compressor prints)
+# for the prediction's accuracy. Sources under a minute fall back to
+# two-pass, so bench them on longer clips.
 PIPELINE_CONFIGS = [
     ("pipeline_speed_auto", "Prioritize Speed", "Auto", "Auto"),
     ("pipeline_speed_original", "Prioritize Speed", "Original", "Auto"),
     ("pipeline_quality_auto", "Prioritize Quality", "Auto", "Auto"),
+    ("predictive_speed_auto", "Prioritize Speed", "Auto", "Auto", {"predictive": True}),
+    ("predictive_speed_original", "Prioritize Speed", "Original", "Auto", {"predictive": True}),
+    ("predictive_quality_auto", "Prioritize Quality", "Auto", "Auto", {"predictive": True}),
 ]
 
 _pipeline_compressor = None
@@ -171,12 +218,15 @@ def _get_compressor():
     global _pipeline_compressor
     if _pipeline_compressor is None:
         from compressor import VideoCompressor
-        _pipeline_compressor = VideoCompressor()
+        # Result cache off: every config must actually run the encoder.
+        _pipeline_compressor = VideoCompressor(cache_max_bytes=0)
     return _pipeline_compressor
 
 
-def run_pipeline_encode(source_path, target_mb, speed_mode, output_resolution, fps_mode):
-    """Run a full VideoCompressor.compress pipeline. Returns (output_path, elapsed_s, error)."""
+def run_pipeline_encode(source_path, target_mb, speed_mode, output_resolution, fps_mode, **options):
+    """Run a full VideoCompressor.compress pipeline. Returns (output_path, elapsed_s, error).
+
+    options are passed through to compress() (e.g. predictive=True)."""
     from compressor import CompressionCancelled
     compressor = _get_compressor()
     job_id = uuid.uuid4().hex[:12]
@@ -193,6 +243,7 @@ def run_pipeline_encode(source_path, target_mb, speed_mode, output_resolution, f
             output_resolution=output_resolution,
             fps_mode=fps_mode,
             progress_callback=lambda *a, **k: None,
+            **options,
         )
         return Path(out), time.monotonic() - start, None
     except CompressionCancelled as e:
@@ -201,15 +252,115 @@ def run_pipeline_encode(source_path, target_mb, speed_mode, output_resolution, f
         return None, time.monotonic() - start, str(e)
 
 
+def _children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
 def run_encode(cmds):
-    """Run cmds sequentially. Returns (elapsed_seconds, error_tail_or_none)."""
+    """Run cmds sequentially.
+
+    Returns (elapsed_seconds, error_tail_or_none, cpu_seconds_per_cmd).
+    """
     start = time.monotonic()
+    cpu_per_cmd = []
     for cmd in cmds:
+        cpu_before = _children_cpu_seconds()
         result = subprocess.run(cmd, capture_output=True, text=True)
+        cpu_per_cmd.append(_children_cpu_seconds() - cpu_before)
         if result.returncode != 0:
             tail = "\n".join(result.stderr.strip().splitlines()[-5:])
-            return time.monotonic() - start, tail
-    return time.monotonic() - start, None
+            return time.monotonic() - start, tail, cpu_per_cmd
+    return time.monotonic() - start, None, cpu_per_cmd
+
+
+def _cmd_value(cmd, flag):
+    """Value following flag in an ffmpeg argv (the last occurrence), or None."""
+    values = [str(cmd[i + 1]) for i, arg in enumerate(cmd[:-1]) if arg == flag]
+    return values[-1] if values else None
+
+
+def record_cost_samples(cmds, cpu_per_cmd, mpx_frames):
+    """Feed each command's CPU time to the compressor's cost model.
+
+    Raw configs encode at source resolution and frame rate, so mpx_frames is
+    the source's. Commands without a recognizable -c:v / -preset are skipped.
+    """
+    from compressor import ENCODER_BACKENDS
+    model = _get_compressor().cost_model
+    for cmd, cpu_seconds in zip(cmds, cpu_per_cmd):
+        backend = ENCODER_BACKENDS.get(_cmd_value(cmd, "-c:v"))
+        preset = _cmd_value(cmd, "-preset")
+        if backend is None or preset is None:
+            continue
+        # x265 takes its pass inside -x265-params rather than -pass.
+        x265_pass = re.search(r"pass=(\d)", _cmd_value(cmd, "-x265-params") or "")
+        pass_number = int(_cmd_value(cmd, "-pass") or (x265_pass and x265_pass.group(1)) or 0)
+        model.record(backend.cost_key(preset), pass_number, mpx_frames, cpu_seconds, source="bench")
+
+
+def _filter_cpu_seconds(source_path, filter_args):
+    """Child CPU-seconds to decode source_path through filter_args into null."""
+    cmd = ["ffmpeg", "-v", "error", "-i", str(source_path), *filter_args, "-an", "-f", "null", "-"]
+    before = _children_cpu_seconds()
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return _children_cpu_seconds() - before
+
+
+def bench_filter_plan(source_path, meta, vbitrate):
+    """Time each stage of the Auto filter plan for this source.
+
+    A stage's cost is the CPU the chain gains when the stage is appended, so
+    stage costs plus the bare decode add up to the full chain. The legacy row
+    runs the same targets in the pre-planner order (scale, then fps, default
+    scaler).
+    """
+    from compressor import _resolve_target_fps, _resolve_target_height
+    from filter_plan import plan_filters
+
+    width, height, fps = meta.get("width") or 0, meta.get("height") or 0, meta.get("fps") or 0
+    target_fps = _resolve_target_fps("Auto", fps, width, height, vbitrate)
+    target_height = _resolve_target_height("Auto", height, width, target_fps or fps, vbitrate)
+    stages = plan_filters(width, height, fps, target_height, target_fps)["stages"]
+    if not stages:
+        print("  filter plan: nothing to filter at Auto")
+        return None
+
+    decode = _filter_cpu_seconds(source_path, [])
+    if decode is None:
+        return None
+    rows = []
+    previous = decode
+    for i, stage in enumerate(stages):
+        chain = _filter_cpu_seconds(source_path, ["-vf", ",".join(s["filter"] for s in stages[:i + 1])])
+        if chain is None:
+            return None
+        rows.append({
+            "stage": stage["name"], "filter": stage["filter"],
+            "planned_mpx_per_s": stage["mpx_per_second"], "cpu_s": round(chain - previous, 3),
+        })
+        previous = chain
+
+    legacy_parts = []
+    if target_height:
+        legacy_parts.append(f"scale=-2:{target_height}")
+    if target_fps:
+        legacy_parts.append(f"fps={target_fps}")
+    legacy = _filter_cpu_seconds(source_path, ["-vf", ",".join(legacy_parts)])
+
+    print(f"  filter plan (decode {decode:.2f}s CPU):")
+    for row in rows:
+        print(f"    {row['filter']:36s} +{row['cpu_s']:6.2f}s CPU  (planned {row['planned_mpx_per_s']} Mpx/s)")
+    if legacy is not None:
+        print(f"    {'planned chain':36s} {previous - decode:7.2f}s CPU vs legacy order {legacy - decode:.2f}s")
+    return {
+        "decode_cpu_s": round(decode, 3),
+        "stages": rows,
+        "chain_cpu_s": round(previous - decode, 3),
+        "legacy_chain_cpu_s": round(legacy - decode, 3) if legacy is not None else None,
+    }
 
 
 # When the encoded output has different dimensions than the reference (e.g.
@@ -296,13 +447,13 @@ def measure_xpsnr(reference, encoded):
 
 
 def cleanup_pass_logs(log_prefix):
-    for ext in ("-0.log", "-0.log.mbtree", ".log", ".log.mbtree"):
+    for ext in ("-0.log", "-0.log.mbtree", ".log", ".log.mbtree", ".x265.log", ".x265.log.cutree"):
         p = Path(str(log_prefix) + ext)
         if p.exists():
             p.unlink()
 
 
-def bench_source(source_path, target_mb, configs, pipeline_configs):
+def bench_source(source_path, target_mb, configs, pipeline_configs, filter_plan=False):
     meta = get_video_metadata(str(source_path))
     if not meta:
         raise SystemExit(f"Could not probe {source_path}")
@@ -323,6 +474,12 @@ def bench_source(source_path, target_mb, configs, pipeline_configs):
           f"{meta.get('width')}x{meta.get('height')}, bitrate {meta['bitrate'] / 1000:.0f} kbps")
     print(f"Plan:   {vbitrate / 1000:.0f} kbps video / {abitrate / 1000:.0f} kbps audio\n")
 
+    # Source megapixel-frames, for the cost-model samples each raw config
+    # contributes (pipeline configs record their own via VideoCompressor).
+    mpx_frames = None
+    if meta.get("width") and meta.get("height") and meta.get("fps"):
+        mpx_frames = meta["duration"] * meta["fps"] * meta["width"] * meta["height"] / 1e6
+
     def _record(name, out_path, elapsed, err):
         """Measure quality of `out_path` against `source_path`, print one line, append row."""
         if err:
@@ -362,24 +519,28 @@ def bench_source(source_path, target_mb, configs, pipeline_configs):
             "error": None,
         })
 
+    filter_results = bench_filter_plan(source_path, meta, vbitrate) if filter_plan else None
+
     rows = []
     for name, build in configs:
         out_path = OUT_DIR / f"{source_path.stem}__{name}.mp4"
         log_prefix = OUT_DIR / f"{source_path.stem}__{name}_log"
         print(f"  {name:36s} ", end="", flush=True)
         cmds = build(source_path, out_path, vbitrate, abitrate, log_prefix)
-        elapsed, err = run_encode(cmds)
+        elapsed, err, cpu_per_cmd = run_encode(cmds)
         cleanup_pass_logs(log_prefix)
+        if not err and mpx_frames:
+            record_cost_samples(cmds, cpu_per_cmd, mpx_frames)
         _record(name, out_path, elapsed, err)
 
     # Pipeline configs use VideoCompressor.compress() so they exercise Auto
     # resolution, the trim-bitrate probe, and any other production-pipeline
     # logic. Output paths live in the compressor's tempdir; bench just reads
     # them for quality measurement and lets the compressor's own TTL prune.
-    for name, speed_mode, output_resolution, fps_mode in pipeline_configs:
+    for name, speed_mode, output_resolution, fps_mode, *options in pipeline_configs:
         print(f"  {name:36s} ", end="", flush=True)
         out_path, elapsed, err = run_pipeline_encode(
-            source_path, target_mb, speed_mode, output_resolution, fps_mode,
+            source_path, target_mb, speed_mode, output_resolution, fps_mode, **(options[0] if options else {}),
         )
         _record(name, out_path, elapsed, err)
 
@@ -397,6 +558,7 @@ def bench_source(source_path, target_mb, configs, pipeline_configs):
         },
         "plan_kbps": {"video": round(vbitrate / 1000), "audio": round(abitrate / 1000)},
         "results": rows,
+        "filter_plan": filter_results,
     }
 
 
@@ -464,6 +626,8 @@ def main():
                         help="Target output size in MB. Default 10.")
     parser.add_argument("--configs", type=str, default=None,
                         help="Comma-separated config names. Default: all.")
+    parser.add_argument("--filter-plan", action="store_true",
+                        help="Also time each stage of the Auto filter plan per source.")
     args = parser.parse_args()
 
     OUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -496,7 +660,7 @@ def main():
         configs = CONFIGS
         pipeline_configs = PIPELINE_CONFIGS
 
-    runs = [bench_source(src, args.target_mb, configs, pipeline_configs) for src in sources]
+    runs = [bench_source(src, args.target_mb, configs, pipeline_configs, args.filter_plan) for src in sources]
 
     with RESULTS_PATH.open("w") as f:
         json.dump({"runs": runs}, f, indent=2)
@@ -1,3 +1,5 @@
+import asyncio
+import math
 import os
 import re
 import shutil
@@ -6,12 +8,31 @@ import tempfile
 import threading
 import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, asynccontextmanager, contextmanager, nullcontext
+from functools import partial
+from cost_model import EncodeCostModel
+from cpu_budget import MIN_JOB_THREADS, CpuBudget, split_threads
+from filter_plan import plan_filters
+from janitor import OutputJanitor
+from metrics import MetricsRegistry, wait_with_rusage
+from packet_index import PacketIndexStore
+from presets import PresetThroughput
+from result_cache import ResultCache, hash_file, link_or_copy, make_cache_key
+from scheduler import JobScheduler
 from utils import (
     compute_bitrate_plan,
+    fit_crf_for_bitrate,
+    fragmented_mp4_ready_bytes,
+    get_keyframe_times,
     get_trim_bitrate,
+    get_trim_stream_bytes,
     get_video_metadata,
     pick_auto_fps_cap,
     pick_auto_resolution,
+    pick_preview_windows,
+    plan_segments,
 )
 
 # Encode artifacts live in the platform tempdir so the working directory stays
@@ -19,17 +40,132 @@ from utils import (
 OUTPUT_DIR = os.path.join(tempfile.gettempdir(), "10mb_video_outputs")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Per-job subdirs in OUTPUT_DIR older than this get pruned at the start of each
-# compress() call. Long enough that a user has time to download; short enough that
-# the free-tier Space disk doesn't fill up.
+# Per-job subdirs in OUTPUT_DIR idle longer than this are removed by the
+# background janitor (janitor.py). Long enough that a user has time to
+# download; short enough that the free-tier Space disk doesn't fill up.
 OUTPUT_TTL_SECONDS = 3600
 
+# Byte quota across all job subdirs. A burst of large outputs would otherwise
+# fill the disk well inside the TTL; past this, the janitor evicts the least
+# recently used finished jobs first. Running jobs and in-flight downloads are
+# pinned and never evicted, so the quota can be exceeded while they hold it.
+OUTPUT_MAX_BYTES = 8 * 1024 * 1024 * 1024
+JANITOR_INTERVAL_SECONDS = 60
+
+# Finished outputs are also kept in a content-addressed cache so re-uploads
+# and repeat clicks with identical settings skip the encode entirely. The
+# cache lives under OUTPUT_DIR (prefixed "_" so job pruning leaves it alone)
+# and is bounded by bytes, evicting least-recently-used first.
+RESULT_CACHE_DIRNAME = "_cache"
+RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Spooled per-upload packet indexes (see packet_index.py). Pruned on the same
+# TTL as job directories.
+PACKET_INDEX_DIRNAME = "_index"
+
 # Free-tier HF Spaces have limited RAM and the ffmpeg decode path can balloon
 # quickly on large inputs. Reject sources above this size before we burn any
 # encode time — users with bigger sources should trim/downscale locally first.
 MAX_INPUT_MB = 500
 MAX_INPUT_BYTES = MAX_INPUT_MB * 1024 * 1024
 
+# Input bytes say little about encode work: a 400 MB ten-minute 1080p60 clip
+# and a 400 MB thirty-second ProRes file differ by an order of magnitude in
+# CPU. Encodes predicted (by cost_model.py) to need more CPU than this are
+# refused before they queue.
+MAX_JOB_CPU_SECONDS = 4 * 3600
+
+# Per-(preset, pass) CPU samples from finished jobs and bench.py runs, kept
+# under OUTPUT_DIR so the cost model's fit survives restarts.
+COST_HISTORY_FILENAME = "_cost_history.jsonl"
+
+# x264 preset for each speed mode. "Fit Time Budget" (see presets.py) picks
+# one per job instead.
+SPEED_MODE_PRESETS = {
+    "Prioritize Speed": "superfast",
+    "Prioritize Quality": "medium",
+}
+
+
+# Segmented mode splits the source at keyframes and runs pass 1 + pass 2 for
+# every chunk concurrently, then stream-copies the chunks back together. It
+# only pays off when there are spare cores and enough footage to keep them
+# busy — on the 2-vCPU free tier the single-stream encode is already optimal.
+SEGMENT_MIN_DURATION = 120
+SEGMENT_MIN_CPUS = 4
+# Shortest chunk we'll hand to a worker. Two-pass rate control needs a few
+# GOPs of runway to converge on the target bitrate.
+SEGMENT_MIN_SECONDS = 20
+
+# Closed-loop size control. Pass 2's bytes written are projected to a final
+# size as it runs; a projection over the target stops it and pass 2 reruns
+# (reusing pass 1's stats) at a bitrate scaled to land SIZE_TOLERANCE / 2
+# under target. Outputs that still finish over target get the same
+# correction, up to SIZE_CORRECTION_ATTEMPTS reruns in all. Projections
+# before SIZE_GUARD_MIN_PROGRESS of the frames are too noisy to act on.
+SIZE_TOLERANCE = 0.03
+SIZE_GUARD_MIN_PROGRESS = 0.25
+SIZE_CORRECTION_ATTEMPTS = 2
+
+# Predictive single-pass mode: instead of a full pass 1, encode this many
+# short windows (spread through the range) at each of the backend's
+# probe_crfs, fit size vs CRF, and run one capped-CRF pass at the CRF the fit
+# predicts for the target. 5 x 3s windows at three CRFs is 45s of encode —
+# a fraction of pass 1 on anything over a couple of minutes. Below
+# PREDICTIVE_MIN_DURATION the probes cost about as much as pass 1 would, so
+# the two-pass encode runs instead.
+PREDICTIVE_WINDOWS = 5
+PREDICTIVE_WINDOW_SECONDS = 3
+PREDICTIVE_MIN_DURATION = 60
+# Share of the progress bar given to the probe encodes.
+PREDICTIVE_PROGRESS = 0.1
+
+# Preview: this many short windows, spread through the trimmed range, are
+# encoded with the full job's plan so users can judge resolution/fps before
+# paying for the whole encode.
+PREVIEW_WINDOWS = 3
+PREVIEW_WINDOW_SECONDS = 4
+
+# Decode-once mode: decode + trim + scale/fps the source a single time into a
+# lossless intermediate that both passes read, instead of each pass decoding
+# the original. Worth it on HEVC/VP9/4K sources where decode+scale is a big
+# slice of total CPU. "Auto" times a short decode sample and turns the mode on
+# when decode+filter costs more than this many seconds per source second.
+DECODE_ONCE_COST_THRESHOLD = 0.2
+DECODE_PROBE_SECONDS = 3
+# Below this the probe itself isn't worth running.
+DECODE_ONCE_MIN_DURATION = 30
+# Rough size of lossless ultrafast x264 per output pixel, used to check the
+# spool fits. Deliberately pessimistic; a miss just falls back to per-pass
+# decoding.
+DECODE_ONCE_BYTES_PER_PIXEL = 0.5
+DECODE_ONCE_TMPFS = "/dev/shm"
+# Share of the progress bar given to writing the intermediate.
+DECODE_ONCE_PROGRESS = 0.15
+
+# Pass 2 writes fragmented MP4: an empty moov up front, then a moof + mdat
+# per keyframe interval. The file is playable as it grows (live_output()
+# serves the complete fragments) and is finished the moment ffmpeg exits —
+# no +faststart pass rewriting the file to move a trailing moov.
+FRAGMENTED_MP4_ARGS = ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+
+# Minimum gap between progress_callback calls per ffmpeg run. Each call can be
+# a websocket push to the browser; two a second is plenty for a progress bar.
+PROGRESS_INTERVAL_SECONDS = 0.5
+
+
+# Stream-copy fast paths: before committing to a two-pass encode, check
+# whether a remux gets under target (see _plan_stream_copy). Video is copied
+# only when it's already in the requested encoder's codec, and only for
+# codecs browsers' <video> can play, which the result player depends on
+# (HEVC support is too patchy).
+_COPYABLE_VIDEO_CODECS = ("h264", "av1")
+# Audio codecs the MP4 muxer takes as-is.
+_COPYABLE_AUDIO_CODECS = ("aac", "mp3")
+# Share of the target a remux may fill; the remainder covers MP4 overhead,
+# which packet-byte sums don't include.
+REMUX_SIZE_MARGIN = 0.97
+
 
 _RESOLUTION_HEIGHTS = {"720p": 720, "480p": 480, "360p": 360}
 
@@ -73,6 +209,50 @@ def _resolve_target_height(output_resolution, source_height, source_width, sourc
     return 0
 
 
+def _plan_stream_copy(stream_bytes, budget_bytes, keep_audio, audio_codec, planned_audio_bytes):
+    """Pick the cheapest remux route that fits budget_bytes, or None.
+
+    Routes, cheapest first:
+      "copy_all"                 — copy video and audio (a plain or trimmed remux)
+      "copy_video"               — copy video, drop audio (-an)
+      "copy_video_encode_audio"  — copy video, re-encode only the audio
+    stream_bytes holds the packet bytes of the range being copied.
+    """
+    video = stream_bytes["video"]
+    if not keep_audio:
+        return "copy_video" if video <= budget_bytes else None
+    if audio_codec in _COPYABLE_AUDIO_CODECS and video + stream_bytes["audio"] <= budget_bytes:
+        return "copy_all"
+    if video + planned_audio_bytes <= budget_bytes:
+        return "copy_video_encode_audio"
+    return None
+
+
+def _remux_fits(output_path, target_bytes):
+    """Check a finished remux against the target, discarding it if it overshot.
+
+    The planner's byte sums exclude container overhead; if the margin wasn't
+    enough, the caller falls through to a real encode rather than overshoot.
+    """
+    try:
+        if os.path.getsize(output_path) <= target_bytes:
+            return True
+        os.remove(output_path)
+    except OSError:
+        pass
+    return False
+
+
+def _can_copy_audio(meta, planned_audio_bitrate):
+    """True when the source audio is AAC already at or below the planned bitrate."""
+    source_bitrate = meta.get("audio_bitrate")
+    return (
+        meta.get("audio_codec") == "aac"
+        and source_bitrate is not None
+        and 0 < source_bitrate <= planned_audio_bitrate
+    )
+
+
 _ERROR_HINTS = ("Error", "Invalid", "not found", "Conversion failed", "No such")
 
 
@@ -99,12 +279,557 @@ def _summarize_ffmpeg_error(stderr_buffer):
     return "ffmpeg failed (no stderr output)."
 
 
+def _parse_progress_block(block):
+    """Normalize one -progress key/value block into numbers.
+
+    ffmpeg reports N/A for fields it doesn't know yet (speed before the first
+    frame, total_size on the null muxer); those come back as 0. out_time_us
+    is preferred; out_time_ms is the same value (it's microseconds too,
+    despite the name) and is the fallback on older builds.
+    """
+    def number(key, cast=float):
+        try:
+            return cast(block.get(key, "").rstrip("x"))
+        except ValueError:
+            return cast(0)
+
+    out_time_us = number("out_time_us", int) or number("out_time_ms", int)
+    return {
+        "frame": number("frame", int),
+        "fps": number("fps"),
+        "speed": number("speed"),
+        "out_time": max(out_time_us, 0) / 1_000_000,
+        "total_size": number("total_size", int),
+    }
+
+
+class _ProgressStream:
+    """Incremental, throttled parser for ffmpeg's -progress key/value stream.
+
+    feed() takes one line at a time; when a block completes ("progress=..."),
+    it's parsed into self.stats, and feed() returns True if at least
+    interval seconds have passed since the last report (always on the final
+    "progress=end" block). Shared by the thread- and asyncio-based runners.
+    """
+
+    def __init__(self, interval):
+        self.stats = {}
+        self._block = {}
+        self._interval = interval
+        self._last_emit = 0.0
+
+    def feed(self, line):
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return False
+        self._block[key] = value
+        if key != "progress":
+            return False
+        self.stats = _parse_progress_block(self._block)
+        self._block = {}
+        now = time.monotonic()
+        if value != "end" and now - self._last_emit < self._interval:
+            return False
+        self._last_emit = now
+        return True
+
+    def report(self, progress_callback, total_duration, progress_start, progress_end, description):
+        fraction_complete = min(self.stats["out_time"] / total_duration, 1.0) if total_duration else 0.0
+        global_progress = progress_start + (fraction_complete * (progress_end - progress_start))
+        progress_callback(global_progress, desc=_describe_progress(description, self.stats, total_duration))
+
+
+def _x264_frame_weights(log_prefix):
+    """Cumulative share of pass 2's bits expected by each output frame,
+    from libx264's pass-1 stats, or None when the log isn't readable.
+
+    x264's second pass hands each frame bits in proportion to roughly its
+    pass-1 size ** (1 - qcomp), with qcomp = 0.6 by default, so that's the
+    weight used; it tracks bursts (scene cuts, motion) far better than
+    assuming bytes accrue linearly with time.
+    """
+    weights = {}
+    try:
+        with open(log_prefix + "-0.log", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                fields = dict(part.split(":", 1) for part in line.split() if ":" in part)
+                try:
+                    frame = int(fields["out"])
+                    bits = int(fields["tex"]) + int(fields["mv"]) + int(fields["misc"])
+                except (KeyError, ValueError):
+                    continue
+                weights[frame] = max(bits, 1) ** 0.4
+    except OSError:
+        return None
+    if not weights:
+        return None
+    total = sum(weights.values())
+    cumulative, running = [], 0.0
+    for frame in sorted(weights):
+        running += weights[frame]
+        cumulative.append(running / total)
+    return cumulative
+
+
+class _SizeGuard:
+    """Projects an encode's final size from its -progress stream.
+
+    Called with each progress block; returns True once, past
+    SIZE_GUARD_MIN_PROGRESS, the projection exceeds target_bytes — the
+    signal to stop and rerun at a lower bitrate. Audio (audio_bitrate, bits
+    per second) is assumed to accrue linearly with time and video by
+    frame_weights (see _x264_frame_weights) or, without them, linearly too.
+    """
+
+    def __init__(self, target_bytes, duration, audio_bitrate=0, frame_weights=None):
+        self.target_bytes = target_bytes
+        self.duration = duration
+        self.audio_bitrate = audio_bitrate
+        self.frame_weights = frame_weights
+        self.projected = None
+
+    def __call__(self, stats):
+        if not self.duration or stats["total_size"] <= 0:
+            return False
+        time_fraction = min(stats["out_time"] / self.duration, 1.0)
+        video_fraction = time_fraction
+        if self.frame_weights and stats["frame"] > 0:
+            video_fraction = self.frame_weights[min(stats["frame"], len(self.frame_weights)) - 1]
+        if video_fraction < SIZE_GUARD_MIN_PROGRESS:
+            return False
+        audio_total = self.audio_bitrate * self.duration / 8
+        video_so_far = max(stats["total_size"] - audio_total * time_fraction, 0)
+        self.projected = video_so_far / video_fraction + audio_total
+        return self.projected > self.target_bytes
+
+
+def _corrected_bitrate(video_bitrate, target_bytes, actual_bytes, audio_bytes=0):
+    """Video bitrate that should bring actual_bytes to SIZE_TOLERANCE / 2
+    under target_bytes, holding audio_bytes fixed."""
+    goal = target_bytes * (1 - SIZE_TOLERANCE / 2) - audio_bytes
+    spent = max(actual_bytes - audio_bytes, 1)
+    return max(video_bitrate * goal / spent, 10000)
+
+
+def _next_pass2_rate(plan, backend, video_bitrate, crf, actual_bytes, projected=False):
+    """(video_bitrate, crf) for rerunning pass 2 after one that came in (or
+    was projected, see _SizeGuard) at actual_bytes over plan's target. A
+    predictive plan's CRF walks down its fitted curve by the same ratio."""
+    audio_bytes = plan["audio_bitrate"] * plan["duration"] / 8
+    corrected = _corrected_bitrate(video_bitrate, plan["target_bytes"], actual_bytes, audio_bytes)
+    if crf is not None:
+        low, high = backend.crf_range
+        crf = round(min(max(crf + math.log(corrected / video_bitrate) / plan["crf_slope"], low), high), 1)
+    print(
+        f"Size correction: {actual_bytes / 1e6:.2f} MB {'projected' if projected else 'written'} "
+        f"vs {plan['target_bytes'] / 1e6:.2f} MB target; rerunning pass 2 at {corrected / 1000:.0f} kbps"
+        + (f" (CRF {crf:g})" if crf is not None else "")
+    )
+    return corrected, crf
+
+
+def _segments_to_correct(video_bitrate, durations, sizes):
+    """[(index, corrected_bitrate)] for the chunks to rerun so the chunks'
+    total fits their combined budget (video_bitrate * duration each).
+
+    Nothing is rerun while the total is within SIZE_TOLERANCE of budget —
+    a chunk over its share is fine when others came in under. Otherwise the
+    worst offenders go first, just enough of them to cover the excess.
+    """
+    budgets = [video_bitrate * duration / 8 for duration in durations]
+    excess = sum(sizes) - sum(budgets) * (1 + SIZE_TOLERANCE)
+    corrections = []
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i] - budgets[i], reverse=True):
+        if excess <= 0 or sizes[index] <= budgets[index]:
+            break
+        corrections.append((index, _corrected_bitrate(video_bitrate, budgets[index], sizes[index])))
+        excess -= sizes[index] - budgets[index] * (1 - SIZE_TOLERANCE / 2)
+    return corrections
+
+
+def _describe_progress(description, stats, total_duration):
+    """Append encode speed and an ETA to a progress description."""
+    if not description or stats["speed"] <= 0:
+        return description
+    remaining = max(total_duration - stats["out_time"], 0.0) / stats["speed"]
+    return f"{description} {stats['speed']:.1f}x, ~{remaining:.0f}s left"
+
+
+def _vbv_args(video_bitrate):
+    return ["-b:v", str(int(video_bitrate)), *_vbv_cap_args(video_bitrate)]
+
+
+def _vbv_cap_args(video_bitrate):
+    return [
+        "-maxrate", str(int(video_bitrate * 1.5)),
+        "-bufsize", str(int(video_bitrate * 2)),
+    ]
+
+
+class EncoderBackend:
+    """One ffmpeg video encoder: its presets, rate control and pass handling.
+
+    args() returns the encoder args for one pass — pass_number 1 or 2 of a
+    two-pass encode, or 0 for a backend that encodes in a single pass
+    (passes == (0,)). log_prefix names the backend's stats files; the
+    suffixes it writes are listed in log_suffixes for cleanup.
+
+    crf_args() returns the args for a single capped-CRF pass, used by
+    predictive mode: quality set by crf, peaks held to video_bitrate's VBV
+    caps. probe_crfs are the CRFs its sample windows are encoded at and
+    crf_range clamps the fitted one.
+    """
+
+    name = None
+    # ffprobe codec_name of this backend's output, for stream-copy routes.
+    codec_name = None
+    speed_presets = {}
+    passes = (1, 2)
+    log_suffixes = ()
+    probe_crfs = ()
+    crf_range = None
+
+    def args(self, preset, video_bitrate, threads, pass_number, log_prefix):
+        raise NotImplementedError
+
+    def crf_args(self, preset, crf, video_bitrate, threads):
+        raise NotImplementedError
+
+    def cost_key(self, preset):
+        """Key the cost model tracks this backend's preset under."""
+        return f"{self.name}:{preset}"
+
+
+class _X264Backend(EncoderBackend):
+    name = "libx264"
+    codec_name = "h264"
+    speed_presets = SPEED_MODE_PRESETS
+    log_suffixes = ("-0.log", "-0.log.mbtree", ".log", ".log.mbtree")
+    probe_crfs = (20, 27, 34)
+    crf_range = (10, 51)
+
+    def args(self, preset, video_bitrate, threads, pass_number, log_prefix):
+        # NOTE: two-pass *requires* the same -preset on both passes. A pass-1
+        # preset that strips features (e.g. ultrafast disables mbtree/cabac)
+        # produces a stats file that pass 2 refuses to consume ("Could not
+        # open encoder before EOF" / EINVAL). libx264 already optimizes pass
+        # 1 internally via --slow-firstpass=0 (the default), so don't try to
+        # speed it up further by overriding the preset.
+        return [
+            "-c:v", "libx264",
+            "-preset", preset,
+            "-threads", str(threads),
+            "-x264-params", f"lookahead-threads={split_threads(threads)['lookahead_threads']}",
+            *_vbv_args(video_bitrate),
+            "-passlogfile", log_prefix,
+            "-pass", str(pass_number),
+        ]
+
+    def crf_args(self, preset, crf, video_bitrate, threads):
+        return [
+            "-c:v", "libx264",
+            "-preset", preset,
+            "-threads", str(threads),
+            "-x264-params", f"lookahead-threads={split_threads(threads)['lookahead_threads']}",
+            "-crf", f"{crf:g}",
+            *_vbv_cap_args(video_bitrate),
+        ]
+
+    def cost_key(self, preset):
+        # Bare preset names, as the cost history recorded before there were
+        # other backends.
+        return preset
+
+
+class _X265Backend(EncoderBackend):
+    """libx265 two-pass. ffmpeg's -pass/-passlogfile don't reach x265, so
+    the pass and stats file go through -x265-params; VBV maps from
+    -maxrate/-bufsize as with x264. x265's presets run several times slower
+    than x264's namesakes, hence the faster mapping."""
+
+    name = "libx265"
+    codec_name = "hevc"
+    speed_presets = {"Prioritize Speed": "ultrafast", "Prioritize Quality": "fast"}
+    log_suffixes = (".x265.log", ".x265.log.cutree", ".x265.log.temp", ".x265.log.cutree.temp")
+    probe_crfs = (22, 28, 34)
+    crf_range = (10, 51)
+
+    def args(self, preset, video_bitrate, threads, pass_number, log_prefix):
+        params = f"pools={threads}:log-level=error:pass={pass_number}:stats={log_prefix}.x265.log"
+        return [
+            "-c:v", "libx265",
+            "-preset", preset,
+            *_vbv_args(video_bitrate),
+            "-x265-params", params,
+            # hvc1 rather than hev1, or Safari/QuickTime won't play the MP4.
+            "-tag:v", "hvc1",
+        ]
+
+    def crf_args(self, preset, crf, video_bitrate, threads):
+        return [
+            "-c:v", "libx265",
+            "-preset", preset,
+            "-crf", f"{crf:g}",
+            *_vbv_cap_args(video_bitrate),
+            "-x265-params", f"pools={threads}:log-level=error",
+            "-tag:v", "hvc1",
+        ]
+
+
+class _SvtAv1Backend(EncoderBackend):
+    """libsvtav1 single-pass VBR. ffmpeg's wrapper doesn't expose SVT-AV1's
+    multi-pass stats, but SVT's lookahead-driven VBR lands close to target
+    on its own. SVT-AV1 rejects -maxrate outside CRF mode, so no VBV caps
+    are passed, and ignores -threads; its lp parameter bounds the thread
+    pool instead. In CRF mode it does take -maxrate (capped CRF), though
+    not -bufsize; and its CRF takes whole numbers only."""
+
+    name = "libsvtav1"
+    codec_name = "av1"
+    speed_presets = {"Prioritize Speed": "10", "Prioritize Quality": "8"}
+    passes = (0,)
+    probe_crfs = (30, 40, 50)
+    crf_range = (10, 63)
+
+    def args(self, preset, video_bitrate, threads, pass_number, log_prefix):
+        return [
+            "-c:v", "libsvtav1",
+            "-preset", str(preset),
+            "-b:v", str(int(video_bitrate)),
+            "-svtav1-params", f"rc=1:lp={threads}",
+        ]
+
+    def crf_args(self, preset, crf, video_bitrate, threads):
+        return [
+            "-c:v", "libsvtav1",
+            "-preset", str(preset),
+            "-crf", str(round(crf)),
+            "-maxrate", str(int(video_bitrate * 1.5)),
+            "-svtav1-params", f"lp={threads}",
+        ]
+
+
+ENCODER_BACKENDS = {backend.name: backend for backend in (_X264Backend(), _X265Backend(), _SvtAv1Backend())}
+DEFAULT_ENCODER = "libx264"
+
+
+def _encoder_backend(encoder):
+    backend = ENCODER_BACKENDS.get(encoder or DEFAULT_ENCODER)
+    if backend is None:
+        raise Exception(f"Unknown encoder {encoder!r}; choose one of {', '.join(ENCODER_BACKENDS)}.")
+    return backend
+
+
+def _two_pass_commands(plan, threads, intermediate=None):
+    """Build (cmd_pass1, cmd_pass2, pass_log_prefix) for a single-stream plan.
+
+    threads is the job's current CPU share (see cpu_budget.CpuBudget): the
+    encoder gets all of it and the decoder a fraction
+    (split_threads()["decode_threads"]).
+
+    With an intermediate (decode-once mode) both passes read the already
+    trimmed + filtered spool, and pass 2 pulls audio from the (trimmed)
+    source as a second input. A plan with an "audio_file" (AAC encoded
+    ahead of time, see VideoCompressor._encode) has pass 2 copy its audio
+    from there instead. For single-pass backends, and for plans with a
+    "crf" (predictive mode, see VideoCompressor._probe_crf), cmd_pass1 is
+    None and cmd_pass2 is the one encode.
+    """
+    backend = ENCODER_BACKENDS[plan["encoder"]]
+    input_path = plan["input_path"]
+    # -threads before -i sizes the decoder; after it, the encoder.
+    decode_threads = ["-threads", str(split_threads(threads)["decode_threads"])]
+    video_input = [*decode_threads, "-i", input_path]
+    trim_args = plan["trim_args"]
+    scale_args = plan["scale_args"]
+    audio_input, stream_map = [], []
+    audio_args = plan["audio_args"]
+    if intermediate:
+        video_input = [*decode_threads, "-i", intermediate]
+        trim_args, scale_args = [], []
+        if plan["audio_args"] != ["-an"]:
+            audio_input = [*plan["trim_args"], "-i", input_path]
+            stream_map = ["-map", "0:v:0", "-map", "1:a:0"]
+    if plan.get("audio_file"):
+        # The file is already trimmed and starts at 0. Output-side -ss/-to
+        # cut every stream, so shift it to the trim start first.
+        offset = ["-itsoffset", str(plan["start"])] if trim_args else []
+        audio_input = [*offset, "-i", plan["audio_file"]]
+        stream_map = ["-map", "0:v:0", "-map", "1:a:0"]
+        audio_args = ["-c:a", "copy"]
+
+    common_args = ["-y", *trim_args, *scale_args]
+
+    # Both Speed and Quality run two-pass; only the preset differs.
+    # Bench data (see bench.py) showed -tune fastdecode is a free quality
+    # loss across every metric and every content type (animation, gameplay,
+    # natural), and that single-pass at low target sizes gives up
+    # noticeable quality on varied content (e.g. ~+2 VMAF on animation
+    # when we switch to two-pass at the same superfast preset).
+    pass_log_prefix = os.path.join(plan["job_dir"], "ffmpeg2pass")
+
+    def encoder_args(pass_number):
+        if plan.get("crf") is not None:
+            return backend.crf_args(plan["preset"], plan["crf"], plan["video_bitrate"], threads)
+        return backend.args(plan["preset"], plan["video_bitrate"], threads, pass_number, pass_log_prefix)
+
+    cmd_pass1 = None
+    if backend.passes == (1, 2) and plan.get("crf") is None:
+        cmd_pass1 = [
+            "ffmpeg", *video_input,
+            *common_args,
+            *encoder_args(1),
+            "-an",
+            "-f", "mp4", os.devnull
+        ]
+    cmd_pass2 = [
+        "ffmpeg", *video_input, *audio_input,
+        *common_args,
+        *stream_map,
+        *encoder_args(backend.passes[-1]),
+        *audio_args,
+        *FRAGMENTED_MP4_ARGS,
+        plan["output_path"]
+    ]
+    return cmd_pass1, cmd_pass2, pass_log_prefix
+
+
+def _multi_target_commands(plans, threads):
+    """Build (cmd_pass1, cmd_pass2) encoding every plan from one decode.
+
+    plans come from VideoCompressor.compress_many and share an input, trim
+    and encoder. Each pass decodes the source once and splits the frames
+    into one filter chain + encoder per plan (its own resolution, fps cap,
+    bitrate and stats file, in its own job_dir), so N sizes cost one decode
+    per pass plus N encodes. threads, the job's CPU share, is divided
+    between the encoders. The trim is input-side so one seek serves every
+    output. cmd_pass1 is None for single-pass backends.
+    """
+    first = plans[0]
+    backend = ENCODER_BACKENDS[first["encoder"]]
+    encoder_threads = max(1, threads // len(plans))
+    trim_args = ["-ss", str(first["start"]), "-to", str(first["end"])] if first["trim_args"] else []
+    video_input = [
+        "-threads", str(split_threads(threads)["decode_threads"]), *trim_args, "-i", first["input_path"],
+    ]
+    graph = [f"[0:v]split={len(plans)}" + "".join(f"[v{i}]" for i in range(len(plans)))]
+    for i, plan in enumerate(plans):
+        # scale_args is ["-vf", chain, *output options] or [] (see filter_plan).
+        graph.append(f"[v{i}]{plan['scale_args'][1] if plan['scale_args'] else 'null'}[out{i}]")
+    head = ["ffmpeg", "-y", *video_input, "-filter_complex", ";".join(graph)]
+
+    def encoder_args(plan, pass_number):
+        log_prefix = os.path.join(plan["job_dir"], "ffmpeg2pass")
+        return backend.args(plan["preset"], plan["video_bitrate"], encoder_threads, pass_number, log_prefix)
+
+    cmd_pass1 = None
+    if backend.passes == (1, 2):
+        cmd_pass1 = list(head)
+        for i, plan in enumerate(plans):
+            cmd_pass1 += [
+                "-map", f"[out{i}]", *plan["scale_args"][2:], *encoder_args(plan, 1),
+                "-an", "-f", "mp4", os.devnull,
+            ]
+    cmd_pass2 = list(head)
+    for i, plan in enumerate(plans):
+        audio_map = [] if plan["audio_args"] == ["-an"] else ["-map", "0:a:0"]
+        cmd_pass2 += [
+            "-map", f"[out{i}]", *audio_map, *plan["scale_args"][2:],
+            *encoder_args(plan, backend.passes[-1]), *plan["audio_args"],
+            *FRAGMENTED_MP4_ARGS, plan["output_path"],
+        ]
+    return cmd_pass1, cmd_pass2
+
+
+class _SegmentProgress:
+    """Folds per-chunk progress from concurrent workers into one callback.
+
+    Each chunk reports its own 0..1 value (pass 1 maps to 0..0.25, pass 2 to
+    0.25..1 exactly as in the single-stream path). The aggregate is weighted
+    by chunk duration and scaled into [0, span] so the concat step still has
+    room at the end of the bar.
+    """
+
+    def __init__(self, progress_callback, durations, span, description, interval):
+        self._callback = progress_callback
+        self._interval = interval
+        self._last_emit = 0.0
+        self._durations = durations
+        self._total = sum(durations) or 1.0
+        self._values = [0.0] * len(durations)
+        self._span = span
+        self._description = description
+        self._lock = threading.Lock()
+
+    def for_chunk(self, index):
+        def report(value, desc=None):
+            with self._lock:
+                self._values[index] = value
+                # Every worker is already throttled, but N workers would
+                # still mean N times the callback rate without this.
+                now = time.monotonic()
+                if now - self._last_emit < self._interval:
+                    return
+                self._last_emit = now
+                done = sum(v * d for v, d in zip(self._values, self._durations))
+                self._callback(self._span * done / self._total, desc=self._description)
+        return report
+
+
+def _crf_probe_commands(plan, backend, windows, threads):
+    """Per window, a (probe_path, cmd) for each of backend.probe_crfs in
+    turn: the encodes VideoCompressor._probe_crf measures."""
+    probes = []
+    for index, (start, end) in enumerate(windows):
+        window_probes = []
+        for i, crf in enumerate(backend.probe_crfs):
+            probe_path = os.path.join(plan["job_dir"], f"probe_{index}_{i}.mp4")
+            window_probes.append((probe_path, [
+                "ffmpeg", "-ss", str(start), "-t", str(end - start), "-i", plan["input_path"],
+                "-y", *plan["scale_args"],
+                *backend.crf_args(plan["preset"], crf, plan["video_bitrate"], threads),
+                "-an", probe_path,
+            ]))
+        probes.append(window_probes)
+    return probes
+
+
+def _fit_crf_probes(plan, backend, durations, window_sizes):
+    """Fit (crf, slope) from _crf_probe_commands' output sizes, or None.
+
+    Each CRF's total bytes over all windows becomes a bitrate over the
+    sampled seconds (see utils.fit_crf_for_bitrate).
+    """
+    sampled = sum(durations)
+    samples = [
+        (crf, sum(sizes[i] for sizes in window_sizes) * 8 / sampled)
+        for i, crf in enumerate(backend.probe_crfs)
+    ]
+    fit = fit_crf_for_bitrate(samples, plan["video_bitrate"], backend.crf_range)
+    print("CRF probes: " + ", ".join(f"crf {crf} -> {bitrate / 1000:.0f} kbps" for crf, bitrate in samples))
+    if fit is None:
+        print("CRF probes gave no usable size curve; encoding two-pass instead.")
+    else:
+        print(f"Predicted CRF {fit[0]:g} for {plan['video_bitrate'] / 1000:.0f} kbps")
+    return fit
+
+
+def _check_admission(plan):
+    """Refuse encodes predicted to cost more than MAX_JOB_CPU_SECONDS."""
+    if plan["cost"] > MAX_JOB_CPU_SECONDS:
+        raise Exception(
+            f"This encode is predicted to need ~{plan['cost'] / 60:.0f} CPU-minutes; "
+            f"the limit is {MAX_JOB_CPU_SECONDS / 60:.0f}. Trim the clip, pick a lower "
+            "resolution, or use Prioritize Speed."
+        )
+
+
 class CompressionCancelled(Exception):
     """Raised when a running encode is terminated by VideoCompressor.cancel()."""
 
 
 class VideoCompressor:
-    def __init__(self, output_dir=OUTPUT_DIR):
+    def __init__(self, output_dir=OUTPUT_DIR, cache_max_bytes=RESULT_CACHE_MAX_BYTES, max_concurrent_jobs=None, progress_interval=PROGRESS_INTERVAL_SECONDS, cpus=None):
         for tool in ("ffmpeg", "ffprobe"):
             if shutil.which(tool) is None:
                 raise RuntimeError(
@@ -112,19 +837,66 @@ class VideoCompressor:
                     "Install ffmpeg (the Dockerfile does this in production)."
                 )
         self.output_dir = output_dir
+        self.progress_interval = progress_interval
+        # Phase timings and child-process usage per job, aggregated for the
+        # app's /metrics route.
+        self.metrics = MetricsRegistry()
+        self._job_metrics = {}
+        # cache_max_bytes=0 disables result caching (bench.py does this so
+        # repeated runs actually measure the encoder).
+        self.result_cache = None
+        if cache_max_bytes:
+            self.result_cache = ResultCache(
+                os.path.join(output_dir, RESULT_CACHE_DIRNAME),
+                max_bytes=cache_max_bytes,
+                ttl_seconds=OUTPUT_TTL_SECONDS,
+            )
         # Per-job subprocess tracking so cancel() can free CPU mid-encode.
-        # Keyed by the job_id passed into compress(). Guarded by _lock for
-        # safety against concurrent requests on the shared HF Space.
+        # Keyed by the job_id passed into compress(); each value is the set of
+        # live ffmpeg processes for that job (several in segmented mode).
+        # Guarded by _lock for safety against concurrent requests on the
+        # shared HF Space.
         self._active = {}
         self._cancelled = set()
+        # job_id -> output path pass 2 is writing, for live_output().
+        self._live_outputs = {}
         self._lock = threading.Lock()
+        # Packet indexes are started by the app on upload and consulted here
+        # for trim bitrate and keyframes when they're ready in time.
+        self.packet_indexes = PacketIndexStore(os.path.join(output_dir, PACKET_INDEX_DIRNAME))
+        # CPUs we may really use (affinity mask and cgroup quota, not the
+        # host's core count), shared out between running jobs per ffmpeg run.
+        # Pass cpus to carve out a smaller budget (batch.py's workers do).
+        self.cpu_budget = CpuBudget(cpus)
+        # Encode slots. By default one job per MIN_JOB_THREADS CPUs; the rest
+        # queue rather than time-slice the same CPUs.
+        if max_concurrent_jobs is None:
+            max_concurrent_jobs = max(1, self.cpu_budget.cpus // MIN_JOB_THREADS)
+        self.scheduler = JobScheduler(max_concurrent_jobs)
+        # Measured per-preset throughput, for picking a preset by deadline,
+        # and the CPU-seconds model used for admission, queueing and ETAs.
+        self.preset_throughput = PresetThroughput()
+        self.cost_model = EncodeCostModel(os.path.join(output_dir, COST_HISTORY_FILENAME))
+        # Output cleanup runs off the request path. compress() pins its job
+        # directory so the janitor never removes a running job's files.
+        extra_prune = [self._prune_packet_indexes]
+        if self.result_cache:
+            extra_prune.append(self.result_cache.prune)
+        self.janitor = OutputJanitor(
+            output_dir,
+            ttl_seconds=OUTPUT_TTL_SECONDS,
+            max_bytes=OUTPUT_MAX_BYTES,
+            interval_seconds=JANITOR_INTERVAL_SECONDS,
+            extra_prune=extra_prune,
+        )
+        self.janitor.start()
 
-    def _prune_old_outputs(self):
+    def _prune_packet_indexes(self):
         cutoff = time.time() - OUTPUT_TTL_SECONDS
         try:
-            for entry in os.scandir(self.output_dir):
-                if entry.is_dir() and entry.stat().st_mtime < cutoff:
-                    shutil.rmtree(entry.path, ignore_errors=True)
+            for entry in os.scandir(self.packet_indexes.index_dir):
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
         except OSError:
             pass
 
@@ -134,31 +906,465 @@ class VideoCompressor:
             return
         with self._lock:
             self._cancelled.add(job_id)
-            proc = self._active.get(job_id)
-        if proc and proc.poll() is None:
-            proc.terminate()
+        self.scheduler.wake()
+        self._terminate_processes(job_id)
+
+    def _is_cancelled(self, job_id):
+        with self._lock:
+            return job_id in self._cancelled
+
+    def _terminate_processes(self, job_id):
+        with self._lock:
+            procs = list(self._active.get(job_id, ()))
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
             try:
                 proc.wait(timeout=2)
             except subprocess.TimeoutExpired:
                 proc.kill()
 
-    def compress(self, job_id, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback):
-        self._prune_old_outputs()
+    @contextmanager
+    def _job(self, job_id, pins=(), client_id=None):
+        """Bookkeeping around one compress()/compress_many()/preview() call
+        (and AsyncVideoCompressor.compress()).
 
-        if not job_id:
-            job_id = uuid.uuid4().hex[:12]
+        Pins job_id's directory (and any extra pins) against the janitor and
+        opens the job's metrics under every pinned name, so work done in a
+        per-size directory is timed as part of the job. On the way out it
+        records how the job ended, forgets its cancel flag, processes and
+        live output, and releases the pins.
 
+        Yields slot(cost, progress_callback): a context manager that queues
+        for an encode slot under client_id (reporting the queue position),
+        then holds the job's CPU share while the encode runs.
+        """
+        names = (job_id, *pins)
+        for name in names:
+            self.janitor.pin(name)
+        job_metrics = self.metrics.start_job(job_id)
+        with self._lock:
+            for name in names:
+                self._job_metrics[name] = job_metrics
+        status = "error"
         try:
-            return self._compress_inner(
-                job_id, input_path, target_mb, remove_audio,
-                start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback,
-            )
+            yield partial(self._slot, job_id, client_id)
+            status = "ok"
+        except (CompressionCancelled, asyncio.CancelledError):
+            status = "cancelled"
+            raise
         finally:
             with self._lock:
                 self._cancelled.discard(job_id)
                 self._active.pop(job_id, None)
+                self._live_outputs.pop(job_id, None)
+                for name in names:
+                    self._job_metrics.pop(name, None)
+            self.metrics.finish_job(job_metrics, status)
+            for name in names:
+                self.janitor.unpin(name)
+
+    @contextmanager
+    def _slot(self, job_id, client_id, cost, progress_callback):
+        """See _job. Everything before this is cheap probing; the encode
+        itself waits here so concurrent jobs don't oversubscribe the CPU."""
+        def report_position(position):
+            progress_callback(0, desc=f"Queued (position {position})...")
+
+        with self.scheduler.slot(
+            client_id or job_id, cost,
+            on_position=report_position,
+            should_abort=lambda: self._is_cancelled(job_id),
+        ) as waited:
+            if waited is None:
+                raise CompressionCancelled("Compression cancelled.")
+            with self._lock:
+                job_metrics = self._job_metrics.get(job_id)
+            if job_metrics:
+                job_metrics.queue_wait = round(waited, 3)
+            with self.cpu_budget.job(job_id):
+                yield
 
-    def _compress_inner(self, job_id, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback):
+    def _run_parallel(self, job_id, fn, items, max_workers=None):
+        """fn(item) for every item on a thread pool; results in items' order.
+
+        If one call fails (or the job is cancelled), the calls not yet
+        started are dropped and job_id's ffmpeg processes terminated before
+        the error propagates, instead of letting the others burn CPU on an
+        output that will be discarded.
+        """
+        items = list(items)
+        executor = ThreadPoolExecutor(max_workers=max_workers or len(items))
+        try:
+            futures = [executor.submit(fn, item) for item in items]
+            return [future.result() for future in futures]
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._terminate_processes(job_id)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
+    def compress(self, job_id, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback, segmented=None, client_id=None, decode_once=None, deadline_seconds=None, encoder=None, predictive=False):
+        """Encode input_path to fit target_mb and return the output path.
+
+        segmented=None picks segmented mode automatically for long sources on
+        machines with spare cores; True/False forces it on or off.
+
+        decode_once=None benchmarks decode+filter cost and decodes the source
+        once into a shared intermediate when it's expensive; True/False
+        forces it. Ignored in segmented mode, where each chunk decodes only
+        its own range.
+
+        client_id groups jobs for scheduler fairness (the app passes the
+        Gradio session); None treats the job as its own client.
+
+        deadline_seconds, when given, overrides speed_mode's fixed preset:
+        the slowest x264 preset predicted to finish (queue wait included)
+        within that many seconds is used instead (libx264 only).
+
+        encoder picks the video backend from ENCODER_BACKENDS; None means
+        DEFAULT_ENCODER.
+
+        predictive=True replaces pass 1 with CRF probes on sampled windows
+        and encodes in one capped-CRF pass (see PREDICTIVE_WINDOWS). It turns
+        segmented and decode-once mode off, and is ignored on clips shorter
+        than PREDICTIVE_MIN_DURATION.
+        """
+        if not job_id:
+            job_id = uuid.uuid4().hex[:12]
+
+        with self._job(job_id, client_id=client_id) as slot:
+            return self._compress_inner(
+                job_id, slot, input_path, target_mb, remove_audio,
+                start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback,
+                segmented, decode_once, deadline_seconds, encoder, predictive,
+            )
+
+    def compress_many(self, job_id, input_path, target_mbs, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback, client_id=None, deadline_seconds=None, encoder=None):
+        """Encode input_path at every size in target_mbs in one job and
+        return the output paths, in target_mbs order.
+
+        Each size is planned as compress() would plan it (resolution, fps
+        cap, preset, stream-copy and cache shortcuts). The sizes that need an
+        encode then share one decode per pass (see _multi_target_commands)
+        and one scheduler slot, instead of running N full pipelines.
+        Segmented, decode-once and predictive modes don't apply.
+        """
+        if not job_id:
+            job_id = uuid.uuid4().hex[:12]
+        if not target_mbs:
+            raise Exception("No target sizes given.")
+
+        # One working directory per size (outputs and pass logs would
+        # collide in one), all pinned and timed under this job.
+        target_ids = [f"{job_id}-{index}" for index in range(len(target_mbs))]
+        with self._job(job_id, pins=target_ids, client_id=client_id) as slot:
+            return self._compress_many_inner(
+                job_id, slot, target_ids, input_path, target_mbs, remove_audio, start_time, end_time,
+                speed_mode, output_resolution, fps_mode, progress_callback, deadline_seconds, encoder,
+            )
+
+    def _compress_many_inner(self, job_id, slot, target_ids, input_path, target_mbs, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback, deadline_seconds, encoder):
+        output_paths = [None] * len(target_mbs)
+        pending = []  # (index, plan) still to encode
+        for index, (target_id, target_mb) in enumerate(zip(target_ids, target_mbs)):
+            plan = self._prepare(
+                target_id, input_path, target_mb, remove_audio, start_time, end_time,
+                speed_mode, output_resolution, fps_mode, progress_callback, False, False,
+                deadline_seconds, encoder,
+            )
+            if isinstance(plan, str):
+                output_paths[index] = plan
+                continue
+            if plan["remux_cmd"]:
+                with self._span(job_id, "stream_copy"):
+                    self._run_ffmpeg_with_progress(
+                        job_id, plan["remux_cmd"], progress_callback, plan["remux_duration"],
+                        progress_start=0.0, progress_end=0.0,
+                        description=f"Remuxing {target_mb:g} MB (no re-encode)..."
+                    )
+                if _remux_fits(plan["output_path"], plan["target_bytes"]):
+                    output_paths[index] = plan["output_path"]
+                    continue
+            _check_admission(plan)
+            pending.append((index, plan))
+
+        if not pending:
+            return output_paths
+        plans = [plan for _, plan in pending]
+        with slot(sum(plan["cost"] for plan in plans), progress_callback):
+            self._encode_many(job_id, plans, progress_callback)
+
+        for index, plan in pending:
+            output_paths[index] = plan["output_path"]
+            if plan["cache_key"]:
+                self.result_cache.put(plan["cache_key"], plan["output_path"])
+        return output_paths
+
+    def _encode_many(self, job_id, plans, progress_callback):
+        """Run compress_many's shared-decode passes, then rerun pass 2 alone
+        (from its own stats) for any size that finished over target.
+
+        No cost-model samples: a pass's CPU covers one decode and several
+        encodes, which would teach the model the wrong per-frame price.
+        """
+        backend = ENCODER_BACKENDS[plans[0]["encoder"]]
+        duration = plans[0]["duration"]
+        threads = self.cpu_budget.threads_for(job_id)
+        cmd_pass1, cmd_pass2 = _multi_target_commands(plans, threads)
+        pass1_end = 0.25 if cmd_pass1 else 0.0
+        if cmd_pass1:
+            with self._span(job_id, "pass1"):
+                self._run_ffmpeg_with_progress(
+                    job_id, cmd_pass1, progress_callback, duration,
+                    progress_start=0.0, progress_end=pass1_end,
+                    description=f"Analyzing metadata ({len(plans)} sizes)..."
+                )
+            threads = self.cpu_budget.threads_for(job_id)
+            _, cmd_pass2 = _multi_target_commands(plans, threads)
+        with self._span(job_id, "pass2"):
+            stats = self._run_ffmpeg_with_progress(
+                job_id, cmd_pass2, progress_callback, duration,
+                progress_start=pass1_end, progress_end=1.0,
+                description=f"Compressing {len(plans)} sizes..."
+            )
+        self._record_speed(job_id, stats)
+
+        for plan in plans:
+            audio_bytes = plan["audio_bitrate"] * plan["duration"] / 8
+            video_bitrate = plan["video_bitrate"]
+            for _ in range(SIZE_CORRECTION_ATTEMPTS):
+                actual = os.path.getsize(plan["output_path"])
+                if actual <= plan["target_bytes"]:
+                    break
+                video_bitrate = _corrected_bitrate(video_bitrate, plan["target_bytes"], actual, audio_bytes)
+                print(
+                    f"Size correction: {actual / 1e6:.2f} MB vs {plan['target_bytes'] / 1e6:.2f} MB target; "
+                    f"rerunning that size's pass 2 at {video_bitrate / 1000:.0f} kbps"
+                )
+                _, cmd, _ = _two_pass_commands(
+                    dict(plan, video_bitrate=video_bitrate), self.cpu_budget.threads_for(job_id),
+                )
+                with self._span(job_id, "size_correction"):
+                    self._run_ffmpeg_with_progress(
+                        job_id, cmd, progress_callback, plan["duration"],
+                        progress_start=1.0, progress_end=1.0,
+                        description="Compressing (size-corrected)..."
+                    )
+        with self._span(job_id, "cleanup"):
+            for plan in plans:
+                self._cleanup_logs(os.path.join(plan["job_dir"], "ffmpeg2pass"), backend)
+
+    def preview(self, job_id, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback, client_id=None, deadline_seconds=None, encoder=None):
+        """Encode a few short windows with exactly the plan compress() would
+        use (bitrate, preset, resolution, fps cap) and return them.
+
+        Windows are picked from the keyframe index and encoded in parallel.
+        Returns {"windows": [...], "note": ...}. Each window is a {"start",
+        "end", "path", "size_bytes", "video_kbps", "ssim"} dict; ssim
+        compares the window, scaled back up, with the source. No windows
+        means compress() wouldn't re-encode at all, and "note" says why (the
+        source already fits, the result is cached, or the streams would be
+        copied as they are).
+        """
+        if not job_id:
+            job_id = uuid.uuid4().hex[:12]
+
+        with self._job(job_id, client_id=client_id) as slot:
+            plan = self._prepare(
+                job_id, input_path, target_mb, remove_audio, start_time, end_time,
+                speed_mode, output_resolution, fps_mode, progress_callback, False, False,
+                deadline_seconds, encoder,
+            )
+            if isinstance(plan, str):
+                return {"windows": [], "note": "No encode needed — Compress will return this right away."}
+            if plan["remux_cmd"]:
+                # compress() tries the stream copy first and only re-encodes
+                # if it overshoots; encoding windows here would show quality
+                # the real job (almost always) won't produce.
+                return {
+                    "windows": [],
+                    "note": "Will be remuxed (stream copy, no re-encode) — no quality loss, unless the copy misses the target.",
+                }
+            keyframes = plan["keyframes"]
+            if keyframes is None:
+                progress_callback(0, desc="Finding keyframes...")
+                keyframes = get_keyframe_times(input_path)
+            windows = pick_preview_windows(
+                keyframes, plan["start"], plan["end"], PREVIEW_WINDOWS, PREVIEW_WINDOW_SECONDS,
+            )
+            sampled = sum(end - start for start, end in windows)
+            with slot(plan["cost"] * sampled / plan["duration"], progress_callback), self._span(job_id, "preview"):
+                results = self._encode_preview_windows(job_id, plan, windows, progress_callback)
+            return {"windows": results, "note": None}
+
+    def _encode_preview_windows(self, job_id, plan, windows, progress_callback):
+        """Two-pass encode each preview window in parallel and measure SSIM."""
+        input_path = plan["input_path"]
+        backend = ENCODER_BACKENDS[plan["encoder"]]
+        threads = max(1, self.cpu_budget.threads_for(job_id) // len(windows))
+        durations = [end - start for start, end in windows]
+        tracker = _SegmentProgress(
+            progress_callback, durations, span=1.0,
+            description=f"Encoding {len(windows)} preview windows...",
+            interval=self.progress_interval,
+        )
+
+        def encode_window(index):
+            start, end = windows[index]
+            window_path = os.path.join(plan["job_dir"], f"preview_{index}.mp4")
+            log_prefix = os.path.join(plan["job_dir"], f"preview_{index}_2pass")
+            input_args = ["ffmpeg", "-ss", str(start), "-t", str(end - start), "-i", input_path]
+            common_args = ["-y", *plan["scale_args"]]
+            report = tracker.for_chunk(index)
+            pass2_start = 0.0
+            if backend.passes == (1, 2):
+                pass2_start = 0.25
+                self._run_ffmpeg_with_progress(
+                    job_id,
+                    [*input_args, *common_args,
+                     *backend.args(plan["preset"], plan["video_bitrate"], threads, 1, log_prefix),
+                     "-an", "-f", "mp4", os.devnull],
+                    report, durations[index], progress_start=0.0, progress_end=0.25, description=None,
+                )
+            self._run_ffmpeg_with_progress(
+                job_id,
+                [*input_args, *common_args,
+                 *backend.args(plan["preset"], plan["video_bitrate"], threads, backend.passes[-1], log_prefix),
+                 "-an", window_path],
+                report, durations[index], progress_start=pass2_start, progress_end=1.0, description=None,
+            )
+            self._cleanup_logs(log_prefix, backend)
+            size_bytes = os.path.getsize(window_path)
+            return {
+                "start": start,
+                "end": end,
+                "path": window_path,
+                "size_bytes": size_bytes,
+                "video_kbps": round(size_bytes * 8 / max(end - start, 1e-6) / 1000),
+                "ssim": self._measure_ssim(job_id, input_path, start, end - start, window_path, threads),
+            }
+
+        return self._run_parallel(job_id, encode_window, range(len(windows)))
+
+    def _measure_ssim(self, job_id, input_path, start, duration, encoded_path, threads):
+        """SSIM of encoded_path against the same window of the source, or None.
+
+        The encode is scaled back up to source size first (scale2ref), so the
+        score includes what a downscale costs, not just the encoder's loss.
+        Runs as one of job_id's processes (Cancel reaches it) within its
+        share of threads.
+        """
+        decode_threads = ["-threads", str(split_threads(threads)["decode_threads"])]
+        cmd = [
+            "ffmpeg",
+            "-filter_threads", str(threads),
+            *decode_threads, "-i", encoded_path,
+            *decode_threads, "-ss", str(start), "-t", str(duration), "-i", input_path,
+            "-lavfi", "[0:v][1:v]scale2ref=flags=bicubic[enc][ref];[enc][ref]ssim",
+            "-f", "null", "-",
+        ]
+        try:
+            stats = self._run_ffmpeg_with_progress(
+                job_id, cmd, lambda *args, **kwargs: None, duration,
+                progress_start=1.0, progress_end=1.0, description=None, capture_stderr=True,
+            )
+        except CompressionCancelled:
+            raise
+        except Exception:
+            return None
+        match = re.search(r"All:(\d+\.\d+)", "\n".join(stats["stderr"]))
+        return float(match.group(1)) if match else None
+
+    def live_output(self, job_id):
+        """(path, ready_bytes) of the output job_id's pass 2 is still writing,
+        or None. ready_bytes covers the init segment and every complete
+        fragment, so that prefix is playable as-is."""
+        with self._lock:
+            path = self._live_outputs.get(job_id)
+        if path is None:
+            return None
+        return path, fragmented_mp4_ready_bytes(path)
+
+    def resolve_preset(self, speed_mode, deadline_seconds, out_pixels, mpx_frames, encoder=None):
+        """Encoder preset for a job: speed_mode's fixed one, or (libx264
+        only) with a deadline the slowest one predicted to finish in time."""
+        backend = _encoder_backend(encoder)
+        if not deadline_seconds or backend.name != "libx264":
+            return backend.speed_presets.get(speed_mode, backend.speed_presets["Prioritize Quality"])
+        # Queue wait is predicted as if this job ran at the Speed preset; the
+        # jobs ahead are already priced in CPU-seconds.
+        queue_seconds = self.queue_seconds(
+            self.cost_model.predict(SPEED_MODE_PRESETS["Prioritize Speed"], mpx_frames),
+        )
+        return self.preset_throughput.pick_preset(
+            out_pixels, mpx_frames, float(deadline_seconds), queue_seconds,
+            threads=self.cpu_budget.threads_for_new_job(),
+        )
+
+    def queue_seconds(self, cost):
+        """Predicted wait before a job of this CPU-second cost gets a slot."""
+        threads_per_slot = max(1.0, self.cpu_budget.cpus / self.scheduler.slots)
+        return self.scheduler.work_ahead(cost) / threads_per_slot
+
+    def estimate_seconds(self, preset, mpx_frames, encoder=None):
+        """Predicted (cpu_seconds, eta_seconds) for an encode submitted now."""
+        backend = _encoder_backend(encoder)
+        cpu_seconds = self.cost_model.predict(backend.cost_key(preset), mpx_frames, backend.passes)
+        return cpu_seconds, self.queue_seconds(cpu_seconds) + cpu_seconds / self.cpu_budget.threads_for_new_job()
+
+    def metrics_gauges(self):
+        """Live scheduler gauges for MetricsRegistry.render_prometheus/snapshot."""
+        running, queued = self.scheduler.stats()
+        return {
+            "running_encodes": running, "queued_encodes": queued,
+            "encode_slots": self.scheduler.slots, "cpu_budget": self.cpu_budget.cpus,
+        }
+
+    def _span(self, job_id, phase):
+        """Time a phase of job_id's work (no-op outside compress())."""
+        with self._lock:
+            job_metrics = self._job_metrics.get(job_id)
+        return job_metrics.span(phase) if job_metrics else nullcontext()
+
+    def _compress_inner(self, job_id, slot, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback, segmented, decode_once, deadline_seconds, encoder, predictive):
+        plan = self._prepare(
+            job_id, input_path, target_mb, remove_audio, start_time, end_time,
+            speed_mode, output_resolution, fps_mode, progress_callback, segmented, decode_once,
+            deadline_seconds, encoder, predictive,
+        )
+        if isinstance(plan, str):
+            return plan
+        output_path = plan["output_path"]
+
+        if plan["remux_cmd"]:
+            with self._span(job_id, "stream_copy"):
+                self._run_ffmpeg_with_progress(
+                    job_id, plan["remux_cmd"], progress_callback, plan["remux_duration"],
+                    progress_start=0.0, progress_end=1.0,
+                    description="Remuxing (no re-encode)..."
+                )
+            if _remux_fits(output_path, plan["target_bytes"]):
+                return output_path
+
+        _check_admission(plan)
+        with slot(plan["cost"], progress_callback):
+            self._encode(job_id, plan, progress_callback)
+
+        if plan["cache_key"]:
+            self.result_cache.put(plan["cache_key"], output_path)
+        return output_path
+
+    def _prepare(self, job_id, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback, segmented, decode_once, deadline_seconds=None, encoder=None, predictive=False):
+        """Probe the source and resolve every encode decision into a plan dict.
+
+        Returns a path string instead when no encode is needed at all (the
+        source already fits, or the result cache has it). Runs ffprobe but
+        never ffmpeg; the plan's remux_cmd / two-pass settings are executed
+        by the caller (VideoCompressor, or AsyncVideoCompressor on its loop).
+        """
         try:
             input_size = os.path.getsize(input_path)
         except OSError as e:
@@ -169,15 +1375,11 @@ class VideoCompressor:
                 f"Upload is {size_mb:.0f} MB; the limit is {MAX_INPUT_MB} MB. "
                 "Trim or downscale the source locally first."
             )
-
-        preset_map = {
-            "Prioritize Speed": "superfast",
-            "Prioritize Quality": "medium"
-        }
-        ffmpeg_preset = preset_map.get(speed_mode, "medium")
+        backend = _encoder_backend(encoder)
 
         progress_callback(0, desc="Analyzing Metadata...")
-        meta = get_video_metadata(input_path)
+        with self._span(job_id, "probe"):
+            meta = get_video_metadata(input_path)
         if not meta:
             raise Exception("Could not read video metadata.")
 
@@ -197,15 +1399,20 @@ class VideoCompressor:
             print("File is already below target size. Skipping encoding.")
             return input_path
 
-        # Per-request working directory keeps output, two-pass logs, and the trim
-        # probe file isolated from concurrent jobs sharing the same Space.
+        # Per-request working directory keeps output and two-pass logs isolated
+        # from concurrent jobs sharing the same Space.
         job_dir = os.path.join(self.output_dir, job_id)
         os.makedirs(job_dir, exist_ok=True)
 
+        packet_index = self.packet_indexes.get(input_path)
         source_bitrate_cap = meta["bitrate"]
         if is_trimmed:
             progress_callback(0, desc="Analyzing trimmed section...")
-            trim_bitrate = get_trim_bitrate(input_path, s_time, e_time, job_dir)
+            with self._span(job_id, "trim_probe"):
+                if packet_index:
+                    trim_bitrate = packet_index.trim_bitrate(s_time, e_time)
+                else:
+                    trim_bitrate = get_trim_bitrate(input_path, s_time, e_time)
             if trim_bitrate:
                 source_bitrate_cap = trim_bitrate
                 print(f"Trim detected. Using local bitrate cap: {int(trim_bitrate/1024)}k (Global was {int(meta['bitrate']/1024)}k)")
@@ -223,6 +1430,9 @@ class VideoCompressor:
 
         if remove_audio or not meta["has_audio"]:
             audio_args = ["-an"]
+        elif _can_copy_audio(meta, audio_bitrate):
+            # Re-encoding AAC to the same or a higher bitrate only loses quality.
+            audio_args = ["-c:a", "copy"]
         else:
             audio_args = ["-c:a", "aac", "-b:a", str(int(audio_bitrate))]
 
@@ -244,80 +1454,615 @@ class VideoCompressor:
             output_resolution, source_height, source_width, effective_fps, video_bitrate,
         )
 
-        vf_parts = []
-        if target_height and target_height < source_height:
-            vf_parts.append(f"scale=-2:{target_height}")
-        if target_fps:
-            vf_parts.append(f"fps={target_fps}")
-        scale_args = ["-vf", ",".join(vf_parts)] if vf_parts else []
+        # fps before scale, scaler picked by ratio; see filter_plan.py.
+        filters = plan_filters(source_width, source_height, source_fps, target_height, target_fps)
+        scale_args = filters["args"]
+        if filters["stages"]:
+            print("Filter plan: " + ", ".join(
+                f"{stage['filter']} ({stage['mpx_per_second']} Mpx/s)" for stage in filters["stages"]
+            ))
 
         base_name = os.path.splitext(os.path.basename(input_path))[0]
         output_path = os.path.join(job_dir, f"{base_name}_compressed.mp4")
 
         trim_args = ["-ss", str(s_time), "-to", str(e_time)] if is_trimmed else []
-        v_bitrate_str = str(int(video_bitrate))
 
-        # -threads matches the HF Spaces Free tier vCPU count; libx264's auto-detect
-        # can over-subscribe on shared infra and slow encoding down.
-        # NOTE: two-pass *requires* the same -preset on both passes. A pass-1
-        # preset that strips features (e.g. ultrafast disables mbtree/cabac)
-        # produces a stats file that pass 2 refuses to consume ("Could not open
-        # encoder before EOF" / EINVAL). libx264 already optimizes pass 1
-        # internally via --slow-firstpass=0 (the default), so don't try to
-        # speed it up further by overriding the preset.
-        common_args = [
-            "-y",
+        with self._span(job_id, "stream_copy_plan"):
+            remux_cmd, remux_duration = self._plan_remux(
+                meta, input_path, output_path, s_time, e_time, is_trimmed,
+                packet_index, remove_audio, audio_bitrate, output_resolution, fps_mode,
+                target_bytes_strict, progress_callback, backend.codec_name,
+            )
+
+        if predictive and target_duration < PREDICTIVE_MIN_DURATION:
+            print(f"Clip is under {PREDICTIVE_MIN_DURATION}s; encoding two-pass instead of predictive single-pass.")
+            predictive = False
+        if predictive:
+            # One pass over the source: nothing for decode-once to share, and
+            # chunks too short to probe.
+            segmented, decode_once = False, False
+
+        cpu_count = self.cpu_budget.cpus
+        if segmented is None:
+            segmented = target_duration >= SEGMENT_MIN_DURATION and cpu_count >= SEGMENT_MIN_CPUS
+
+        out_height = target_height or source_height
+        out_width = out_height * source_width / source_height if source_height else 0
+        out_pixels = out_width * out_height
+        mpx_frames = target_duration * (effective_fps or 30) * out_pixels / 1e6
+
+        ffmpeg_preset = self.resolve_preset(speed_mode, deadline_seconds, out_pixels, mpx_frames, backend.name)
+        if deadline_seconds and backend.name == "libx264":
+            print(f"Deadline {float(deadline_seconds):.0f}s: using preset {ffmpeg_preset}")
+
+        # Predicted CPU-seconds; the scheduler runs cheaper jobs first and
+        # admission refuses the outrageous ones.
+        if predictive:
+            # Probes cost what single-pass encoding the sampled seconds would.
+            probed = len(backend.probe_crfs) * PREDICTIVE_WINDOWS * PREDICTIVE_WINDOW_SECONDS
+            cost = self.cost_model.predict(
+                backend.cost_key(ffmpeg_preset), mpx_frames * (1 + probed / target_duration), (0,),
+            )
+        else:
+            cost = self.cost_model.predict(backend.cost_key(ffmpeg_preset), mpx_frames, backend.passes)
+
+        # Remuxes are seconds of work; not worth hashing the input to cache.
+        cache_key = None
+        if self.result_cache and not remux_cmd:
+            progress_callback(0, desc="Checking cache...")
+            with self._span(job_id, "cache_lookup"):
+                content_hash = hash_file(input_path)
+            cache_key = make_cache_key(
+                content_hash,
+                target_mb=target_mb,
+                trim=[round(s_time, 3), round(e_time, 3)] if is_trimmed else None,
+                preset=ffmpeg_preset,
+                encoder=backend.name,
+                height=target_height,
+                fps=target_fps,
+                remove_audio=bool(remove_audio),
+                segmented=bool(segmented),
+                predictive=bool(predictive),
+            )
+            cached_path = self.result_cache.get(cache_key)
+            if cached_path:
+                print("Result cache hit. Skipping encoding.")
+                link_or_copy(cached_path, output_path)
+                return output_path
+
+        return {
+            "input_path": input_path,
+            "job_dir": job_dir,
+            "output_path": output_path,
+            "start": s_time,
+            "end": e_time,
+            "duration": target_duration,
+            "trim_args": trim_args,
+            "scale_args": scale_args,
+            "filter_stages": filters["stages"],
+            "preset": ffmpeg_preset,
+            "encoder": backend.name,
+            "video_bitrate": video_bitrate,
+            "audio_bitrate": 0 if audio_args == ["-an"] else audio_bitrate,
+            "audio_args": audio_args,
+            "segmented": segmented,
+            "keyframes": packet_index.keyframes.tolist() if packet_index else None,
+            "decode_once": decode_once,
+            "predictive": bool(predictive),
+            "out_pixels": out_pixels,
+            "out_fps": effective_fps or 30,
+            "mpx_frames": mpx_frames,
+            "cost": cost,
+            "target_bytes": target_bytes_strict,
+            "remux_cmd": remux_cmd,
+            "remux_duration": remux_duration,
+            "cache_key": cache_key,
+        }
+
+    def _plan_remux(self, meta, input_path, output_path, s_time, e_time, is_trimmed, packet_index, remove_audio, audio_bitrate, output_resolution, fps_mode, target_bytes, progress_callback, video_codec="h264"):
+        """Build a remux command when a stream-copy route fits the target.
+
+        Returns (cmd, duration) or (None, None). Trims are widened to start
+        on the keyframe at or before s_time, since a video stream copy can
+        only begin there. An explicit resolution or fps cap rules out
+        copying the video; Auto settings don't, since a copy that already
+        fits has no reason to downscale. Only video already in the requested
+        encoder's codec (video_codec) is copied.
+        """
+        if meta.get("video_codec") != video_codec or video_codec not in _COPYABLE_VIDEO_CODECS:
+            return None, None
+        source_height = meta.get("height") or 0
+        if output_resolution in _RESOLUTION_HEIGHTS and _RESOLUTION_HEIGHTS[output_resolution] < source_height:
+            return None, None
+        if fps_mode == "On" and (meta.get("fps") or 0) > _FPS_CAP:
+            return None, None
+
+        copy_start = s_time
+        if is_trimmed and s_time > 0:
+            if packet_index:
+                keyframe = packet_index.keyframe_at_or_before(s_time)
+            else:
+                keyframe = max((k for k in get_keyframe_times(input_path) if k <= s_time), default=None)
+            if keyframe is None:
+                return None, None
+            copy_start = keyframe
+        copy_duration = e_time - copy_start
+
+        # Skip the packet scan when the range is obviously far too big.
+        budget = target_bytes * REMUX_SIZE_MARGIN
+        if meta["size_bytes"] * copy_duration / meta["duration"] > 2 * budget:
+            return None, None
+
+        if packet_index:
+            stream_bytes = packet_index.range_bytes(copy_start, e_time)
+        else:
+            progress_callback(0, desc="Checking for a fast path...")
+            stream_bytes = get_trim_stream_bytes(input_path, copy_start, e_time)
+        if not stream_bytes:
+            return None, None
+
+        keep_audio = meta["has_audio"] and not remove_audio
+        route = _plan_stream_copy(
+            stream_bytes, budget, keep_audio, meta.get("audio_codec"),
+            planned_audio_bytes=audio_bitrate * copy_duration / 8,
+        )
+        if route is None:
+            return None, None
+
+        audio_args = {
+            "copy_all": ["-map", "0:a:0", "-c:a", "copy"],
+            "copy_video": ["-an"],
+            "copy_video_encode_audio": ["-map", "0:a:0", "-c:a", "aac", "-b:a", str(int(audio_bitrate))],
+        }[route]
+        trim_args = ["-ss", str(copy_start), "-to", str(e_time)] if is_trimmed else []
+        cmd = [
+            "ffmpeg", "-y",
             *trim_args,
-            *scale_args,
-            "-c:v", "libx264",
-            "-preset", ffmpeg_preset,
-            "-threads", "2",
-            "-b:v", v_bitrate_str,
-            "-maxrate", str(int(video_bitrate * 1.5)),
-            "-bufsize", str(int(video_bitrate * 2)),
+            "-i", input_path,
+            "-map", "0:v:0",
+            "-c:v", "copy",
+            *audio_args,
+            "-avoid_negative_ts", "make_zero",
+            output_path
         ]
+        print(f"Stream-copy fast path: {route}")
+        return cmd, copy_duration
 
-        # Both Speed and Quality run two-pass; only the preset differs.
-        # Bench data (see bench.py) showed -tune fastdecode is a free quality
-        # loss across every metric and every content type (animation, gameplay,
-        # natural), and that single-pass at low target sizes gives up
-        # noticeable quality on varied content (e.g. ~+2 VMAF on animation
-        # when we switch to two-pass at the same superfast preset).
-        pass_log_prefix = os.path.join(job_dir, "ffmpeg2pass")
-        pass_args = ["-passlogfile", pass_log_prefix]
+    def _encode(self, job_id, plan, progress_callback):
+        """Run the encode described by plan (built in _prepare)."""
+        input_path = plan["input_path"]
+        if plan["segmented"]:
+            keyframes = plan["keyframes"]
+            if keyframes is None:
+                progress_callback(0, desc="Finding keyframes...")
+                keyframes = get_keyframe_times(input_path)
+            segments = plan_segments(
+                keyframes, plan["start"], plan["end"],
+                count=self.cpu_budget.threads_for(job_id), min_seconds=SEGMENT_MIN_SECONDS,
+            )
+            if len(segments) > 1:
+                started = time.monotonic()
+                with self._span(job_id, "segments"):
+                    self._compress_segments(job_id, plan, segments, progress_callback)
+                # Per-chunk speeds don't add up to anything meaningful; report
+                # the job's effective speed across the whole pool instead.
+                self._record_speed(job_id, {"speed": plan["duration"] / max(time.monotonic() - started, 1e-6)})
+                return
 
-        cmd_pass1 = [
-            "ffmpeg", "-i", input_path,
-            *common_args,
-            *pass_args,
-            "-pass", "1",
+        decode_once = plan["decode_once"]
+        if decode_once is None:
+            with self._span(job_id, "decode_probe"):
+                decode_once = self._decode_is_expensive(job_id, plan)
+
+        # An AAC re-encode runs in its own process alongside pass 1 (which is
+        # -an and leaves a core idle), so it's off the critical path: pass 2
+        # stream-copies the finished track instead of encoding it.
+        # Predictive mode's probes are -an too, so the same applies there.
+        backend = ENCODER_BACKENDS[plan["encoder"]]
+        video_plan, audio_path, audio_future, audio_pool = plan, None, None, None
+        if plan["audio_args"][:2] == ["-c:a", "aac"] and (backend.passes == (1, 2) or plan["predictive"]):
+            audio_path = os.path.join(plan["job_dir"], "audio.m4a")
+            video_plan = dict(plan, audio_file=audio_path)
+            audio_pool = ThreadPoolExecutor(max_workers=1)
+            audio_future = audio_pool.submit(self._encode_audio, job_id, plan, audio_path)
+
+        progress_base = 0.0
+        intermediate = None
+        try:
+            if plan["predictive"]:
+                with self._span(job_id, "crf_probe"):
+                    fit = self._probe_crf(job_id, plan, backend, progress_callback)
+                progress_base = PREDICTIVE_PROGRESS
+                if fit:
+                    video_plan = dict(video_plan, crf=fit[0], crf_slope=fit[1])
+            if decode_once:
+                with self._span(job_id, "decode_intermediate"):
+                    intermediate = self._decode_intermediate(job_id, plan, progress_callback)
+            if intermediate:
+                progress_base = DECODE_ONCE_PROGRESS
+            self._encode_video(
+                job_id, video_plan, backend, intermediate, progress_base, progress_callback, audio_future,
+            )
+        finally:
+            if audio_future and not audio_future.done():
+                # The video side failed; don't leave the audio encode running.
+                self._terminate_processes(job_id)
+            if audio_pool:
+                audio_pool.shutdown(wait=True)
+            for path in (intermediate, audio_path):
+                if path:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _probe_crf(self, job_id, plan, backend, progress_callback):
+        """Fit the CRF that should land plan's video on its bitrate.
+
+        Encodes PREDICTIVE_WINDOWS short windows at each of the backend's
+        probe_crfs (windows in parallel, CRFs in turn), turns each CRF's
+        total bytes into a bitrate over the sampled seconds and fits the
+        curve (utils.fit_crf_for_bitrate). Returns (crf, slope), or None when
+        the samples don't give a usable fit — the job then encodes two-pass.
+        """
+        keyframes = plan["keyframes"]
+        if keyframes is None:
+            progress_callback(0, desc="Finding keyframes...")
+            keyframes = get_keyframe_times(plan["input_path"])
+        windows = pick_preview_windows(
+            keyframes, plan["start"], plan["end"], PREDICTIVE_WINDOWS, PREDICTIVE_WINDOW_SECONDS,
+        )
+        threads = max(1, self.cpu_budget.threads_for(job_id) // len(windows))
+        probes = _crf_probe_commands(plan, backend, windows, threads)
+        durations = [end - start for start, end in windows]
+        tracker = _SegmentProgress(
+            progress_callback, durations, span=PREDICTIVE_PROGRESS,
+            description=f"Sampling {len(windows)} windows at {len(backend.probe_crfs)} quality levels...",
+            interval=self.progress_interval,
+        )
+
+        def probe_window(index):
+            report = tracker.for_chunk(index)
+            sizes = []
+            for i, (probe_path, cmd) in enumerate(probes[index]):
+                self._run_ffmpeg_with_progress(
+                    job_id, cmd, report, durations[index],
+                    progress_start=i / len(probes[index]), progress_end=(i + 1) / len(probes[index]), description=None,
+                )
+                sizes.append(os.path.getsize(probe_path))
+                os.remove(probe_path)
+            return sizes
+
+        window_sizes = self._run_parallel(job_id, probe_window, range(len(windows)))
+        return _fit_crf_probes(plan, backend, durations, window_sizes)
+
+    def _encode_audio(self, job_id, plan, audio_path):
+        """Encode just the plan's audio track to audio_path (see _encode)."""
+        cmd = [
+            "ffmpeg", "-i", plan["input_path"],
+            "-y",
+            *plan["trim_args"],
+            "-vn",
+            *plan["audio_args"],
+            audio_path
+        ]
+        with self._span(job_id, "audio"):
+            self._run_ffmpeg_with_progress(
+                job_id, cmd, lambda *args, **kwargs: None, plan["duration"],
+                progress_start=0.0, progress_end=0.0, description=None,
+            )
+
+    def _encode_video(self, job_id, plan, backend, intermediate, progress_base, progress_callback, audio_future=None):
+        """Run plan's single-stream passes, recording speed and cost.
+
+        audio_future is the pending audio pre-encode, if any; pass 2 waits
+        for it since it copies the track in.
+        """
+        threads = self.cpu_budget.threads_for(job_id)
+        cmd_pass1, cmd_pass2, pass_log_prefix = _two_pass_commands(plan, threads, intermediate)
+        pass1_end = progress_base + 0.25 * (1.0 - progress_base) if cmd_pass1 else progress_base
+
+        started = time.monotonic()
+        pass1_span = None
+        if cmd_pass1:
+            with self._span(job_id, "pass1") as pass1_span:
+                self._run_ffmpeg_with_progress(
+                    job_id, cmd_pass1, progress_callback, plan["duration"],
+                    progress_start=progress_base, progress_end=pass1_end,
+                    description="Analyzing metadata..."
+                )
+            # Jobs may have started or finished during pass 1; pass 2
+            # runs with the share as of now.
+            threads = self.cpu_budget.threads_for(job_id)
+            _, cmd_pass2, _ = _two_pass_commands(plan, threads, intermediate)
+        if audio_future:
+            audio_future.result()
+        with self._lock:
+            self._live_outputs[job_id] = plan["output_path"]
+
+        # Closed-loop size control (see SIZE_TOLERANCE): watch pass 2's bytes
+        # against the target and rerun it at a corrected bitrate when it's
+        # headed over, or finished over.
+        frame_weights = _x264_frame_weights(pass_log_prefix) if cmd_pass1 and backend.name == "libx264" else None
+        video_bitrate = plan["video_bitrate"]
+        crf = plan.get("crf")
+        for attempt in range(SIZE_CORRECTION_ATTEMPTS + 1):
+            guard = None
+            if attempt < SIZE_CORRECTION_ATTEMPTS:
+                guard = _SizeGuard(plan["target_bytes"], plan["duration"], plan["audio_bitrate"], frame_weights)
+            with self._span(job_id, "pass2") as pass2_span:
+                stats = self._run_ffmpeg_with_progress(
+                    job_id, cmd_pass2, progress_callback, plan["duration"],
+                    progress_start=pass1_end, progress_end=1.0,
+                    description="Compressing..." if attempt == 0 else "Compressing (size-corrected)...",
+                    should_stop=guard,
+                )
+            if stats.get("stopped"):
+                actual = guard.projected
+            else:
+                actual = os.path.getsize(plan["output_path"])
+                if guard is None or actual <= plan["target_bytes"]:
+                    break
+            video_bitrate, crf = _next_pass2_rate(
+                plan, backend, video_bitrate, crf, actual, projected=bool(stats.get("stopped")),
+            )
+            threads = self.cpu_budget.threads_for(job_id)
+            _, cmd_pass2, _ = _two_pass_commands(
+                dict(plan, video_bitrate=video_bitrate, crf=crf), threads, intermediate,
+            )
+        self._record_speed(job_id, stats)
+        # A corrected job's wall time covers extra passes, and a single-pass
+        # one skips pass 1; either would skew the preset's (two-pass)
+        # measured throughput.
+        if backend.name == "libx264" and attempt == 0 and cmd_pass1:
+            self.preset_throughput.record(
+                plan["preset"], plan["out_pixels"], plan["mpx_frames"], time.monotonic() - started, threads,
+            )
+        # Passes over an intermediate skip the source decode, so they'd
+        # teach the cost model the wrong per-frame price.
+        if not intermediate:
+            cost_key = backend.cost_key(plan["preset"])
+            spans = (pass1_span, pass2_span) if cmd_pass1 else (pass2_span,)
+            for pass_number, span in zip(backend.passes if cmd_pass1 else (0,), spans):
+                if span:
+                    self.cost_model.record(cost_key, pass_number, plan["mpx_frames"], span["cpu_s"])
+        with self._span(job_id, "cleanup"):
+            self._cleanup_logs(pass_log_prefix, backend)
+
+    def _record_speed(self, job_id, stats):
+        with self._lock:
+            job_metrics = self._job_metrics.get(job_id)
+        if job_metrics and stats and stats.get("speed"):
+            job_metrics.encode_speed = stats["speed"]
+
+    def _decode_is_expensive(self, job_id, plan):
+        """Time a short decode+filter sample to decide on decode-once mode.
+
+        Returns True when decoding and filtering run slower than
+        1 / DECODE_ONCE_COST_THRESHOLD x realtime — i.e. when doing it twice
+        (once per pass) is a large enough share of the encode that paying for
+        an intermediate is worth it. The sample runs as one of the job's
+        ffmpeg processes, so Cancel reaches it and its CPU time is metered.
+        """
+        if plan["duration"] < DECODE_ONCE_MIN_DURATION:
+            return False
+        sample = min(DECODE_PROBE_SECONDS, plan["duration"])
+        cmd = [
+            "ffmpeg", "-v", "error",
+            "-ss", str(plan["start"]), "-t", str(sample),
+            "-i", plan["input_path"],
+            *plan["scale_args"],
+            "-an", "-f", "null", "-",
+        ]
+        start = time.monotonic()
+        try:
+            self._run_ffmpeg_with_progress(
+                job_id, cmd, lambda *args, **kwargs: None, sample,
+                progress_start=0.0, progress_end=0.0, description=None,
+            )
+        except CompressionCancelled:
+            raise
+        except Exception:
+            return False
+        cost = (time.monotonic() - start) / sample
+        print(f"Decode+filter cost: {cost:.2f}s per source second")
+        return cost > DECODE_ONCE_COST_THRESHOLD
+
+    def _decode_intermediate(self, job_id, plan, progress_callback):
+        """Decode, trim and filter the source once into a lossless spool.
+
+        Returns the spool path, or None when neither tmpfs nor the job
+        directory has room for it (the caller then decodes per pass as
+        usual). The spool is lossless x264 at ultrafast: cheap to write and
+        several times cheaper to decode than HEVC/VP9/4K sources.
+        """
+        estimate = plan["out_pixels"] * plan["out_fps"] * plan["duration"] * DECODE_ONCE_BYTES_PER_PIXEL
+        spool_dir = None
+        for candidate in (DECODE_ONCE_TMPFS, plan["job_dir"]):
+            try:
+                st = os.statvfs(candidate)
+            except (OSError, AttributeError):
+                continue
+            if estimate < st.f_bavail * st.f_frsize * 0.5:
+                spool_dir = candidate
+                break
+        if spool_dir is None:
+            return None
+
+        intermediate = os.path.join(spool_dir, f"{job_id}_intermediate.mkv")
+        cmd = [
+            "ffmpeg", "-i", plan["input_path"],
+            "-y",
+            *plan["trim_args"],
+            *plan["scale_args"],
             "-an",
-            "-f", "mp4", os.devnull
+            "-c:v", "libx264", "-preset", "ultrafast", "-qp", "0",
+            "-threads", str(self.cpu_budget.threads_for(job_id)),
+            intermediate
         ]
-        self._run_ffmpeg_with_progress(
-            job_id, cmd_pass1, progress_callback, target_duration,
-            progress_start=0.0, progress_end=0.25,
-            description="Analyzing metadata..."
+        try:
+            self._run_ffmpeg_with_progress(
+                job_id, cmd, progress_callback, plan["duration"],
+                progress_start=0.0, progress_end=DECODE_ONCE_PROGRESS,
+                description="Decoding source..."
+            )
+        except BaseException:
+            try:
+                os.remove(intermediate)
+            except OSError:
+                pass
+            raise
+        return intermediate
+
+    def _compress_segments(self, job_id, plan, segments, progress_callback):
+        """Two-pass encode each keyframe-aligned chunk in parallel, then concat.
+
+        Every chunk encodes at the plan's video bitrate, so each one spends
+        bitrate * chunk_duration bits — its proportional share of the target.
+        Chunks are video-only; audio is encoded once from the (trimmed) source
+        during the stream-copy concat so there are no AAC priming gaps at the
+        joins. If the chunks together overshoot their budget, only the
+        oversized ones rerun pass 2 at a corrected bitrate before the concat
+        (see _segments_to_correct). The joined file is checked against the
+        target too, since audio and container overhead only show up there:
+        while it's over, the largest chunk reruns pass 2 small enough to
+        absorb the excess and the chunks are joined again.
+        """
+        input_path = plan["input_path"]
+        job_dir = plan["job_dir"]
+        backend = ENCODER_BACKENDS[plan["encoder"]]
+        share = self.cpu_budget.threads_for(job_id)
+        workers = min(len(segments), share)
+        threads = max(1, share // workers)
+        durations = [end - start for start, end in segments]
+        tracker = _SegmentProgress(
+            progress_callback, durations, span=0.95,
+            description=f"Compressing {len(segments)} segments...",
+            interval=self.progress_interval,
         )
 
-        cmd_pass2 = [
-            "ffmpeg", "-i", input_path,
-            *common_args,
-            *pass_args,
-            "-pass", "2",
+        log_prefixes = [os.path.join(job_dir, f"segment_{i:03d}_2pass") for i in range(len(segments))]
+
+        def encode_chunk(index, video_bitrate=None):
+            """Both passes for a chunk, or with video_bitrate just pass 2
+            again (reusing the chunk's pass-1 stats) at that bitrate."""
+            start, end = segments[index]
+            chunk_path = os.path.join(job_dir, f"segment_{index:03d}.mp4")
+            log_prefix = log_prefixes[index]
+            bitrate = video_bitrate or plan["video_bitrate"]
+            # -ss before -i seeks straight to the chunk's keyframe, so no
+            # worker decodes footage that belongs to another chunk.
+            def encoder_args(pass_number):
+                return backend.args(plan["preset"], bitrate, threads, pass_number, log_prefix)
+
+            common_args = ["-y", *plan["scale_args"]]
+            input_args = ["ffmpeg", "-ss", str(start), "-t", str(end - start), "-i", input_path]
+            report = tracker.for_chunk(index) if video_bitrate is None else (lambda *args, **kwargs: None)
+            pass2_start = 0.0
+            if backend.passes == (1, 2):
+                pass2_start = 0.25
+                if video_bitrate is None:
+                    self._run_ffmpeg_with_progress(
+                        job_id, [*input_args, *common_args, *encoder_args(1), "-an", "-f", "mp4", os.devnull],
+                        report, durations[index], progress_start=0.0, progress_end=0.25, description=None,
+                    )
+            self._run_ffmpeg_with_progress(
+                job_id, [*input_args, *common_args, *encoder_args(backend.passes[-1]), "-an", chunk_path],
+                report, durations[index], progress_start=pass2_start, progress_end=1.0, description=None,
+            )
+            return chunk_path
+
+        bitrates = [plan["video_bitrate"]] * len(segments)
+        chunk_paths = self._run_parallel(job_id, encode_chunk, range(len(segments)), workers)
+        corrections = _segments_to_correct(
+            plan["video_bitrate"], durations, [os.path.getsize(path) for path in chunk_paths],
+        )
+        if corrections:
+            progress_callback(0.95, desc=f"Re-encoding {len(corrections)} oversized segments...")
+            print(f"Size correction: re-encoding segments {[index for index, _ in corrections]}")
+            self._run_parallel(job_id, lambda correction: encode_chunk(*correction), corrections, workers)
+            for index, bitrate in corrections:
+                bitrates[index] = bitrate
+
+        concat_list = os.path.join(job_dir, "segments.txt")
+        with open(concat_list, "w", encoding="utf-8") as f:
+            for path in chunk_paths:
+                f.write(f"file '{os.path.basename(path)}'\n")
+
+        audio_args = plan["audio_args"]
+        if audio_args == ["-an"]:
+            audio_input, audio_map = [], []
+        else:
+            audio_input = [*plan["trim_args"], "-i", input_path]
+            audio_map = ["-map", "1:a:0"]
+        cmd_concat = [
+            "ffmpeg", "-y",
+            "-f", "concat", "-safe", "0", "-i", concat_list,
+            *audio_input,
+            "-map", "0:v:0", *audio_map,
+            "-c:v", "copy",
             *audio_args,
-            output_path
+            plan["output_path"]
         ]
-        self._run_ffmpeg_with_progress(
-            job_id, cmd_pass2, progress_callback, target_duration,
-            progress_start=0.25, progress_end=1.0,
-            description="Compressing..."
-        )
-        self._cleanup_logs(pass_log_prefix)
+        with self._span(job_id, "concat"):
+            self._run_ffmpeg_with_progress(
+                job_id, cmd_concat, progress_callback, sum(durations),
+                progress_start=0.95, progress_end=1.0,
+                description="Joining segments..."
+            )
 
-        return output_path
+        for _ in range(SIZE_CORRECTION_ATTEMPTS):
+            actual = os.path.getsize(plan["output_path"])
+            if actual <= plan["target_bytes"]:
+                break
+            excess = actual - plan["target_bytes"] * (1 - SIZE_TOLERANCE / 2)
+            sizes = [os.path.getsize(path) for path in chunk_paths]
+            index = max(range(len(sizes)), key=sizes.__getitem__)
+            # At most halve one chunk per attempt; the next attempt takes the
+            # then-largest chunk if that wasn't enough.
+            goal = max(sizes[index] - excess, sizes[index] / 2)
+            bitrates[index] = max(bitrates[index] * goal / sizes[index], 10000)
+            print(
+                f"Size correction: joined output {actual / 1e6:.2f} MB vs {plan['target_bytes'] / 1e6:.2f} MB "
+                f"target; re-encoding segment {index} at {bitrates[index] / 1000:.0f} kbps"
+            )
+            progress_callback(0.95, desc="Re-encoding the largest segment to fit...")
+            with self._span(job_id, "size_correction"):
+                encode_chunk(index, bitrates[index])
+            with self._span(job_id, "concat"):
+                self._run_ffmpeg_with_progress(
+                    job_id, cmd_concat, progress_callback, sum(durations),
+                    progress_start=0.95, progress_end=1.0,
+                    description="Joining segments..."
+                )
+
+        for log_prefix in log_prefixes:
+            self._cleanup_logs(log_prefix, backend)
+        for path in [*chunk_paths, concat_list]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-    def _run_ffmpeg_with_progress(self, job_id, cmd, progress_callback, total_duration, progress_start, progress_end, description):
+    def _run_ffmpeg_with_progress(self, job_id, cmd, progress_callback, total_duration, progress_start, progress_end, description, should_stop=None, capture_stderr=False):
+        """Run one ffmpeg command, reporting progress; returns its final stats.
+
+        should_stop(stats), if given, sees every progress block; when it
+        returns True ffmpeg is terminated and the stats come back with
+        "stopped": True instead of an error. capture_stderr=True adds the
+        last lines of stderr to the stats as "stderr" (for filters such as
+        ssim that report there).
+
+        Progress comes from ffmpeg's machine-readable -progress stream on
+        stdout rather than regex-scraping stderr. Each block is parsed by
+        _ProgressStream into frame/fps/speed/out_time/total_size;
+        progress_callback fires at most once per progress_interval (plus once
+        at the end) and its desc carries encode speed and an ETA. stderr is
+        drained on a side thread into a bounded deque, kept only for error
+        summaries.
+        """
+        # -progress/-nostats are global options, so they go before the inputs.
+        cmd = [cmd[0], "-nostats", "-progress", "pipe:1", *cmd[1:]]
         process = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
@@ -332,51 +2077,345 @@ class VideoCompressor:
             if already_cancelled:
                 process.terminate()
             else:
-                self._active[job_id] = process
+                self._active.setdefault(job_id, set()).add(process)
 
         if already_cancelled:
             process.wait()
             raise CompressionCancelled("Compression cancelled.")
 
-        stderr_buffer = []
-        time_pattern = re.compile(r"time=(\d{2}):(\d{2}):(\d{2}\.\d+)")
-        # stderr is always a pipe because we pass stderr=subprocess.PIPE above;
-        # the assert lets pyright narrow the Optional type.
+        # Both streams are always pipes because we pass PIPE above; the
+        # asserts let pyright narrow the Optional types.
+        assert process.stdout is not None
         assert process.stderr is not None
+        stderr_tail = deque(maxlen=50)
+        stderr_reader = threading.Thread(target=stderr_tail.extend, args=(process.stderr,), daemon=True)
+        stderr_reader.start()
 
+        progress = _ProgressStream(self.progress_interval)
+        stopped = False
         try:
-            for line in process.stderr:
-                stderr_buffer.append(line)
-                if len(stderr_buffer) > 50:
-                    stderr_buffer.pop(0)
-
-                match = time_pattern.search(line)
-                if match:
-                    hours, minutes, seconds = map(float, match.groups())
-                    current_time = hours * 3600 + minutes * 60 + seconds
-                    fraction_complete = min(current_time / total_duration, 1.0)
-                    global_progress = progress_start + (fraction_complete * (progress_end - progress_start))
-                    progress_callback(global_progress, desc=description)
+            for line in process.stdout:
+                if stopped:
+                    # Keep draining so ffmpeg never blocks on a full pipe
+                    # while it shuts down.
+                    continue
+                if progress.feed(line):
+                    progress.report(progress_callback, total_duration, progress_start, progress_end, description)
+                if should_stop and line.startswith("progress=") and should_stop(progress.stats):
+                    stopped = True
+                    process.terminate()
 
-            process.wait()
+            rusage = wait_with_rusage(process)
+            stderr_reader.join(timeout=5)
         finally:
             with self._lock:
-                self._active.pop(job_id, None)
+                procs = self._active.get(job_id)
+                if procs is not None:
+                    procs.discard(process)
+                    if not procs:
+                        del self._active[job_id]
 
         with self._lock:
             was_cancelled = job_id in self._cancelled
+            job_metrics = self._job_metrics.get(job_id)
+        if job_metrics:
+            job_metrics.record_child(rusage)
 
         if was_cancelled:
             raise CompressionCancelled("Compression cancelled.")
+        if stopped:
+            return dict(progress.stats, stopped=True)
         if process.returncode != 0:
-            summary = _summarize_ffmpeg_error(stderr_buffer)
+            summary = _summarize_ffmpeg_error(stderr_tail)
             raise Exception(f"FFmpeg Error (Exit Code {process.returncode}): {summary}")
+        if capture_stderr:
+            return dict(progress.stats, stderr=list(stderr_tail))
+        return progress.stats
 
-    def _cleanup_logs(self, prefix):
+    def _cleanup_logs(self, prefix, backend=None):
+        backend = backend or ENCODER_BACKENDS[DEFAULT_ENCODER]
         try:
-            for ext in ["-0.log", "-0.log.mbtree", ".log", ".log.mbtree"]:
+            for ext in backend.log_suffixes:
                 p = prefix + ext
                 if os.path.exists(p):
                     os.remove(p)
         except Exception:
             pass
+
+
+class AsyncVideoCompressor:
+    """asyncio-native counterpart of VideoCompressor.
+
+    Jobs are booked exactly like sync ones, on the wrapped compressor:
+    _prepare plans them (in a worker thread, since it runs ffprobe), and
+    _job pins their directory, records metrics spans and queues them in the
+    shared JobScheduler (fair by client_id) and CPU budget. Every ffmpeg
+    run, though, is an asyncio subprocess awaited on the event loop, so one
+    loop can drive dozens of concurrent jobs and their progress streams
+    without a thread each. Cancel a job by cancelling its task: the running
+    ffmpeg processes are terminated before CancelledError propagates.
+    VideoCompressor.cancel(job_id) stops it too.
+
+    Segmented and decode-once modes are thread-pool features of the sync
+    compressor; async jobs run the single-stream encode (two-pass, or
+    predictive mode's CRF probes and one capped-CRF pass) or a remux. The
+    event loop reaps its children without their rusage, so async jobs' spans
+    carry wall time only and don't feed the cost model or preset throughput.
+    """
+
+    def __init__(self, compressor=None):
+        self.compressor = compressor or VideoCompressor()
+
+    async def compress(self, job_id, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback=None, client_id=None, deadline_seconds=None, encoder=None, predictive=False):
+        """Same contract as VideoCompressor.compress, awaited instead of blocking."""
+        if not job_id:
+            job_id = uuid.uuid4().hex[:12]
+        if progress_callback is None:
+            progress_callback = lambda *args, **kwargs: None  # noqa: E731
+
+        with self.compressor._job(job_id, client_id=client_id) as slot:
+            return await self._compress_inner(
+                job_id, slot, input_path, target_mb, remove_audio, start_time, end_time,
+                speed_mode, output_resolution, fps_mode, progress_callback, deadline_seconds, encoder, predictive,
+            )
+
+    async def compress_iter(self, job_id, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, client_id=None, deadline_seconds=None, encoder=None, predictive=False):
+        """Run compress() and yield its progress as dicts.
+
+        Yields {"progress": float, "desc": str} events, then a final event
+        that also carries "output_path". Errors from the job are raised from
+        the iterator; closing the iterator early cancels the job.
+        """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def on_progress(value, desc=None):
+            # Planning runs in a worker thread, so always hop to the loop.
+            loop.call_soon_threadsafe(events.put_nowait, {"progress": value, "desc": desc})
+
+        task = asyncio.create_task(self.compress(
+            job_id, input_path, target_mb, remove_audio, start_time, end_time,
+            speed_mode, output_resolution, fps_mode, progress_callback=on_progress,
+            client_id=client_id, deadline_seconds=deadline_seconds, encoder=encoder, predictive=predictive,
+        ))
+        task.add_done_callback(lambda _: loop.call_soon(events.put_nowait, None))
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+            yield {"progress": 1.0, "desc": "Done", "output_path": await task}
+        finally:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    async def _compress_inner(self, job_id, slot, input_path, target_mb, remove_audio, start_time, end_time, speed_mode, output_resolution, fps_mode, progress_callback, deadline_seconds, encoder, predictive):
+        compressor = self.compressor
+        plan = await asyncio.to_thread(
+            compressor._prepare, job_id, input_path, target_mb, remove_audio, start_time, end_time,
+            speed_mode, output_resolution, fps_mode, progress_callback, False, False,
+            deadline_seconds, encoder, predictive,
+        )
+        if isinstance(plan, str):
+            return plan
+        output_path = plan["output_path"]
+
+        if plan["remux_cmd"]:
+            with compressor._span(job_id, "stream_copy"):
+                await self._run_ffmpeg_with_progress(
+                    job_id, plan["remux_cmd"], progress_callback, plan["remux_duration"],
+                    progress_start=0.0, progress_end=1.0,
+                    description="Remuxing (no re-encode)..."
+                )
+            if _remux_fits(output_path, plan["target_bytes"]):
+                return output_path
+
+        _check_admission(plan)
+        async with self._slot(job_id, slot, plan["cost"], progress_callback):
+            await self._encode(job_id, plan, progress_callback)
+
+        if plan["cache_key"]:
+            await asyncio.to_thread(compressor.result_cache.put, plan["cache_key"], output_path)
+        return output_path
+
+    @asynccontextmanager
+    async def _slot(self, job_id, slot, cost, progress_callback):
+        """slot(cost, progress_callback) from VideoCompressor._job, waited
+        for in a worker thread so the queue doesn't block the loop."""
+        compressor = self.compressor
+        held = slot(cost, progress_callback)
+        waiting = asyncio.ensure_future(asyncio.to_thread(held.__enter__))
+        with ExitStack() as stack:
+            try:
+                await asyncio.shield(waiting)
+            except asyncio.CancelledError:
+                # Make the waiting thread give up its place in the queue, and
+                # hand the slot straight back if it got one meanwhile.
+                with compressor._lock:
+                    compressor._cancelled.add(job_id)
+                compressor.scheduler.wake()
+                try:
+                    await waiting
+                except CompressionCancelled:
+                    pass
+                else:
+                    held.__exit__(None, None, None)
+                raise
+            stack.push(held)
+            yield
+
+    async def _encode(self, job_id, plan, progress_callback):
+        """Async _encode_video: pass 1 (or CRF probes), then pass 2 with the
+        same closed-loop size correction."""
+        compressor = self.compressor
+        backend = ENCODER_BACKENDS[plan["encoder"]]
+        progress_base = 0.0
+        if plan["predictive"]:
+            with compressor._span(job_id, "crf_probe"):
+                fit = await self._probe_crf(job_id, plan, backend, progress_callback)
+            progress_base = PREDICTIVE_PROGRESS
+            if fit:
+                plan = dict(plan, crf=fit[0], crf_slope=fit[1])
+
+        cmd_pass1, cmd_pass2, pass_log_prefix = _two_pass_commands(plan, compressor.cpu_budget.threads_for(job_id))
+        pass1_end = progress_base + 0.25 * (1.0 - progress_base) if cmd_pass1 else progress_base
+        try:
+            if cmd_pass1:
+                with compressor._span(job_id, "pass1"):
+                    await self._run_ffmpeg_with_progress(
+                        job_id, cmd_pass1, progress_callback, plan["duration"],
+                        progress_start=progress_base, progress_end=pass1_end,
+                        description="Analyzing metadata..."
+                    )
+                _, cmd_pass2, _ = _two_pass_commands(plan, compressor.cpu_budget.threads_for(job_id))
+            with compressor._lock:
+                compressor._live_outputs[job_id] = plan["output_path"]
+
+            frame_weights = _x264_frame_weights(pass_log_prefix) if cmd_pass1 and backend.name == "libx264" else None
+            video_bitrate = plan["video_bitrate"]
+            crf = plan.get("crf")
+            for attempt in range(SIZE_CORRECTION_ATTEMPTS + 1):
+                guard = None
+                if attempt < SIZE_CORRECTION_ATTEMPTS:
+                    guard = _SizeGuard(plan["target_bytes"], plan["duration"], plan["audio_bitrate"], frame_weights)
+                with compressor._span(job_id, "pass2"):
+                    stats = await self._run_ffmpeg_with_progress(
+                        job_id, cmd_pass2, progress_callback, plan["duration"],
+                        progress_start=pass1_end, progress_end=1.0,
+                        description="Compressing..." if attempt == 0 else "Compressing (size-corrected)...",
+                        should_stop=guard,
+                    )
+                if stats.get("stopped"):
+                    actual = guard.projected
+                else:
+                    actual = os.path.getsize(plan["output_path"])
+                    if guard is None or actual <= plan["target_bytes"]:
+                        break
+                video_bitrate, crf = _next_pass2_rate(
+                    plan, backend, video_bitrate, crf, actual, projected=bool(stats.get("stopped")),
+                )
+                _, cmd_pass2, _ = _two_pass_commands(
+                    dict(plan, video_bitrate=video_bitrate, crf=crf), compressor.cpu_budget.threads_for(job_id),
+                )
+            compressor._record_speed(job_id, stats)
+        finally:
+            compressor._cleanup_logs(pass_log_prefix, backend)
+
+    async def _probe_crf(self, job_id, plan, backend, progress_callback):
+        """Async VideoCompressor._probe_crf: windows concurrently, CRFs in turn."""
+        keyframes = plan["keyframes"]
+        if keyframes is None:
+            progress_callback(0, desc="Finding keyframes...")
+            keyframes = await asyncio.to_thread(get_keyframe_times, plan["input_path"])
+        windows = pick_preview_windows(
+            keyframes, plan["start"], plan["end"], PREDICTIVE_WINDOWS, PREDICTIVE_WINDOW_SECONDS,
+        )
+        threads = max(1, self.compressor.cpu_budget.threads_for(job_id) // len(windows))
+        probes = _crf_probe_commands(plan, backend, windows, threads)
+        durations = [end - start for start, end in windows]
+        tracker = _SegmentProgress(
+            progress_callback, durations, span=PREDICTIVE_PROGRESS,
+            description=f"Sampling {len(windows)} windows at {len(backend.probe_crfs)} quality levels...",
+            interval=self.compressor.progress_interval,
+        )
+
+        async def probe_window(index):
+            report = tracker.for_chunk(index)
+            sizes = []
+            for i, (probe_path, cmd) in enumerate(probes[index]):
+                await self._run_ffmpeg_with_progress(
+                    job_id, cmd, report, durations[index],
+                    progress_start=i / len(probes[index]), progress_end=(i + 1) / len(probes[index]), description=None,
+                )
+                sizes.append(os.path.getsize(probe_path))
+                os.remove(probe_path)
+            return sizes
+
+        # A failing window cancels the others (and so their ffmpeg runs).
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(probe_window(index)) for index in range(len(windows))]
+        return _fit_crf_probes(plan, backend, durations, [task.result() for task in tasks])
+
+    async def _run_ffmpeg_with_progress(self, job_id, cmd, progress_callback, total_duration, progress_start, progress_end, description, should_stop=None):
+        """asyncio twin of VideoCompressor._run_ffmpeg_with_progress.
+
+        Cancelling the awaiting task terminates ffmpeg (killing it if it
+        hasn't exited within 2 s) before CancelledError propagates.
+        VideoCompressor.cancel(job_id) is checked on every progress line.
+        """
+        compressor = self.compressor
+        if compressor._is_cancelled(job_id):
+            raise CompressionCancelled("Compression cancelled.")
+        cmd = [cmd[0], "-nostats", "-progress", "pipe:1", *cmd[1:]]
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        assert process.stdout is not None
+        assert process.stderr is not None
+        stderr_tail = deque(maxlen=50)
+
+        async def drain_stderr():
+            async for raw in process.stderr:
+                stderr_tail.append(raw.decode("utf-8", errors="replace"))
+
+        stderr_reader = asyncio.create_task(drain_stderr())
+        progress = _ProgressStream(compressor.progress_interval)
+        stopped = cancelled = False
+        try:
+            async for raw in process.stdout:
+                if stopped or cancelled:
+                    # Keep draining so ffmpeg never blocks on a full pipe
+                    # while it shuts down.
+                    continue
+                line = raw.decode("utf-8", errors="replace")
+                if progress.feed(line):
+                    progress.report(progress_callback, total_duration, progress_start, progress_end, description)
+                if compressor._is_cancelled(job_id):
+                    cancelled = True
+                    process.terminate()
+                elif should_stop and line.startswith("progress=") and should_stop(progress.stats):
+                    stopped = True
+                    process.terminate()
+            await process.wait()
+            await stderr_reader
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=2)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            stderr_reader.cancel()
+            raise
+
+        if cancelled or compressor._is_cancelled(job_id):
+            raise CompressionCancelled("Compression cancelled.")
+        if stopped:
+            return dict(progress.stats, stopped=True)
+        if process.returncode != 0:
+            summary = _summarize_ffmpeg_error(stderr_tail)
+            raise Exception(f"FFmpeg Error (Exit Code {process.returncode}): {summary}")
+        return progress.stats
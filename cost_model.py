@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+from collections import defaultdict, deque
+
+from presets import SEED_THROUGHPUT
+
+# CPU-seconds per megapixel-frame for each (preset, pass) before any history
+# exists. Derived from presets.SEED_THROUGHPUT (wall-clock, two-pass, two
+# threads) with pass 1 taking about a third of the work — libx264's first
+# pass runs with its fast-firstpass shortcuts. Pass 0 is a single-pass
+# encode, which costs about what a second pass does.
+PASS1_SHARE = 0.35
+SEED_CPU_PER_MPX_FRAME = {}
+for _preset, _rate in SEED_THROUGHPUT.items():
+    _two_pass = 2.0 / _rate
+    SEED_CPU_PER_MPX_FRAME[(_preset, 1)] = _two_pass * PASS1_SHARE
+    SEED_CPU_PER_MPX_FRAME[(_preset, 2)] = _two_pass * (1 - PASS1_SHARE)
+    SEED_CPU_PER_MPX_FRAME[(_preset, 0)] = _two_pass * (1 - PASS1_SHARE)
+
+# Other encoders' presets are keyed "<encoder>:<preset>" and seeded as a
+# multiple of an x264 preset: x265 at the x264 preset of the same name, and
+# SVT-AV1's numeric presets at x264 medium (SVT's 8-10 land around there per
+# core, but it parallelizes across many more).
+BACKEND_SEED_FACTOR = {"libx265": 3.0, "libsvtav1": 2.0}
+
+# A (preset, pass) coefficient is fitted once it has this many samples; until
+# then the seed is used.
+MIN_SAMPLES = 3
+
+# Samples kept per (preset, pass), newest last. Old hardware/ffmpeg history
+# ages out as new jobs come in.
+MAX_SAMPLES = 200
+
+# Once the history file holds this many times the lines it would need, it is
+# rewritten keeping only the newest MAX_SAMPLES per (preset, pass), so it
+# doesn't grow for as long as the server runs.
+COMPACT_FACTOR = 2
+
+
+def _seed(preset, pass_number):
+    factor = 1.0
+    if ":" in preset:
+        encoder, preset = preset.split(":", 1)
+        factor = BACKEND_SEED_FACTOR.get(encoder, 1.0)
+    base = SEED_CPU_PER_MPX_FRAME.get((preset, pass_number), SEED_CPU_PER_MPX_FRAME[("medium", pass_number)])
+    return base * factor
+
+
+def _read_history(path):
+    """({(preset, pass): deque of the newest MAX_SAMPLES valid rows}, line count)."""
+    rows = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+    lines = 0
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    row = json.loads(line)
+                    row["pass"] = int(row["pass"])
+                    row["mpx_frames"] = float(row["mpx_frames"])
+                    row["cpu_s"] = float(row["cpu_s"])
+                    rows[(row["preset"], row["pass"])].append(row)
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except OSError:
+        pass
+    return rows, lines
+
+
+class EncodeCostModel:
+    """Predicts encode CPU-seconds from megapixel-frames, preset and passes.
+
+    cpu_seconds = mpx_frames * sum(coefficient[preset, pass] for each pass),
+    where mpx_frames = duration * effective fps * output pixels / 1e6. Each
+    coefficient is fitted as total CPU / total mpx_frames over its recent
+    samples (least squares through the origin, weighted by job size), so
+    long jobs dominate the fit the way they dominate the machine.
+
+    Samples come from finished jobs (the per-pass CPU time JobMetrics already
+    measures) and from bench.py runs. With a history_path they're appended
+    there as JSONL and reloaded at startup, so a restart keeps the fit. The
+    file is compacted at load and whenever it outgrows COMPACT_FACTOR times
+    the samples kept; compaction works from the file itself, so rows other
+    processes (batch workers) appended survive it.
+    """
+
+    def __init__(self, history_path=None):
+        self.history_path = history_path
+        self._samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))  # (preset, pass) -> (mpx_frames, cpu_s)
+        self._history_lines = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.history_path or not os.path.exists(self.history_path):
+            return
+        rows, lines = _read_history(self.history_path)
+        for row in rows.values():
+            for sample in row:
+                self._add(sample["preset"], sample["pass"], sample["mpx_frames"], sample["cpu_s"])
+        with self._lock:
+            self._history_lines = lines
+            if lines > sum(len(row) for row in rows.values()):
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the history file with the newest MAX_SAMPLES rows per key.
+
+        Caller holds _lock. Re-reads the file rather than writing the
+        in-memory samples, so other processes' rows are kept.
+        """
+        rows, _ = _read_history(self.history_path)
+        tmp = f"{self.history_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                for row in rows.values():
+                    for sample in row:
+                        f.write(json.dumps(sample) + "\n")
+            os.replace(tmp, self.history_path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._history_lines = sum(len(row) for row in rows.values())
+
+    def _add(self, preset, pass_number, mpx_frames, cpu_seconds):
+        if mpx_frames > 0 and cpu_seconds > 0:
+            with self._lock:
+                self._samples[(preset, pass_number)].append((mpx_frames, cpu_seconds))
+
+    def record(self, preset, pass_number, mpx_frames, cpu_seconds, source="job"):
+        """Add one measured pass (pass_number 1/2, or 0 for single-pass)."""
+        if not mpx_frames or not cpu_seconds or mpx_frames <= 0 or cpu_seconds <= 0:
+            return
+        self._add(preset, pass_number, mpx_frames, cpu_seconds)
+        if not self.history_path:
+            return
+        row = {
+            "preset": preset, "pass": pass_number, "mpx_frames": round(mpx_frames, 3),
+            "cpu_s": round(cpu_seconds, 3), "source": source,
+        }
+        with self._lock:
+            try:
+                with open(self.history_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(row) + "\n")
+            except OSError:
+                return
+            self._history_lines += 1
+            if self._history_lines > COMPACT_FACTOR * MAX_SAMPLES * max(len(self._samples), 1):
+                self._compact()
+
+    def coefficient(self, preset, pass_number):
+        """CPU-seconds per megapixel-frame for one pass at this preset."""
+        with self._lock:
+            samples = list(self._samples.get((preset, pass_number), ()))
+        if len(samples) >= MIN_SAMPLES:
+            return sum(cpu for _, cpu in samples) / sum(mpx for mpx, _ in samples)
+        return _seed(preset, pass_number)
+
+    def predict(self, preset, mpx_frames, passes=(1, 2)):
+        """Predicted CPU-seconds for an encode of mpx_frames at preset."""
+        return mpx_frames * sum(self.coefficient(preset, p) for p in passes)
+
+    def summary(self):
+        """{"preset/pass": {"samples": n, "cpu_per_mpx_frame": c}} for inspection."""
+        with self._lock:
+            keys = sorted(self._samples)
+        return {
+            f"{preset}/{pass_number}": {
+                "samples": len(self._samples[(preset, pass_number)]),
+                "cpu_per_mpx_frame": round(self.coefficient(preset, pass_number), 5),
+            }
+            for preset, pass_number in keys
+        }
@@ -0,0 +1,138 @@
+import os
+import threading
+from contextlib import contextmanager
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Fewest threads a job is planned around when sizing encode slots: below two,
+# x264 loses frame-threading and a job's wall time roughly doubles.
+MIN_JOB_THREADS = 2
+
+# Decoder threads as a share of a job's threads. H.264 sources decode far
+# ahead of the encoder and mostly sleep on a full queue; HEVC/4K sources need
+# real decode parallelism. A quarter covers both without each job spawning a
+# decoder thread per host core (ffmpeg's default).
+DECODE_THREAD_DIVISOR = 4
+
+# ...but never fewer than this. On the 2-vCPU production tier a quarter
+# rounds down to one, and a single-threaded HEVC/4K decode becomes the
+# bottleneck; before decoders were sized at all they auto-threaded there.
+MIN_DECODE_THREADS = 2
+
+# libx264's own rule is threads / 6 lookahead threads; it's spelled out so
+# the count follows the job's share rather than the host's core count.
+LOOKAHEAD_THREAD_DIVISOR = 6
+
+
+def _read(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_v2_quota():
+    """Tightest cpu.max quota (in CPUs) from our cgroup up to the root."""
+    relative = "/"
+    for line in (_read("/proc/self/cgroup") or "").splitlines():
+        if line.startswith("0::"):
+            relative = line[3:] or "/"
+    quotas = []
+    path = os.path.normpath(os.path.join(CGROUP_ROOT, relative.lstrip("/")))
+    while True:
+        parts = (_read(os.path.join(path, "cpu.max")) or "").split()
+        if len(parts) == 2 and parts[0] != "max":
+            try:
+                quotas.append(int(parts[0]) / int(parts[1]))
+            except (ValueError, ZeroDivisionError):
+                pass
+        if path == CGROUP_ROOT or not path.startswith(CGROUP_ROOT):
+            break
+        path = os.path.dirname(path)
+    return min(quotas) if quotas else None
+
+
+def _cgroup_v1_quota():
+    for controller in ("cpu,cpuacct", "cpu"):
+        base = os.path.join(CGROUP_ROOT, controller)
+        quota, period = _read(os.path.join(base, "cpu.cfs_quota_us")), _read(os.path.join(base, "cpu.cfs_period_us"))
+        try:
+            if quota and period and int(quota) > 0:
+                return int(quota) / int(period)
+        except (ValueError, ZeroDivisionError):
+            continue
+    return None
+
+
+def detect_cpus():
+    """CPUs this process may actually use: the affinity mask, capped by a
+    cgroup CPU quota (v2 cpu.max or v1 cfs_quota_us) when one is set.
+
+    os.cpu_count() reports the host's cores, which inside a container with
+    a 2-CPU quota on a 32-core node oversubscribes sixteenfold. Fractional
+    quotas round down (1.5 CPUs -> 1) so jobs aren't throttled mid-frame.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_v2_quota()
+    if quota is None:
+        quota = _cgroup_v1_quota()
+    if quota is not None:
+        cpus = min(cpus, int(quota))
+    return max(1, cpus)
+
+
+def split_threads(threads):
+    """Thread counts for one ffmpeg run given the job's share of CPUs."""
+    threads = max(1, int(threads))
+    return {
+        "threads": threads,
+        "decode_threads": max(MIN_DECODE_THREADS, threads // DECODE_THREAD_DIVISOR),
+        "lookahead_threads": max(1, threads // LOOKAHEAD_THREAD_DIVISOR),
+    }
+
+
+class CpuBudget:
+    """Splits the process's CPUs between the jobs currently encoding.
+
+    Jobs register for the length of their encode; threads_for() answers with
+    an equal share of the budget (the remainder going to the oldest jobs), so
+    a lone job gets the whole machine and each new one shrinks the others'
+    next ffmpeg run. Shares are read whenever a command is built — per pass,
+    per segment — since a running ffmpeg can't change its thread count.
+    """
+
+    def __init__(self, cpus=None):
+        self.cpus = max(1, int(cpus or detect_cpus()))
+        self._jobs = []  # job ids, oldest first
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def job(self, job_id):
+        with self._lock:
+            self._jobs.append(job_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._jobs.remove(job_id)
+
+    def _share(self, index, running):
+        base, extra = divmod(self.cpus, max(1, running))
+        return max(1, base + (1 if index < extra else 0))
+
+    def threads_for(self, job_id):
+        """This job's current share, in threads."""
+        with self._lock:
+            if job_id not in self._jobs:
+                return self._share(len(self._jobs), len(self._jobs) + 1)
+            return self._share(self._jobs.index(job_id), len(self._jobs))
+
+    def threads_for_new_job(self):
+        """The share a job starting now would get."""
+        with self._lock:
+            running = len(self._jobs)
+        return self._share(running, running + 1)
@@ -0,0 +1,64 @@
+"""Plans the -vf chain for an encode: which stages run, in what order, with
+which scaler.
+
+Stages are ordered so each one sees as few pixels as possible:
+
+    fps -> scale
+
+The frame-dropping stage goes first, so a 60 -> 30 fps cap halves the
+frames the scaler touches instead of scaling frames only to throw them
+away. Stages appear only when they apply: no fps stage without a cap, no
+scale without a downscale.
+
+Each stage carries an estimate of the work pushed through it, in megapixels
+per source second (frames in x pixels in), so a plan can be compared with
+what bench.py measures for it.
+"""
+
+# Scaler per downscale ratio (output height / input height), first match
+# wins. Big downscales (4K -> 480p is ~0.22) use "area", which averages every
+# source pixel into its output pixel: alias-free and cheaper than bicubic,
+# whose filter widens as the ratio shrinks. Milder downscales keep bicubic,
+# swscale's default, where area's box filter would visibly soften.
+SCALER_BY_RATIO = (
+    (0.5, "area"),
+    (1.0, "bicubic"),
+)
+
+
+def scaler_for_ratio(ratio):
+    for upper, flags in SCALER_BY_RATIO:
+        if ratio <= upper:
+            return flags
+    return SCALER_BY_RATIO[-1][1]
+
+
+def plan_filters(source_width, source_height, source_fps, target_height=0, target_fps=0):
+    """Resolve the filter stages for one encode.
+
+    Returns {"stages": [...], "args": [...]}; args are the output options to
+    splice after -i ([] when nothing applies). Each stage is a dict with its
+    "name", "filter" string and "mpx_per_second" work estimate.
+    """
+    width, height = source_width or 0, source_height or 0
+    fps = source_fps or 0
+    stages = []
+
+    def add(name, filter_string):
+        stages.append({
+            "name": name,
+            "filter": filter_string,
+            "mpx_per_second": round(fps * width * height / 1e6, 3),
+        })
+
+    if target_fps and fps and target_fps < fps:
+        add("fps", f"fps={target_fps}")
+        fps = target_fps
+    if target_height and height and target_height < height:
+        flags = scaler_for_ratio(target_height / height)
+        add("scale", f"scale=-2:{target_height}:flags={flags}")
+
+    args = []
+    if stages:
+        args = ["-vf", ",".join(stage["filter"] for stage in stages)]
+    return {"stages": stages, "args": args}
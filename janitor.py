@@ -0,0 +1,241 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# A pinned job directory holds one marker per pinning process, so janitors in
+# other processes sharing OUTPUT_DIR (batch workers, the app) leave it alone.
+PIN_MARKER_PREFIX = ".pinned-"
+
+# flock()ed around marker changes and sweep's check-then-remove, so a pin in
+# any process can't land between a sweep's check and its removal.
+LOCK_FILENAME = "_janitor.lock"
+
+# Doomed directories are renamed to this prefix under the lock and deleted
+# after it's released; the "_" keeps sweeps from indexing them.
+TOMBSTONE_PREFIX = "_removing-"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _pinned_elsewhere(path):
+    """True if a live process other than this one has a pin marker in path.
+    Markers left by dead processes are removed."""
+    try:
+        names = [name for name in os.listdir(path) if name.startswith(PIN_MARKER_PREFIX)]
+    except OSError:
+        return False
+    pinned = False
+    for name in names:
+        try:
+            pid = int(name[len(PIN_MARKER_PREFIX):])
+        except ValueError:
+            continue
+        if pid == os.getpid():
+            continue
+        if _pid_alive(pid):
+            pinned = True
+        else:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+    return pinned
+
+
+def _dir_size(path):
+    """Total bytes of regular files under path (job dirs are shallow)."""
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += _dir_size(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return total
+
+
+class OutputJanitor:
+    """Background thread that bounds OUTPUT_DIR by age and by total bytes.
+
+    Keeps an in-memory index of job directories (name -> size, last access)
+    so sweeps don't walk the whole tree: a directory is re-measured only when
+    it's new, pinned (still being written), or was just unpinned. Each sweep
+    removes directories idle longer than ttl_seconds, then evicts least
+    recently used ones until the total fits max_bytes.
+
+    Pinned directories are never removed. The compressor pins a job for the
+    length of compress(); the HTTP API pins uploads until their job finishes
+    and outputs while a download is streaming. Pins are counted, so
+    overlapping holders don't release each other's. While a process holds
+    any pin on a directory it keeps a marker file there (PIN_MARKER_PREFIX +
+    pid), which every janitor sharing output_dir respects — batch workers
+    each run their own.
+
+    Names starting with "_" (the result cache, packet indexes) are skipped;
+    those stores enforce their own bounds and are pruned through the
+    extra_prune callables on the same schedule.
+    """
+
+    def __init__(self, output_dir, ttl_seconds, max_bytes, interval_seconds, extra_prune=()):
+        self.output_dir = output_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.interval_seconds = interval_seconds
+        self.extra_prune = list(extra_prune)
+        self._entries = {}  # name -> {"size": bytes, "last_access": epoch, "dirty": bool}
+        self._pins = {}  # name -> count
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(output_dir, LOCK_FILENAME)
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="output-janitor", daemon=True)
+            self._thread.start()
+
+    @contextmanager
+    def _locked(self):
+        """This process's lock plus the cross-process one on output_dir."""
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _marker(self, name):
+        return os.path.join(self.output_dir, name, f"{PIN_MARKER_PREFIX}{os.getpid()}")
+
+    def pin(self, name):
+        """Hold name's directory (created if missing) against every janitor."""
+        with self._locked():
+            self._pins[name] = self._pins.get(name, 0) + 1
+            if self._pins[name] == 1:
+                os.makedirs(os.path.join(self.output_dir, name), exist_ok=True)
+                with open(self._marker(name), "w"):
+                    pass
+            entry = self._entries.get(name)
+            if entry:
+                entry["last_access"] = time.time()
+
+    def unpin(self, name):
+        """Release one pin; the directory becomes evictable once none remain."""
+        with self._locked():
+            count = self._pins.get(name, 0) - 1
+            if count > 0:
+                self._pins[name] = count
+            else:
+                self._pins.pop(name, None)
+                try:
+                    os.remove(self._marker(name))
+                except OSError:
+                    pass
+            entry = self._entries.get(name)
+            if entry:
+                entry["last_access"] = time.time()
+                entry["dirty"] = True
+        # A finished job may have just pushed us over quota.
+        self._wakeup.set()
+
+    def _loop(self):
+        while True:
+            self.sweep()
+            self._wakeup.wait(self.interval_seconds)
+            self._wakeup.clear()
+
+    def sweep(self):
+        """One pass: refresh the index, expire by TTL, then evict to quota."""
+        self._refresh()
+        now = time.time()
+        with self._lock:
+            pinned = set(self._pins)
+            candidates = sorted(
+                (entry["last_access"], name, entry["size"])
+                for name, entry in self._entries.items()
+                if name not in pinned
+            )
+            total = sum(entry["size"] for entry in self._entries.values())
+        doomed = []
+        for last_access, name, size in candidates:
+            if now - last_access > self.ttl_seconds or total > self.max_bytes:
+                doomed.append(name)
+                total -= size
+        for name in doomed:
+            path = os.path.join(self.output_dir, name)
+            tombstone = os.path.join(self.output_dir, f"{TOMBSTONE_PREFIX}{uuid.uuid4().hex}")
+            with self._locked():
+                # Re-check under both locks: a job here or in another process
+                # may have pinned this directory since we looked. Once renamed
+                # it's out of every pinner's way; a later pin() recreates it.
+                if name in self._pins or _pinned_elsewhere(path):
+                    continue
+                self._entries.pop(name, None)
+                try:
+                    os.rename(path, tombstone)
+                except OSError:
+                    continue
+            shutil.rmtree(tombstone, ignore_errors=True)
+
+        for prune in self.extra_prune:
+            try:
+                prune()
+            except OSError:
+                pass
+
+    def _refresh(self):
+        try:
+            with os.scandir(self.output_dir) as it:
+                present = {
+                    entry.name: entry.stat().st_mtime
+                    for entry in it
+                    if not entry.name.startswith("_") and entry.is_dir(follow_symlinks=False)
+                }
+        except OSError:
+            return
+        with self._lock:
+            for name in list(self._entries):
+                if name not in present:
+                    del self._entries[name]
+        self._remove_tombstones()
+        with self._lock:
+            to_measure = [
+                name for name in present
+                if name not in self._entries or name in self._pins or self._entries[name]["dirty"]
+            ]
+        # Measure outside the lock so pin/unpin never wait on disk.
+        sizes = {name: _dir_size(os.path.join(self.output_dir, name)) for name in to_measure}
+        with self._lock:
+            for name, size in sizes.items():
+                entry = self._entries.get(name)
+                if entry is None:
+                    # First sighting (e.g. after a restart): the directory's
+                    # mtime is the best guess at when it was last used.
+                    entry = self._entries[name] = {"last_access": present[name]}
+                entry["size"] = size
+                entry["dirty"] = False
+
+    def _remove_tombstones(self):
+        """Finish removals a crashed sweep (in any process) left behind."""
+        try:
+            with os.scandir(self.output_dir) as it:
+                leftovers = [entry.path for entry in it if entry.name.startswith(TOMBSTONE_PREFIX)]
+        except OSError:
+            return
+        for path in leftovers:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,456 @@
+"""HTTP job API served next to the Gradio UI.
+
+    POST /api/jobs?target_mb=10[&start_time=..&end_time=..&speed_mode=..
+                   &resolution=..&fps_mode=..&remove_audio=true&deadline_seconds=..&encoder=libx264|libx265|libsvtav1
+                   &predictive=true&filename=clip.mov]
+         body: the raw video bytes        -> 202 {"job_id": ..., "token": ..., urls...}
+    GET  /api/jobs/{job_id}               -> status JSON
+    GET  /api/jobs/{job_id}/events        -> text/event-stream of status changes
+    POST /api/jobs/{job_id}/cancel
+    GET  /api/jobs/{job_id}/download      -> the output (Range requests supported)
+    GET  /api/jobs/{job_id}/download?index=i -> the i-th output of a multi-size job
+    GET  /api/jobs/{job_id}/live          -> the output so far, while pass 2 runs
+
+Submissions return as soon as the upload is on disk (or 429 while
+MAX_PENDING_JOBS are already pending); the encode runs on a worker thread
+and queues in the compressor's own scheduler like any UI job, so clients
+can pipeline submissions without holding a connection per encode.
+
+Every per-job route takes the job's token (?token=...), which is returned
+only by the submission. Job ids alone show up in places like logs; without
+the token, a job is answered as unknown.
+
+Repeating target_mb (?target_mb=10&target_mb=50) submits one multi-size job:
+every size is encoded from a single decode of the upload
+(VideoCompressor.compress_many), and the finished status lists one
+download URL per size, in the order given.
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+
+from compressor import MAX_INPUT_BYTES, MAX_INPUT_MB, OUTPUT_TTL_SECONDS, CompressionCancelled
+
+# How often an events stream checks its job for changes, and how long it
+# stays quiet before sending a keep-alive comment through proxies.
+EVENTS_POLL_SECONDS = 0.5
+EVENTS_KEEPALIVE_SECONDS = 15
+
+# Read size when streaming a live output's ready prefix.
+LIVE_CHUNK_BYTES = 256 * 1024
+
+# API jobs uploading or unfinished at once; further submissions get 429.
+# Each holds a pinned upload of up to MAX_INPUT_MB the janitor can't evict,
+# so this bounds the disk the API can claim (like the UI's Gradio queue,
+# max_size=8). Every admitted job has a worker thread, so all of them reach
+# the compressor's scheduler, which decides the order they encode in.
+MAX_PENDING_JOBS = 8
+
+_FINISHED = ("done", "error", "cancelled")
+
+
+class JobManager:
+    """Tracks API-submitted jobs and runs each through compressor.compress().
+
+    Job records are plain dicts guarded by one lock; every change bumps the
+    record's "version" so event streams can tell when there's news without
+    a queue per subscriber. Finished records are forgotten after the same
+    TTL as their output directories, checked on every janitor sweep. A
+    finished job's directories (its own, plus one per size for multi-size
+    jobs) stay pinned until its record is forgotten, so the janitor can't
+    evict outputs a client can still ask for.
+    """
+
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self._jobs = {}  # job_id -> record
+        self._pending = 0  # admitted by upload_path() and not yet finished
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=MAX_PENDING_JOBS, thread_name_prefix="api-job")
+        compressor.janitor.extra_prune.append(self._forget_expired)
+
+    def new_job_id(self):
+        return uuid.uuid4().hex[:12]
+
+    def upload_path(self, job_id, filename):
+        """Where an upload for job_id is written: inside the job's own
+        directory, so it's pruned along with the job's outputs. None when
+        MAX_PENDING_JOBS jobs are already pending.
+
+        Admits the job and pins the directory against the janitor; submit()'s
+        worker releases both when the job finishes (discard_upload() if it
+        never starts).
+        """
+        with self._lock:
+            if self._pending >= MAX_PENDING_JOBS:
+                return None
+            self._pending += 1
+        try:
+            self.compressor.janitor.pin(job_id)
+        except BaseException:
+            self._release()
+            raise
+        job_dir = os.path.join(self.compressor.output_dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        _, ext = os.path.splitext(os.path.basename(filename or ""))
+        return os.path.join(job_dir, f"upload{ext.lower() or '.mp4'}")
+
+    def discard_upload(self, job_id, input_path):
+        try:
+            os.remove(input_path)
+        except OSError:
+            pass
+        self.compressor.janitor.unpin(job_id)
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, job_id, input_path, params, client_id=None):
+        """Queue the job and return its access token."""
+        token = secrets.token_urlsafe(16)
+        record = {
+            "job_id": job_id,
+            "token": token,
+            "status": "queued",
+            "progress": 0.0,
+            "desc": None,
+            "error": None,
+            "output_path": None,
+            "output_paths": None,
+            "created": time.time(),
+            "finished": None,
+            "pinned": (),
+            "version": 0,
+        }
+        with self._lock:
+            self._jobs[job_id] = record
+        self._executor.submit(self._run, job_id, input_path, params, client_id)
+        return token
+
+    def get(self, job_id):
+        with self._lock:
+            record = self._jobs.get(job_id)
+            return dict(record) if record else None
+
+    def cancel(self, job_id):
+        if self.get(job_id) is None:
+            return False
+        self.compressor.cancel(job_id)
+        return True
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                return
+            record.update(changes)
+            record["version"] += 1
+
+    def _run(self, job_id, input_path, params, client_id):
+        def on_progress(value, desc=None):
+            self._update(job_id, status="running", progress=round(float(value), 4), desc=desc)
+
+        # upload_path() already pinned job_id. Pin the per-size directories
+        # compress_many() writes to as well, before it starts, so there's no
+        # gap between its own pins and ours.
+        janitor = self.compressor.janitor
+        pinned = [job_id]
+        if "target_mbs" in params:
+            pinned += [f"{job_id}-{index}" for index in range(len(params["target_mbs"]))]
+        for name in pinned[1:]:
+            janitor.pin(name)
+        done = False
+        try:
+            if "target_mbs" in params:
+                output_paths = self.compressor.compress_many(
+                    job_id=job_id,
+                    input_path=input_path,
+                    progress_callback=on_progress,
+                    client_id=client_id,
+                    **{k: v for k, v in params.items() if k != "predictive"},
+                )
+            else:
+                output_paths = [self.compressor.compress(
+                    job_id=job_id,
+                    input_path=input_path,
+                    progress_callback=on_progress,
+                    client_id=client_id,
+                    **params,
+                )]
+            self._update(
+                job_id, status="done", progress=1.0, desc=None,
+                output_path=output_paths[0], output_paths=output_paths, finished=time.time(),
+                pinned=tuple(pinned),
+            )
+            done = True
+        except CompressionCancelled:
+            self._update(job_id, status="cancelled", finished=time.time())
+        except Exception as e:
+            self._update(job_id, status="error", error=str(e), finished=time.time())
+        finally:
+            # A finished job's pins are released by _forget_expired().
+            if not done:
+                for name in pinned:
+                    janitor.unpin(name)
+            self._release()
+
+    def _forget_expired(self):
+        cutoff = time.time() - OUTPUT_TTL_SECONDS
+        with self._lock:
+            expired = [j for j, r in self._jobs.items() if r["finished"] and r["finished"] < cutoff]
+            released = [name for job_id in expired for name in self._jobs.pop(job_id)["pinned"]]
+        for name in released:
+            self.compressor.janitor.unpin(name)
+
+
+def _public(record):
+    """Status JSON for clients — no server paths, and no token (the
+    download URLs need ?token= added)."""
+    body = {k: v for k, v in record.items() if k not in ("output_path", "output_paths", "pinned", "token", "version")}
+    if record["status"] == "done":
+        body["download_url"] = f"/api/jobs/{record['job_id']}/download"
+        if len(record["output_paths"] or ()) > 1:
+            body["download_urls"] = [
+                f"/api/jobs/{record['job_id']}/download?index={index}" for index in range(len(record["output_paths"]))
+            ]
+    return body
+
+
+def _parse_range(header, length):
+    """(start, end) inclusive for a single "bytes=" range within length
+    bytes, None for no/unsupported header, or False when unsatisfiable."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            start, end = max(0, length - int(last)), length - 1
+        else:
+            start = int(first)
+            end = min(int(last), length - 1) if last else length - 1
+    except ValueError:
+        return None
+    if start > end or start >= length:
+        return False
+    return start, end
+
+
+def live_response(compressor, job_id, request):
+    """Serve the complete fragments of job_id's output while it's encoding.
+
+    The file is still growing, so responses cover only the ready prefix
+    (init segment + whole fragments) and ranges report an unknown total
+    length ("bytes a-b/*"); clients re-request from where they stopped.
+    Returns None when the job has no live output (not in pass 2 yet, or
+    already finished).
+    """
+    live = compressor.live_output(job_id)
+    if live is None:
+        return None
+    path, ready = live
+    if ready == 0:
+        raise HTTPException(status_code=409, detail="No complete fragments written yet.")
+    byte_range = _parse_range(request.headers.get("range"), ready)
+    if byte_range is False:
+        return Response(status_code=416, headers={"Content-Range": "bytes */*"})
+    start, end = byte_range or (0, ready - 1)
+
+    def body():
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(LIVE_CHUNK_BYTES, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "no-store", "Content-Length": str(end - start + 1)}
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/*"
+    return StreamingResponse(body(), status_code=206 if byte_range else 200, media_type="video/mp4", headers=headers)
+
+
+def create_job_router(manager):
+    router = APIRouter(prefix="/api/jobs")
+
+    def require(job_id, token):
+        record = manager.get(job_id)
+        # A wrong token gets the same answer as an unknown id, so ids can't
+        # be probed for.
+        if record is None or not secrets.compare_digest(record["token"].encode(), (token or "").encode()):
+            raise HTTPException(status_code=404, detail="Unknown job id.")
+        return record
+
+    @router.post("", status_code=202)
+    async def submit_job(
+        request: Request,
+        target_mb: list[float] = Query(...),
+        start_time: float | None = None,
+        end_time: float | None = None,
+        speed_mode: str = "Prioritize Speed",
+        resolution: str = "Auto",
+        fps_mode: str = "Auto",
+        remove_audio: bool = False,
+        deadline_seconds: float | None = None,
+        encoder: str = "libx264",
+        predictive: bool = False,
+        filename: str | None = None,
+    ):
+        """Stream the request body to disk and queue a compress job for it."""
+        if any(size <= 0 for size in target_mb):
+            raise HTTPException(status_code=422, detail="target_mb must be greater than 0.")
+        declared = request.headers.get("content-length")
+        if declared and declared.isdigit() and int(declared) > MAX_INPUT_BYTES:
+            raise HTTPException(status_code=413, detail=f"The upload limit is {MAX_INPUT_MB} MB.")
+
+        job_id = manager.new_job_id()
+        input_path = await run_in_threadpool(manager.upload_path, job_id, filename)
+        if input_path is None:
+            raise HTTPException(
+                status_code=429, detail="Too many jobs pending; try again shortly.", headers={"Retry-After": "30"},
+            )
+        received = 0
+        # Written chunk by chunk as the body arrives; nothing holds the whole
+        # upload in memory, and oversize bodies are cut off at the limit.
+        # File I/O goes through the threadpool so a slow disk doesn't stall
+        # the event loop (and every other request on it).
+        try:
+            f = await run_in_threadpool(open, input_path, "wb")
+            try:
+                async for chunk in request.stream():
+                    received += len(chunk)
+                    if received > MAX_INPUT_BYTES:
+                        break
+                    await run_in_threadpool(f.write, chunk)
+            finally:
+                await run_in_threadpool(f.close)
+        except BaseException:
+            # Client went away mid-upload.
+            manager.discard_upload(job_id, input_path)
+            raise
+        if received > MAX_INPUT_BYTES or received == 0:
+            manager.discard_upload(job_id, input_path)
+            if received == 0:
+                raise HTTPException(status_code=400, detail="Empty upload.")
+            raise HTTPException(status_code=413, detail=f"The upload limit is {MAX_INPUT_MB} MB.")
+
+        params = {
+            "remove_audio": remove_audio,
+            "start_time": start_time,
+            "end_time": end_time,
+            "speed_mode": speed_mode,
+            "output_resolution": resolution,
+            "fps_mode": fps_mode,
+            "deadline_seconds": deadline_seconds,
+            "encoder": encoder,
+            "predictive": predictive,
+        }
+        if len(target_mb) > 1:
+            params["target_mbs"] = target_mb
+        else:
+            params["target_mb"] = target_mb[0]
+        client_id = request.headers.get("x-client-id") or (request.client.host if request.client else None)
+        token = manager.submit(job_id, input_path, params, client_id=client_id)
+        return {
+            "job_id": job_id,
+            "token": token,
+            "status_url": f"/api/jobs/{job_id}?token={token}",
+            "events_url": f"/api/jobs/{job_id}/events?token={token}",
+            "cancel_url": f"/api/jobs/{job_id}/cancel?token={token}",
+            "live_url": f"/api/jobs/{job_id}/live?token={token}",
+            "download_url": f"/api/jobs/{job_id}/download?token={token}",
+        }
+
+    @router.get("/{job_id}")
+    def job_status(job_id: str, token: str | None = None):
+        return JSONResponse(_public(require(job_id, token)))
+
+    @router.get("/{job_id}/events")
+    async def job_events(job_id: str, request: Request, token: str | None = None):
+        """Server-sent events: one "status" event per change, ending with the
+        final state."""
+        require(job_id, token)
+
+        async def stream():
+            seen = None
+            quiet = 0.0
+            while True:
+                record = manager.get(job_id)
+                if record is None:
+                    return
+                if record["version"] != seen:
+                    seen = record["version"]
+                    quiet = 0.0
+                    yield f"event: status\ndata: {json.dumps(_public(record))}\n\n"
+                    if record["status"] in _FINISHED:
+                        return
+                elif quiet >= EVENTS_KEEPALIVE_SECONDS:
+                    quiet = 0.0
+                    yield ": keep-alive\n\n"
+                if await request.is_disconnected():
+                    return
+                await asyncio.sleep(EVENTS_POLL_SECONDS)
+                quiet += EVENTS_POLL_SECONDS
+
+        return StreamingResponse(
+            stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @router.post("/{job_id}/cancel")
+    def cancel_job(job_id: str, token: str | None = None):
+        record = require(job_id, token)
+        if record["status"] not in _FINISHED:
+            manager.cancel(job_id)
+        return JSONResponse(_public(manager.get(job_id) or record))
+
+    @router.get("/{job_id}/live")
+    def live_job(job_id: str, request: Request, token: str | None = None):
+        """Preview the output while pass 2 writes it (fragmented MP4)."""
+        record = require(job_id, token)
+        response = live_response(manager.compressor, job_id, request)
+        if response is None:
+            if record["status"] == "done":
+                return download_job(job_id, token)
+            raise HTTPException(status_code=409, detail=f"Job is {record['status']}; no output is being written yet.")
+        return response
+
+    @router.get("/{job_id}/download")
+    def download_job(job_id: str, token: str | None = None, index: int = 0):
+        record = require(job_id, token)
+        if record["status"] == "done" and not 0 <= index < len(record["output_paths"] or ()):
+            raise HTTPException(status_code=404, detail=f"Job has no output {index}.")
+        output_path = record["output_paths"][index] if record["status"] == "done" else None
+        if not output_path or not os.path.exists(output_path):
+            raise HTTPException(status_code=409, detail=f"Job is {record['status']}; no output to download.")
+        # FileResponse answers Range requests itself (206 + Content-Range),
+        # so players can seek and clients can resume. The directory holding
+        # this output ({job_id}-{index} for a multi-size job) stays pinned
+        # until the body has been sent.
+        janitor = manager.compressor.janitor
+        output_dir = os.path.basename(os.path.dirname(output_path))
+        janitor.pin(output_dir)
+        return FileResponse(
+            output_path,
+            media_type="video/mp4",
+            filename=os.path.basename(output_path),
+            background=BackgroundTask(janitor.unpin, output_dir),
+        )
+
+    return router
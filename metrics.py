@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+def wait_with_rusage(process):
+    """Wait for a Popen child and return its resource usage (or None).
+
+    Popen.wait() discards the child's rusage, so reap it ourselves with
+    os.wait4 and hand the exit status back to the Popen object. Falls back to
+    a plain wait() where wait4 doesn't exist (Windows) or when another thread
+    (cancel()'s poll) reaped the child first.
+    """
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        process.wait()
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+class JobMetrics:
+    """Phase spans for one compress() call.
+
+    Each span records wall time plus the CPU time and peak RSS of every
+    ffmpeg child reaped while it was open. Children are attributed to the
+    innermost span opened by the reaping thread, or failing that the
+    innermost open span, so a side process (the parallel audio encode)
+    doesn't land in the pass running next to it. ru_maxrss is KiB on Linux,
+    which is where this runs in production.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.started = time.time()
+        self.spans = []
+        self.queue_wait = None
+        self.encode_speed = None
+        self.status = None
+        self._open = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase):
+        record = {"phase": phase, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0}
+        entry = (threading.get_ident(), record)
+        with self._lock:
+            self._open.append(entry)
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = round(time.monotonic() - start, 3)
+            with self._lock:
+                self._open.remove(entry)
+                self.spans.append(record)
+
+    def record_child(self, rusage):
+        if rusage is None:
+            return
+        with self._lock:
+            if not self._open:
+                return
+            thread_id = threading.get_ident()
+            own = [record for owner, record in self._open if owner == thread_id]
+            record = own[-1] if own else self._open[-1][1]
+            record["cpu_s"] = round(record["cpu_s"] + rusage.ru_utime + rusage.ru_stime, 3)
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], round(rusage.ru_maxrss / 1024, 1))
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "status": self.status,
+            "queue_wait_s": self.queue_wait,
+            "encode_speed": self.encode_speed,
+            "spans": list(self.spans),
+        }
+
+
+class MetricsRegistry:
+    """Process-wide aggregates over finished jobs, plus the last few in full.
+
+    render_prometheus() emits the text exposition format; snapshot() is the
+    same data as JSON-friendly dicts. Both take live gauges (running/queued
+    encodes) from the caller, since the scheduler owns those numbers.
+    """
+
+    def __init__(self, recent_jobs=100):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._jobs_total = defaultdict(int)  # status -> count
+        self._phase = defaultdict(lambda: {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0})
+        self._queue_wait = {"count": 0, "sum_s": 0.0}
+        self._speed = {"count": 0, "sum": 0.0, "last": 0.0}
+        self._recent = deque(maxlen=recent_jobs)
+
+    def start_job(self, job_id):
+        with self._lock:
+            self._active += 1
+        return JobMetrics(job_id)
+
+    def finish_job(self, job, status):
+        job.status = status
+        with self._lock:
+            self._active -= 1
+            self._jobs_total[status] += 1
+            for span in job.spans:
+                agg = self._phase[span["phase"]]
+                agg["count"] += 1
+                agg["wall_s"] += span["wall_s"]
+                agg["cpu_s"] += span["cpu_s"]
+                agg["peak_rss_mb"] = max(agg["peak_rss_mb"], span["peak_rss_mb"])
+            if job.queue_wait is not None:
+                self._queue_wait["count"] += 1
+                self._queue_wait["sum_s"] += job.queue_wait
+            if job.encode_speed:
+                self._speed["count"] += 1
+                self._speed["sum"] += job.encode_speed
+                self._speed["last"] = job.encode_speed
+            self._recent.append(job.to_dict())
+
+    def snapshot(self, gauges=None):
+        with self._lock:
+            return {
+                "active_jobs": self._active,
+                **(gauges or {}),
+                "jobs_total": dict(self._jobs_total),
+                "phases": {k: dict(v) for k, v in self._phase.items()},
+                "queue_wait": dict(self._queue_wait),
+                "encode_speed": dict(self._speed),
+                "recent_jobs": list(self._recent),
+            }
+
+    def render_prometheus(self, gauges=None):
+        snap = self.snapshot(gauges)
+        lines = [
+            "# TYPE tenmb_active_jobs gauge",
+            f"tenmb_active_jobs {snap['active_jobs']}",
+        ]
+        for name, value in (gauges or {}).items():
+            lines += [f"# TYPE tenmb_{name} gauge", f"tenmb_{name} {value}"]
+        lines.append("# TYPE tenmb_jobs_total counter")
+        for status, count in snap["jobs_total"].items():
+            lines.append(f'tenmb_jobs_total{{status="{status}"}} {count}')
+        # Exposition format wants each metric family's samples contiguous.
+        phases = snap["phases"].items()
+        lines.append("# TYPE tenmb_phase_wall_seconds summary")
+        for phase, agg in phases:
+            lines.append(f'tenmb_phase_wall_seconds_sum{{phase="{phase}"}} {agg["wall_s"]:.3f}')
+            lines.append(f'tenmb_phase_wall_seconds_count{{phase="{phase}"}} {agg["count"]}')
+        lines.append("# TYPE tenmb_phase_cpu_seconds_total counter")
+        for phase, agg in phases:
+            lines.append(f'tenmb_phase_cpu_seconds_total{{phase="{phase}"}} {agg["cpu_s"]:.3f}')
+        lines.append("# TYPE tenmb_phase_peak_rss_megabytes gauge")
+        for phase, agg in phases:
+            lines.append(f'tenmb_phase_peak_rss_megabytes{{phase="{phase}"}} {agg["peak_rss_mb"]:.1f}')
+        lines += [
+            "# TYPE tenmb_queue_wait_seconds summary",
+            f"tenmb_queue_wait_seconds_sum {snap['queue_wait']['sum_s']:.3f}",
+            f"tenmb_queue_wait_seconds_count {snap['queue_wait']['count']}",
+            "# TYPE tenmb_encode_speed_realtime summary",
+            f"tenmb_encode_speed_realtime_sum {snap['encode_speed']['sum']:.3f}",
+            f"tenmb_encode_speed_realtime_count {snap['encode_speed']['count']}",
+            "# TYPE tenmb_encode_speed_realtime_last gauge",
+            f"tenmb_encode_speed_realtime_last {snap['encode_speed']['last']:.3f}",
+        ]
+        return "\n".join(lines) + "\n"
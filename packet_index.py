@@ -0,0 +1,159 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import file_signature, iter_packets
+
+# Bump when the on-disk .npz layout (or the meaning of its pts) changes so
+# stale spools are rebuilt. 2: pts relative to the container's start_time.
+INDEX_VERSION = 2
+
+# In-memory indexes kept hot. One ~10-minute 60 fps upload is ~60k packets,
+# i.e. well under 2 MB of arrays, so this is a few tens of MB at worst.
+MAX_LOADED_INDEXES = 16
+
+
+class PacketIndex:
+    """Per-file packet table with prefix sums for O(log n) range queries.
+
+    Packets are sorted by pts, in seconds from the container's start_time
+    (see utils.iter_packets), so queries take the same start/end as -ss/-to.
+    video_cum/audio_cum are exclusive prefix sums
+    (length n + 1), so the bytes of any stream in [start, end) are two
+    searchsorted calls and a subtraction — no ffprobe, no disk.
+    """
+
+    def __init__(self, pts, video_cum, audio_cum, keyframes):
+        self.pts = pts
+        self.video_cum = video_cum
+        self.audio_cum = audio_cum
+        self.keyframes = keyframes
+
+    @classmethod
+    def from_packets(cls, packets):
+        """Build from iter_packets()-style (codec_type, pts, size, is_key) tuples."""
+        rows = [(pts, size, codec_type == "video", codec_type == "audio", key) for codec_type, pts, size, key in packets]
+        if not rows:
+            raise ValueError("no packets")
+        table = np.array(rows, dtype=[("pts", "f8"), ("size", "i8"), ("video", "?"), ("audio", "?"), ("key", "?")])
+        table.sort(order="pts", kind="stable")
+        zero = np.zeros(1, dtype=np.int64)
+        return cls(
+            pts=table["pts"].copy(),
+            video_cum=np.concatenate([zero, np.cumsum(np.where(table["video"], table["size"], 0))]),
+            audio_cum=np.concatenate([zero, np.cumsum(np.where(table["audio"], table["size"], 0))]),
+            keyframes=table["pts"][table["video"] & table["key"]].copy(),
+        )
+
+    @classmethod
+    def build(cls, input_path):
+        return cls.from_packets(iter_packets(input_path))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != INDEX_VERSION:
+                raise ValueError("stale index version")
+            return cls(data["pts"], data["video_cum"], data["audio_cum"], data["keyframes"])
+
+    def save(self, path):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+        np.savez(
+            tmp_path, version=INDEX_VERSION, pts=self.pts,
+            video_cum=self.video_cum, audio_cum=self.audio_cum, keyframes=self.keyframes,
+        )
+        os.replace(tmp_path, path)
+
+    def range_bytes(self, start, end):
+        """Payload bytes per stream type for packets with start <= pts < end."""
+        i, j = np.searchsorted(self.pts, [start, end], side="left")
+        return {
+            "video": int(self.video_cum[j] - self.video_cum[i]),
+            "audio": int(self.audio_cum[j] - self.audio_cum[i]),
+        }
+
+    def trim_bitrate(self, start, end):
+        """Same figure as utils.get_trim_bitrate, answered from the index."""
+        duration = end - start
+        if duration <= 0:
+            return None
+        totals = self.range_bytes(start, end)
+        size_bytes = totals["video"] + totals["audio"]
+        return (size_bytes * 8) / duration if size_bytes > 0 else None
+
+    def keyframe_at_or_before(self, t):
+        """Latest keyframe pts <= t, or None if no keyframe precedes t (a
+        copy from the next one would drop footage before it)."""
+        i = int(np.searchsorted(self.keyframes, t, side="right")) - 1
+        return float(self.keyframes[i]) if i >= 0 else None
+
+
+class PacketIndexStore:
+    """Builds PacketIndexes in the background and serves them without blocking.
+
+    request(path) kicks off a build (or a load from the on-disk spool) on a
+    daemon thread; get(path) returns the index if it's ready, else None, so
+    UI callbacks can fall back to the global estimate instead of waiting.
+    Spooled .npz files are keyed by file_signature, so an edited file at the
+    same path is re-indexed.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self._loaded = OrderedDict()  # signature -> PacketIndex
+        self._building = {}  # signature -> threading.Event
+        self._lock = threading.Lock()
+
+    def _spool_path(self, signature):
+        digest = hashlib.sha1(repr(signature).encode("utf-8")).hexdigest()
+        return os.path.join(self.index_dir, f"{digest}.npz")
+
+    def get(self, input_path):
+        signature = file_signature(input_path)
+        if signature is None:
+            return None
+        with self._lock:
+            index = self._loaded.get(signature)
+            if index is not None:
+                self._loaded.move_to_end(signature)
+            return index
+
+    def request(self, input_path):
+        """Start building the index for input_path unless it exists or is underway."""
+        signature = file_signature(input_path)
+        if signature is None:
+            return
+        with self._lock:
+            if signature in self._loaded or signature in self._building:
+                return
+            done = self._building[signature] = threading.Event()
+        threading.Thread(
+            target=self._build, args=(input_path, signature, done), daemon=True,
+        ).start()
+
+    def _build(self, input_path, signature, done):
+        spool = self._spool_path(signature)
+        index = None
+        try:
+            if os.path.exists(spool):
+                try:
+                    index = PacketIndex.load(spool)
+                except (OSError, ValueError, KeyError):
+                    index = None
+            if index is None:
+                index = PacketIndex.build(input_path)
+                index.save(spool)
+        except (OSError, ValueError) as e:
+            print(f"Error indexing packets: {e}")
+        finally:
+            with self._lock:
+                if index is not None:
+                    self._loaded[signature] = index
+                    while len(self._loaded) > MAX_LOADED_INDEXES:
+                        self._loaded.popitem(last=False)
+                self._building.pop(signature, None)
+            done.set()
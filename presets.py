@@ -0,0 +1,87 @@
+import threading
+
+# libx264 presets a deadline may choose from, fastest first. Slower than
+# "slow" buys little at 8-10 MB targets for a lot of CPU.
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow"]
+
+# Starting throughput for a whole two-pass job at SEED_THREADS threads, in
+# megapixel-frames per wall-clock second (a plan's "mpx_frames" over encode
+# time). Rough numbers from bench.py runs on a 2-vCPU box; measured jobs
+# replace them quickly via the moving average below.
+SEED_THREADS = 2
+SEED_THROUGHPUT = {
+    "ultrafast": 80.0,
+    "superfast": 45.0,
+    "veryfast": 30.0,
+    "faster": 20.0,
+    "fast": 15.0,
+    "medium": 11.0,
+    "slow": 6.0,
+}
+
+# Per-pixel encode speed isn't flat across frame sizes (small frames carry
+# more per-frame overhead), so throughput is tracked per output-size bucket.
+# Upper bounds in megapixels: <=480p, <=720p, <=1080p, larger.
+PIXEL_BUCKETS = (0.45, 1.0, 2.1)
+
+# Weight of the newest measurement in the moving average.
+EWMA_ALPHA = 0.3
+
+# Predictions must fit within this share of the budget, leaving room for
+# probing, muxing and estimation error.
+DEADLINE_HEADROOM = 0.85
+
+
+def _bucket(out_pixels):
+    megapixels = (out_pixels or 0) / 1e6
+    for i, bound in enumerate(PIXEL_BUCKETS):
+        if megapixels <= bound:
+            return i
+    return len(PIXEL_BUCKETS)
+
+
+class PresetThroughput:
+    """Measured encode throughput per (x264 preset, output-size bucket).
+
+    record() folds each finished single-stream two-pass encode into an
+    exponential moving average; throughput() answers from that, falling back
+    to SEED_THROUGHPUT until a bucket has been measured.
+
+    Jobs run with however many threads their CPU share allows, so rates are
+    stored normalized to SEED_THREADS and scaled back by the thread count
+    asked about — x264's frame threading scales close to linearly over the
+    shares a job gets here.
+    """
+
+    def __init__(self):
+        self._rates = {}  # (preset, bucket) -> megapixel-frames per second
+        self._lock = threading.Lock()
+
+    def record(self, preset, out_pixels, mpx_frames, wall_seconds, threads=SEED_THREADS):
+        if preset not in SEED_THROUGHPUT or not mpx_frames or wall_seconds <= 0:
+            return
+        rate = mpx_frames / wall_seconds * SEED_THREADS / max(1, threads)
+        key = (preset, _bucket(out_pixels))
+        with self._lock:
+            previous = self._rates.get(key)
+            self._rates[key] = rate if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * rate
+
+    def throughput(self, preset, out_pixels, threads=SEED_THREADS):
+        with self._lock:
+            rate = self._rates.get((preset, _bucket(out_pixels)))
+        return (rate or SEED_THROUGHPUT[preset]) * max(1, threads) / SEED_THREADS
+
+    def predict_seconds(self, preset, out_pixels, mpx_frames, threads=SEED_THREADS):
+        return mpx_frames / self.throughput(preset, out_pixels, threads)
+
+    def pick_preset(self, out_pixels, mpx_frames, budget_seconds, queue_seconds=0.0, threads=SEED_THREADS):
+        """Slowest preset whose predicted queue wait + encode fits the budget.
+
+        Falls back to the fastest preset when nothing fits — the job still
+        runs, it just can't be made any quicker.
+        """
+        usable = budget_seconds * DEADLINE_HEADROOM - queue_seconds
+        for preset in reversed(X264_PRESETS):
+            if self.predict_seconds(preset, out_pixels, mpx_frames, threads) <= usable:
+                return preset
+        return X264_PRESETS[0]
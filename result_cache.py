@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from utils import file_signature
+
+# Bump when an encoder-side change (new flags, different defaults) would make
+# previously cached outputs differ from what a fresh encode produces today.
+CACHE_VERSION = 4
+
+# Read size for the streamed input hash. Large enough that hashing a 500 MB
+# upload is a few hundred syscalls, small enough to stay out of RAM.
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# hash_file memo, keyed by utils.file_signature: a multi-size job looks up
+# the cache once per target, and a retry hashes the same upload again.
+HASH_MEMO_SIZE = 64
+_hash_memo = OrderedDict()
+_hash_memo_lock = threading.Lock()
+
+
+def hash_file(path):
+    """Streamed SHA-256 of a file's contents (hex), memoized per file version."""
+    signature = file_signature(path)
+    if signature is not None:
+        with _hash_memo_lock:
+            cached = _hash_memo.get(signature)
+            if cached is not None:
+                _hash_memo.move_to_end(signature)
+                return cached
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()
+    if signature is not None:
+        with _hash_memo_lock:
+            _hash_memo[signature] = content_hash
+            while len(_hash_memo) > HASH_MEMO_SIZE:
+                _hash_memo.popitem(last=False)
+    return content_hash
+
+
+def make_cache_key(content_hash, **params):
+    """Combine the input hash with every output-affecting parameter.
+
+    Params are serialized with sorted keys so argument order never changes
+    the key. Floats should be rounded by the caller (trim times especially)
+    so 12.0 and 12.000001 don't miss each other.
+    """
+    payload = json.dumps({"version": CACHE_VERSION, "input": content_hash, **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst when they share a filesystem, else copy."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    """Byte-bounded LRU of finished outputs, keyed by make_cache_key().
+
+    Entries are files named <key>.mp4 in cache_dir. Recency is tracked in
+    memory and mirrored to the file's mtime on every hit, so a restart
+    rebuilds the same LRU order from disk. Entries also expire after
+    ttl_seconds without a hit, matching the job-directory TTL.
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl_seconds):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+        # key -> (size_bytes, last_access), oldest first.
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+
+    def _load(self):
+        found = []
+        try:
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and entry.name.endswith(".mp4"):
+                    st = entry.stat()
+                    found.append((st.st_mtime, entry.name[:-4], st.st_size))
+        except OSError:
+            return
+        for mtime, key, size in sorted(found):
+            self._entries[key] = (size, mtime)
+            self._total_bytes += size
+
+    def get(self, key):
+        """Return the cached file path for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            path = self._path(key)
+            if not os.path.exists(path) or now - entry[1] > self.ttl_seconds:
+                self._drop(key)
+                return None
+            self._entries[key] = (entry[0], now)
+            self._entries.move_to_end(key)
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, source_path):
+        """Store a finished output under key, evicting LRU entries to fit."""
+        try:
+            size = os.path.getsize(source_path)
+        except OSError:
+            return
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            link_or_copy(source_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries[key][0]
+            self._entries[key] = (size, time.time())
+            self._entries.move_to_end(key)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+
+    def prune(self):
+        """Drop entries that haven't been hit within ttl_seconds."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            for key in [k for k, (_, last) in self._entries.items() if last < cutoff]:
+                self._drop(key)
+
+    def _drop(self, key):
+        # Caller holds _lock.
+        size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
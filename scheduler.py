@@ -0,0 +1,127 @@
+import itertools
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# CPU-seconds knocked off a waiting job's cost, for ranking, per second it
+# has waited. Without it a long job can be passed by cheaper arrivals
+# forever under steady load; with it, a job of cost C outranks any new
+# arrival after at most C / AGING_RATE seconds, which bounds its wait.
+AGING_RATE = 1.0
+
+
+class JobScheduler:
+    """Bounded pool of encode slots with fair, shortest-job-first dispatch.
+
+    Waiting jobs are ordered by (slots the client already holds, cost,
+    arrival). The first key is the fairness rule: a client with an encode
+    running goes behind every client that has none, so one user queueing ten
+    uploads can't starve everyone else. Within that, cheaper jobs go first,
+    which keeps short clips from waiting behind a long one and makes tail
+    latency track job size rather than arrival luck. The cost is aged by
+    time waited (AGING_RATE), so shortest-first can't starve a long job.
+    Arrival order breaks ties so equal jobs stay FIFO.
+
+    The waiting set is tiny (bounded by the Gradio queue), so dispatch just
+    re-scans it rather than maintaining a heap whose keys change every time
+    a slot frees up.
+    """
+
+    # How often a waiter re-checks its abort predicate when nothing else
+    # wakes it. Cancel paths call wake() directly, so this is only a backstop.
+    POLL_SECONDS = 0.5
+
+    def __init__(self, slots, aging_rate=AGING_RATE):
+        self.slots = max(1, int(slots))
+        self.aging_rate = aging_rate
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = {}  # ticket -> (client, cost, enqueued)
+        self._running = 0
+        self._running_by_client = Counter()
+        self._running_cost = 0.0
+
+    def _rank(self, ticket, now):
+        client, cost, enqueued = self._waiting[ticket]
+        aged_cost = cost - self.aging_rate * (now - enqueued)
+        return (self._running_by_client[client], aged_cost, ticket)
+
+    def _position(self, ticket):
+        now = time.monotonic()
+        rank = self._rank(ticket, now)
+        return 1 + sum(1 for t in self._waiting if self._rank(t, now) < rank)
+
+    def stats(self):
+        """Snapshot of (running, waiting) counts."""
+        with self._cond:
+            return self._running, len(self._waiting)
+
+    def work_ahead(self, cost):
+        """Rough cost a new job of this cost would wait behind, per slot.
+
+        Zero when a slot is free. Otherwise every waiting job no costlier
+        than this one (shortest-job-first puts those ahead) plus half of
+        what's running (on average, half of it is left), spread over the
+        slots. Ignores the per-client fairness key, so it's an estimate.
+        """
+        with self._cond:
+            ahead = sum(c for _, c, _ in self._waiting.values() if c <= cost)
+            if self._running < self.slots and not ahead:
+                return 0.0
+            return (ahead + self._running_cost / 2) / self.slots
+
+    def wake(self):
+        """Wake all waiters so they re-check their abort predicate."""
+        with self._cond:
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, client, cost, on_position=None, should_abort=None):
+        """Block until this job may run, then hold a slot for the with-body.
+
+        on_position(n) is called whenever the job's 1-based queue position
+        changes while it waits. If should_abort() turns true while waiting,
+        the context yields None without taking a slot; otherwise it yields
+        the seconds spent waiting.
+        """
+        enqueued = time.monotonic()
+        with self._cond:
+            ticket = next(self._seq)
+            self._waiting[ticket] = (client, cost, enqueued)
+            last_position = None
+            try:
+                while True:
+                    if should_abort and should_abort():
+                        acquired = False
+                        break
+                    if self._running < self.slots and self._position(ticket) == 1:
+                        acquired = True
+                        break
+                    position = self._position(ticket)
+                    if on_position and position != last_position:
+                        on_position(position)
+                        last_position = position
+                    self._cond.wait(timeout=self.POLL_SECONDS)
+            finally:
+                del self._waiting[ticket]
+                # Our departure can change everyone else's position.
+                self._cond.notify_all()
+            if acquired:
+                self._running += 1
+                self._running_by_client[client] += 1
+                self._running_cost += cost
+
+        if not acquired:
+            yield None
+            return
+        try:
+            yield time.monotonic() - enqueued
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._running_by_client[client] -= 1
+                self._running_cost -= cost
+                if not self._running_by_client[client]:
+                    del self._running_by_client[client]
+                self._cond.notify_all()
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import stat
+import time
+
+import pytest
+
+from compressor import AsyncVideoCompressor, VideoCompressor
+
+# Stands in for ffmpeg: records its pid, then runs until it's terminated.
+FAKE_FFMPEG = """#!/bin/sh
+echo $$ > "$FAKE_FFMPEG_PID"
+exec sleep 60
+"""
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # Reaped by the event loop's child watcher, or a zombie awaiting it.
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().split(") ")[1][0] != "Z"
+
+
+@pytest.fixture
+def compressor(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for tool in ("ffmpeg", "ffprobe"):
+        path = bin_dir / tool
+        path.write_text(FAKE_FFMPEG)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_FFMPEG_PID", str(tmp_path / "ffmpeg.pid"))
+    compressor = VideoCompressor(output_dir=str(tmp_path / "out"))
+    # A plan that stream-copies: compress() runs one ffmpeg for it.
+    plan = {
+        "remux_cmd": ["ffmpeg", "-i", "in.mp4", "-c", "copy", "out.mp4"],
+        "remux_duration": 10.0,
+        "output_path": str(tmp_path / "out.mp4"),
+        "target_bytes": 1,
+    }
+    monkeypatch.setattr(compressor, "_prepare", lambda *args, **kwargs: plan)
+    return compressor
+
+
+def test_cancelling_the_task_terminates_ffmpeg(compressor, tmp_path):
+    pid_file = tmp_path / "ffmpeg.pid"
+
+    async def main():
+        job = asyncio.create_task(AsyncVideoCompressor(compressor).compress(
+            "job", "in.mp4", 10, False, None, None, "Prioritize Speed", "Auto", "Auto",
+        ))
+        deadline = time.monotonic() + 5
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            assert time.monotonic() < deadline, "ffmpeg never started"
+            await asyncio.sleep(0.01)
+        pid = int(pid_file.read_text())
+        assert pid_alive(pid)
+        job.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await job
+        return pid
+
+    pid = asyncio.run(main())
+    assert not pid_alive(pid)
+    assert compressor.metrics.snapshot()["jobs_total"] == {"cancelled": 1}
+    assert not compressor.janitor._pins
@@ -0,0 +1,52 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import batch
+
+
+def fake_run_job(job, defaults, output_dir):
+    if job["input"] == "crash.mp4":
+        os._exit(1)  # as if the OOM killer took the worker
+    return {"id": batch.job_id_for(job), "input": job["input"], "status": "ok", "elapsed_s": 0.0}
+
+
+def write_manifest(path, jobs):
+    path.write_text("".join(json.dumps(job) + "\n" for job in jobs))
+
+
+@pytest.mark.parametrize("job_id", ["../x", "a/b", "..", "_cache", ".hidden", "a b"])
+def test_unsafe_ids_are_rejected(tmp_path, job_id):
+    manifest = tmp_path / "jobs.jsonl"
+    write_manifest(manifest, [{"id": job_id, "input": "a.mp4"}])
+    with pytest.raises(SystemExit, match="jobs.jsonl:1"):
+        batch.read_manifest(manifest)
+
+
+def test_safe_ids_are_accepted(tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    write_manifest(manifest, [{"id": "clip-1.v2_final", "input": "a.mp4"}, {"input": "b.mp4"}])
+    assert [batch.job_id_for(job) for job in batch.read_manifest(manifest)][0] == "clip-1.v2_final"
+
+
+def test_dead_worker_is_an_error_and_the_batch_carries_on(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "run_job", fake_run_job)
+    monkeypatch.setattr(batch, "_init_worker", lambda cpus: None)
+    manifest = tmp_path / "jobs.jsonl"
+    write_manifest(manifest, [
+        {"id": "before", "input": "a.mp4"},
+        {"id": "crash", "input": "crash.mp4"},
+        {"id": "after", "input": "b.mp4"},
+    ])
+    args = SimpleNamespace(manifest=manifest, results=tmp_path / "results.jsonl",
+                           output_dir=tmp_path, workers=1)
+    batch.run_manifest(args, {})
+
+    rows = {row["id"]: row for row in map(json.loads, args.results.read_text().splitlines())}
+    assert rows["before"]["status"] == "ok"
+    assert rows["crash"]["status"] == "error"
+    assert rows["after"]["status"] == "ok"
+    # The crashed job isn't "done", so a re-run retries it.
+    assert batch.load_done(args.results) == {"before", "after"}
@@ -0,0 +1,59 @@
+import pytest
+
+from compressor import SIZE_TOLERANCE, _corrected_bitrate, _plan_stream_copy, _segments_to_correct
+
+
+@pytest.mark.parametrize("video, audio, budget, keep_audio, codec, planned_audio, expected", [
+    # Everything fits and the audio is MP4-friendly: copy both.
+    (800, 100, 1000, True, "aac", 50, "copy_all"),
+    (800, 100, 1000, True, "mp3", 50, "copy_all"),
+    # The audio can't go in MP4 as-is, or is too big: re-encode just it.
+    (800, 100, 1000, True, "opus", 50, "copy_video_encode_audio"),
+    (800, 300, 1000, True, "aac", 150, "copy_video_encode_audio"),
+    # Even re-encoded audio doesn't fit beside the video.
+    (800, 300, 1000, True, "aac", 250, None),
+    # Audio removed: only the video has to fit.
+    (1000, 500, 1000, False, "aac", 0, "copy_video"),
+    (1001, 0, 1000, False, None, 0, None),
+])
+def test_plan_stream_copy(video, audio, budget, keep_audio, codec, planned_audio, expected):
+    stream_bytes = {"video": video, "audio": audio}
+    assert _plan_stream_copy(stream_bytes, budget, keep_audio, codec, planned_audio) == expected
+
+
+@pytest.mark.parametrize("video_bitrate, target, actual, audio, expected", [
+    # Aim for SIZE_TOLERANCE / 2 under target, scaling the video bitrate.
+    (1_000_000, 1000, 1200, 0, 1_000_000 * 1000 * (1 - SIZE_TOLERANCE / 2) / 1200),
+    # Audio bytes are fixed, so only the video share is rescaled.
+    (1_000_000, 1000, 1200, 200, 1_000_000 * (1000 * (1 - SIZE_TOLERANCE / 2) - 200) / 1000),
+    # Never below 10 kbps.
+    (50_000, 1000, 10**9, 0, 10000),
+])
+def test_corrected_bitrate(video_bitrate, target, actual, audio, expected):
+    assert _corrected_bitrate(video_bitrate, target, actual, audio) == pytest.approx(expected)
+
+
+# 80 kbps over 8 s chunks: a budget of 80000 bytes each.
+BUDGET = 80000
+
+
+def corrected(size):
+    return 80000 * BUDGET * (1 - SIZE_TOLERANCE / 2) / size
+
+
+@pytest.mark.parametrize("sizes, expected", [
+    ([BUDGET] * 3, []),
+    # Within SIZE_TOLERANCE of the combined budget: nothing reruns.
+    ([82000, 82000, 82000], []),
+    # One chunk over its share is fine when the others came in under.
+    ([120000, 60000, 60000], []),
+    # Over: the worst offender alone covers the excess.
+    ([96000, 80000, 80000], [(0, corrected(96000))]),
+    # Worst first, and only as many as the excess needs.
+    ([96000, 104000, 80000], [(1, corrected(104000)), (0, corrected(96000))]),
+    ([96000, 104000, 81000], [(1, corrected(104000)), (0, corrected(96000))]),
+])
+def test_segments_to_correct(sizes, expected):
+    result = _segments_to_correct(80000, [8, 8, 8], sizes)
+    assert [index for index, _ in result] == [index for index, _ in expected]
+    assert [rate for _, rate in result] == pytest.approx([rate for _, rate in expected])
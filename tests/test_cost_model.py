@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import cost_model
+from cost_model import MIN_SAMPLES, EncodeCostModel, _seed
+
+
+@pytest.mark.parametrize("samples, expected", [
+    # Too few samples: the seed stands.
+    ([(10, 5)] * (MIN_SAMPLES - 1), None),
+    # Least squares through the origin, weighted by size: total CPU / total mpx.
+    ([(10, 5), (10, 5), (10, 5)], 0.5),
+    ([(1, 10), (99, 10), (100, 1)], 21 / 200),
+    # Non-positive samples are dropped.
+    ([(10, 5), (10, 5), (10, 5), (0, 9), (10, -1)], 0.5),
+])
+def test_coefficient_fit(samples, expected):
+    model = EncodeCostModel()
+    for mpx_frames, cpu_seconds in samples:
+        model.record("medium", 2, mpx_frames, cpu_seconds)
+    if expected is None:
+        expected = _seed("medium", 2)
+    assert model.coefficient("medium", 2) == pytest.approx(expected)
+
+
+def test_prediction_sums_passes():
+    model = EncodeCostModel()
+    for _ in range(MIN_SAMPLES):
+        model.record("fast", 1, 10, 1)
+        model.record("fast", 2, 10, 3)
+    assert model.predict("fast", 100) == pytest.approx(100 * (0.1 + 0.3))
+    assert model.predict("fast", 100, passes=(2,)) == pytest.approx(30)
+
+
+def test_other_encoders_are_seeded_as_a_multiple_of_x264():
+    assert _seed("libx265:slow", 1) == pytest.approx(3.0 * _seed("slow", 1))
+    assert _seed("libsvtav1:8", 0) == pytest.approx(2.0 * _seed("medium", 0))
+
+
+def test_history_reloads_and_is_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(cost_model, "MAX_SAMPLES", 5)
+    path = tmp_path / "history.jsonl"
+    model = EncodeCostModel(str(path))
+    for i in range(100):
+        model.record("medium", 2, 10, 1 + i)
+    # Never more than COMPACT_FACTOR x the kept samples on disk.
+    assert len(path.read_text().splitlines()) <= cost_model.COMPACT_FACTOR * 5
+
+    with path.open("a") as f:
+        f.write("not json\n")
+        for i in range(20):
+            f.write(json.dumps({"preset": "medium", "pass": 2, "mpx_frames": 10, "cpu_s": 200 + i}) + "\n")
+    reloaded = EncodeCostModel(str(path))
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    # Rewritten at load with the newest samples, which are also what's fitted.
+    assert [row["cpu_s"] for row in rows] == [215, 216, 217, 218, 219]
+    assert reloaded.coefficient("medium", 2) == pytest.approx(217 / 10)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import cpu_budget
+
+
+@pytest.fixture
+def cgroup(tmp_path, monkeypatch):
+    """Fake cgroup tree: cgroup(files, self_cgroup) writes {relative path: content}
+    under a temporary CGROUP_ROOT and sets what /proc/self/cgroup says."""
+    root = tmp_path / "cgroup"
+    root.mkdir()
+    monkeypatch.setattr(cpu_budget, "CGROUP_ROOT", str(root))
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    real_read = cpu_budget._read
+
+    def setup(files, self_cgroup="0::/"):
+        for relative, content in files.items():
+            path = root / relative
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+        monkeypatch.setattr(
+            cpu_budget, "_read", lambda path: self_cgroup if path == "/proc/self/cgroup" else real_read(path),
+        )
+
+    return setup
+
+
+@pytest.mark.parametrize("files, self_cgroup, expected", [
+    ({}, "0::/", None),
+    ({"cpu.max": "max 100000"}, "0::/", None),
+    ({"cpu.max": "200000 100000"}, "0::/", 2.0),
+    # Our own group's quota, found via /proc/self/cgroup.
+    ({"app/cpu.max": "150000 100000"}, "0::/app", 1.5),
+    # The tightest quota on the way up to the root wins.
+    ({"a/cpu.max": "100000 100000", "a/b/cpu.max": "300000 100000"}, "0::/a/b", 1.0),
+    ({"cpu.max": "50000 100000", "a/b/cpu.max": "max 100000"}, "0::/a/b", 0.5),
+    # Malformed files are ignored.
+    ({"cpu.max": "lots 100000"}, "0::/", None),
+    ({"cpu.max": "100000 0"}, "0::/", None),
+    # v1 lines in /proc/self/cgroup don't count as the v2 path.
+    ({"cpu.max": "400000 100000"}, "12:cpu,cpuacct:/docker/abc\n0::/", 4.0),
+])
+def test_cgroup_v2_quota(cgroup, files, self_cgroup, expected):
+    cgroup(files, self_cgroup)
+    assert cpu_budget._cgroup_v2_quota() == expected
+
+
+@pytest.mark.parametrize("files, expected", [
+    ({}, None),
+    ({"cpu,cpuacct/cpu.cfs_quota_us": "-1", "cpu,cpuacct/cpu.cfs_period_us": "100000"}, None),
+    ({"cpu,cpuacct/cpu.cfs_quota_us": "150000", "cpu,cpuacct/cpu.cfs_period_us": "100000"}, 1.5),
+    ({"cpu/cpu.cfs_quota_us": "300000", "cpu/cpu.cfs_period_us": "100000"}, 3.0),
+    ({"cpu/cpu.cfs_quota_us": "300000", "cpu/cpu.cfs_period_us": "0"}, None),
+])
+def test_cgroup_v1_quota(cgroup, files, expected):
+    cgroup(files)
+    assert cpu_budget._cgroup_v1_quota() == expected
+
+
+@pytest.mark.parametrize("files, expected", [
+    # Affinity (8 CPUs) alone.
+    ({}, 8),
+    # Capped by the quota, rounding down, never below one.
+    ({"cpu.max": "250000 100000"}, 2),
+    ({"cpu.max": "50000 100000"}, 1),
+    ({"cpu.max": "1600000 100000"}, 8),
+    # v1 only when v2 has no quota.
+    ({"cpu/cpu.cfs_quota_us": "300000", "cpu/cpu.cfs_period_us": "100000"}, 3),
+    ({"cpu.max": "200000 100000", "cpu/cpu.cfs_quota_us": "300000", "cpu/cpu.cfs_period_us": "100000"}, 2),
+])
+def test_detect_cpus(cgroup, files, expected):
+    cgroup(files)
+    assert cpu_budget.detect_cpus() == expected
+
+
+@pytest.mark.parametrize("threads, expected", [
+    (1, {"threads": 1, "decode_threads": 2, "lookahead_threads": 1}),
+    (2, {"threads": 2, "decode_threads": 2, "lookahead_threads": 1}),
+    (16, {"threads": 16, "decode_threads": 4, "lookahead_threads": 2}),
+])
+def test_split_threads(threads, expected):
+    assert cpu_budget.split_threads(threads) == expected
@@ -0,0 +1,34 @@
+import pytest
+
+from filter_plan import plan_filters
+
+
+@pytest.mark.parametrize("width, height, fps, target_height, target_fps, filters", [
+    # Nothing to do.
+    (1920, 1080, 30, 0, 0, []),
+    (1920, 1080, 30, 1080, 30, []),
+    # Never upscale, never raise the frame rate.
+    (1280, 720, 30, 1080, 60, []),
+    # Mild downscale keeps bicubic; half or less uses area.
+    (1920, 1080, 30, 720, 0, ["scale=-2:720:flags=bicubic"]),
+    (3840, 2160, 30, 480, 0, ["scale=-2:480:flags=area"]),
+    (1920, 1080, 30, 540, 0, ["scale=-2:540:flags=area"]),
+    # fps goes first, so the scaler only sees the frames that are kept.
+    (1920, 1080, 60, 720, 30, ["fps=30", "scale=-2:720:flags=bicubic"]),
+    (1920, 1080, 60, 0, 30, ["fps=30"]),
+    # Unknown source dimensions or rate: that stage is skipped.
+    (0, 0, 60, 720, 30, ["fps=30"]),
+    (1920, 1080, 0, 720, 30, ["scale=-2:720:flags=bicubic"]),
+])
+def test_plan_filters(width, height, fps, target_height, target_fps, filters):
+    plan = plan_filters(width, height, fps, target_height, target_fps)
+    assert [stage["filter"] for stage in plan["stages"]] == filters
+    assert plan["args"] == (["-vf", ",".join(filters)] if filters else [])
+
+
+def test_stage_work_reflects_the_stages_before_it():
+    stages = plan_filters(1920, 1080, 60, 720, 30)["stages"]
+    # The scaler sees half the frames the fps stage does.
+    assert [stage["mpx_per_second"] for stage in stages] == [
+        round(60 * 1920 * 1080 / 1e6, 3), round(30 * 1920 * 1080 / 1e6, 3),
+    ]
@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("fastapi")
+
+from job_api import _parse_range  # noqa: E402
+
+
+@pytest.mark.parametrize("header, length, expected", [
+    # No header, or a form we don't serve: the whole file.
+    (None, 1000, None),
+    ("", 1000, None),
+    ("items=0-10", 1000, None),
+    ("bytes=0-10,20-30", 1000, None),
+    ("bytes=abc-", 1000, None),
+    # Explicit, open-ended and clamped ranges (inclusive ends).
+    ("bytes=0-499", 1000, (0, 499)),
+    ("bytes=500-", 1000, (500, 999)),
+    ("bytes=900-5000", 1000, (900, 999)),
+    # Suffix ranges: the last N bytes, at most the whole file.
+    ("bytes=-100", 1000, (900, 999)),
+    ("bytes=-5000", 1000, (0, 999)),
+    # Unsatisfiable.
+    ("bytes=1000-", 1000, False),
+    ("bytes=500-100", 1000, False),
+    ("bytes=-0", 1000, False),
+])
+def test_parse_range(header, length, expected):
+    assert _parse_range(header, length) == expected
@@ -0,0 +1,105 @@
+import io
+import subprocess
+
+import pytest
+
+import utils
+from packet_index import PacketIndex
+
+# Two seconds of a stream whose container starts at 1.4s (as MPEG-TS and
+# many camera/OBS recordings do): keyframes at absolute 1.4 and 2.4.
+PROBE_OUTPUT = """codec_type=video|pts_time=1.400000|dts_time=1.400000|size=5000|flags=K__
+codec_type=audio|pts_time=1.400000|dts_time=1.400000|size=300|flags=K__
+codec_type=video|pts_time=1.900000|dts_time=1.900000|size=1000|flags=___
+codec_type=video|pts_time=2.400000|dts_time=2.400000|size=4000|flags=K__
+codec_type=audio|pts_time=2.400000|dts_time=2.400000|size=300|flags=K__
+codec_type=video|pts_time=2.900000|dts_time=2.900000|size=1000|flags=___
+"""
+
+
+class FakeProbe:
+    def __init__(self, cmd, **kwargs):
+        FakeProbe.cmd = cmd
+        lines = PROBE_OUTPUT.splitlines(keepends=True)
+        if "-select_streams" in cmd:
+            lines = [line for line in lines if line.startswith("codec_type=video")]
+        self.stdout = io.StringIO("".join(lines))
+
+    def poll(self):
+        return 0
+
+    def wait(self):
+        return 0
+
+
+def fake_probe(monkeypatch, start_time):
+    monkeypatch.setattr(subprocess, "Popen", FakeProbe)
+    monkeypatch.setattr(utils, "get_video_metadata", lambda path: {"start_time": start_time})
+
+
+def test_packet_times_are_relative_to_container_start(monkeypatch):
+    fake_probe(monkeypatch, 1.4)
+    assert [round(k, 6) for k in utils.get_keyframe_times("clip.ts")] == [0.0, 1.0]
+
+
+def test_trim_bytes_use_the_relative_timeline(monkeypatch):
+    fake_probe(monkeypatch, 1.4)
+    assert utils.get_trim_stream_bytes("clip.ts", 1.0, 2.0) == {"video": 5000, "audio": 300}
+    interval = FakeProbe.cmd[FakeProbe.cmd.index("-read_intervals") + 1]
+    start, end = (float(t) for t in interval.split("%"))
+    assert (round(start, 6), round(end, 6)) == (2.4, 3.4)
+
+
+def test_packet_index_matches_trim_bytes(monkeypatch):
+    fake_probe(monkeypatch, 1.4)
+    index = PacketIndex.build("clip.ts")
+    assert index.range_bytes(1.0, 2.0) == {"video": 5000, "audio": 300}
+    assert index.keyframe_at_or_before(0.7) == 0.0
+    assert index.keyframe_at_or_before(-0.1) is None
+
+
+# (codec_type, pts, size, is_key), deliberately out of pts order.
+PACKETS = [
+    ("video", 1.0, 100, False),
+    ("video", 0.0, 1000, True),
+    ("audio", 0.0, 10, True),
+    ("video", 2.0, 800, True),
+    ("audio", 1.0, 10, True),
+    ("subtitle", 1.5, 7, True),
+    ("video", 3.0, 50, False),
+]
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    (0.0, 4.0, {"video": 1950, "audio": 20}),
+    # Half-open: a packet at end is excluded, one at start included.
+    (1.0, 2.0, {"video": 100, "audio": 10}),
+    (2.0, 2.0, {"video": 0, "audio": 0}),
+    (0.5, 0.9, {"video": 0, "audio": 0}),
+    (-5.0, 0.5, {"video": 1000, "audio": 10}),
+    (2.5, 99.0, {"video": 50, "audio": 0}),
+])
+def test_range_bytes(start, end, expected):
+    assert PacketIndex.from_packets(PACKETS).range_bytes(start, end) == expected
+
+
+@pytest.mark.parametrize("t, expected", [
+    (-0.5, None), (0.0, 0.0), (1.99, 0.0), (2.0, 2.0), (10.0, 2.0),
+])
+def test_keyframe_at_or_before(t, expected):
+    assert PacketIndex.from_packets(PACKETS).keyframe_at_or_before(t) == expected
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    (0.0, 2.0, (1000 + 100 + 20) * 8 / 2.0),
+    (0.5, 0.9, None),
+    (2.0, 1.0, None),
+])
+def test_trim_bitrate(start, end, expected):
+    assert PacketIndex.from_packets(PACKETS).trim_bitrate(start, end) == expected
+
+
+def test_index_round_trips_through_disk(tmp_path):
+    path = tmp_path / "clip.npz"
+    PacketIndex.from_packets(PACKETS).save(str(path))
+    assert PacketIndex.load(str(path)).range_bytes(0.0, 4.0) == {"video": 1950, "audio": 20}
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from scheduler import JobScheduler
+
+
+def test_cheaper_job_goes_first():
+    scheduler = JobScheduler(1, aging_rate=0)
+    order = []
+    release = threading.Event()
+
+    def hold():
+        with scheduler.slot("holder", 1):
+            release.wait()
+
+    def run(name, cost):
+        with scheduler.slot(name, cost):
+            order.append(name)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    while scheduler.stats()[0] == 0:
+        time.sleep(0.01)
+    expensive = threading.Thread(target=run, args=("expensive", 100))
+    expensive.start()
+    while scheduler.stats()[1] < 1:
+        time.sleep(0.01)
+    cheap = threading.Thread(target=run, args=("cheap", 1))
+    cheap.start()
+    while scheduler.stats()[1] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in (holder, expensive, cheap):
+        thread.join(timeout=5)
+    assert order == ["cheap", "expensive"]
+
+
+def test_long_job_is_not_starved_by_cheaper_arrivals():
+    # A steady stream of cheap jobs keeps the queue non-empty; without aging
+    # the long job would be passed every time the slot frees up.
+    scheduler = JobScheduler(1, aging_rate=200)
+    long_done = threading.Event()
+    stop = threading.Event()
+
+    def cheap_job(index):
+        with scheduler.slot(f"cheap-{index}", 1):
+            time.sleep(0.02)
+
+    def feeder():
+        index = 0
+        while not stop.is_set():
+            if scheduler.stats()[1] < 3:
+                threading.Thread(target=cheap_job, args=(index,), daemon=True).start()
+                index += 1
+            time.sleep(0.005)
+
+    def long_job():
+        with scheduler.slot("long", 100):
+            long_done.set()
+
+    feeding = threading.Thread(target=feeder, daemon=True)
+    feeding.start()
+    while scheduler.stats()[0] == 0:
+        time.sleep(0.01)
+    waiter = threading.Thread(target=long_job, daemon=True)
+    waiter.start()
+    try:
+        # Aged past every cheap job after 100 / 200 = 0.5s of waiting.
+        assert long_done.wait(timeout=5)
+    finally:
+        stop.set()
@@ -0,0 +1,109 @@
+import math
+
+import pytest
+
+from utils import fit_crf_for_bitrate, fragmented_mp4_ready_bytes, pick_preview_windows, plan_segments
+
+
+@pytest.mark.parametrize("keyframes, start, end, count, min_seconds, expected", [
+    # One chunk requested, or an empty range: the range as-is.
+    ([10, 20], 0, 30, 1, 2, [(0, 30)]),
+    ([10, 20], 5, 5, 4, 2, [(5, 5)]),
+    # Cuts snap to the keyframe nearest each evenly spaced ideal cut.
+    ([8, 11, 19, 22], 0, 30, 3, 2, [(0, 11), (11, 19), (19, 30)]),
+    # No keyframes far enough inside the range: one chunk.
+    ([], 0, 30, 3, 2, [(0, 30)]),
+    ([1, 29], 0, 30, 3, 2, [(0, 30)]),
+    # Keyframes too close together are merged into one cut.
+    ([14, 15], 0, 30, 3, 5, [(0, 14), (14, 30)]),
+    # Trimmed ranges stay within [start, end] and cover it exactly.
+    ([0, 12, 24, 36, 48], 10, 40, 2, 2, [(10, 24), (24, 40)]),
+])
+def test_plan_segments(keyframes, start, end, count, min_seconds, expected):
+    assert plan_segments(keyframes, start, end, count, min_seconds) == expected
+
+
+def box(box_type, payload_size, large=False):
+    if large:
+        return (1).to_bytes(4, "big") + box_type + (16 + payload_size).to_bytes(8, "big") + bytes(payload_size)
+    return (8 + payload_size).to_bytes(4, "big") + box_type + bytes(payload_size)
+
+
+FTYP, MOOV = box(b"ftyp", 16), box(b"moov", 100)
+MOOF, MDAT = box(b"moof", 40), box(b"mdat", 500)
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b"", 0),
+    # No init segment yet, or only part of it.
+    (FTYP, 0),
+    (FTYP + MOOV[:50], 0),
+    # Init segment, then each complete fragment.
+    (FTYP + MOOV, len(FTYP + MOOV)),
+    (FTYP + MOOV + MOOF, len(FTYP + MOOV)),
+    (FTYP + MOOV + MOOF + MDAT, len(FTYP + MOOV + MOOF + MDAT)),
+    # A half-written mdat (or a header cut short) doesn't count.
+    (FTYP + MOOV + MOOF + MDAT + MOOF + MDAT[:100], len(FTYP + MOOV + MOOF + MDAT)),
+    (FTYP + MOOV + MOOF + MDAT + MOOF[:5], len(FTYP + MOOV + MOOF + MDAT)),
+    # 64-bit box sizes.
+    (FTYP + MOOV + MOOF + box(b"mdat", 500, large=True), len(FTYP + MOOV + MOOF) + 516),
+])
+def test_fragmented_mp4_ready_bytes(tmp_path, data, expected):
+    path = tmp_path / "live.mp4"
+    path.write_bytes(data)
+    assert fragmented_mp4_ready_bytes(str(path)) == expected
+
+
+def test_fragmented_mp4_ready_bytes_missing_file(tmp_path):
+    assert fragmented_mp4_ready_bytes(str(tmp_path / "missing.mp4")) == 0
+
+
+@pytest.mark.parametrize("keyframes, start, end, count, seconds, expected", [
+    # Range no longer than one window: the whole range.
+    ([0], 0, 4, 3, 5, [(0, 4)]),
+    # Early/middle/late, each on the keyframe nearest its ideal start.
+    (list(range(0, 60, 10)), 0, 60, 3, 5, [(10, 15), (30, 35), (50, 55)]),
+    # No keyframes in range: the ideal starts themselves.
+    ([], 0, 60, 3, 5, [(7.5, 12.5), (27.5, 32.5), (47.5, 52.5)]),
+    ([100], 0, 60, 3, 5, [(7.5, 12.5), (27.5, 32.5), (47.5, 52.5)]),
+    # Short ranges get fewer windows.
+    ([], 0, 12, 3, 5, [(0.5, 5.5), (6.5, 11.5)]),
+    # Windows that would overlap an earlier one are dropped.
+    ([0], 0, 60, 3, 5, [(0, 5)]),
+    # Trimmed range: windows stay inside it.
+    (list(range(0, 200, 10)), 100, 160, 3, 5, [(110, 115), (130, 135), (150, 155)]),
+])
+def test_pick_preview_windows(keyframes, start, end, count, seconds, expected):
+    assert pick_preview_windows(keyframes, start, end, count, seconds) == expected
+
+
+def halving_every_6(crf):
+    """Bitrate that halves every 6 CRF steps, 1 Mbps at CRF 22."""
+    return 1_000_000 * 2 ** ((22 - crf) / 6)
+
+
+SLOPE = -math.log(2) / 6
+
+
+@pytest.mark.parametrize("samples, target, crf_range, expected", [
+    # Exact on the curve, whether interpolating or extrapolating.
+    ([(22, halving_every_6(22)), (28, halving_every_6(28)), (34, halving_every_6(34))], 500_000, (10, 51), (28.0, SLOPE)),
+    ([(22, halving_every_6(22)), (34, halving_every_6(34))], 2_000_000, (10, 51), (16.0, SLOPE)),
+    # Clamped to the encoder's range.
+    ([(22, halving_every_6(22)), (34, halving_every_6(34))], 1_000, (10, 51), (51, SLOPE)),
+    ([(22, halving_every_6(22)), (34, halving_every_6(34))], 10**12, (10, 51), (10, SLOPE)),
+    # Fewer than two distinct CRFs, unusable samples, or no target.
+    ([(22, 1_000_000)], 500_000, (10, 51), None),
+    ([(22, 1_000_000), (22, 900_000)], 500_000, (10, 51), None),
+    ([(22, 1_000_000), (28, 0)], 500_000, (10, 51), None),
+    ([(22, 1_000_000), (28, 500_000)], 0, (10, 51), None),
+    # Bitrate rising with CRF isn't a usable fit.
+    ([(22, 500_000), (28, 1_000_000)], 700_000, (10, 51), None),
+])
+def test_fit_crf_for_bitrate(samples, target, crf_range, expected):
+    result = fit_crf_for_bitrate(samples, target, crf_range)
+    if expected is None:
+        assert result is None
+    else:
+        assert result[0] == expected[0]
+        assert result[1] == pytest.approx(expected[1])
@@ -1,6 +1,9 @@
 import subprocess
 import json
+import math
 import os
+import threading
+from collections import OrderedDict
 
 def _parse_fps(value):
     """Parse ffprobe's avg_frame_rate ('30000/1001', '30/1', '24') into float."""
@@ -18,16 +21,68 @@ def _parse_fps(value):
         return None
 
 
+def file_signature(path):
+    """(absolute path, size, mtime_ns) identifying this version of a file, or None.
+
+    Cheap stand-in for a content hash when keying per-file caches: an upload
+    that's rewritten in place changes size or mtime and misses the cache.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+# get_video_metadata memo. The app probes on upload, the compressor probes the
+# same file moments later, and bench.py probes every source per config — all
+# the same answer. Keyed by file_signature so an edited file is re-probed.
+METADATA_CACHE_SIZE = 64
+_metadata_cache = OrderedDict()
+_metadata_cache_lock = threading.Lock()
+
+
 def get_video_metadata(input_path):
+    """
+    Memoized front for _probe_video_metadata; see there for the fields.
+
+    Returns a fresh dict per call so callers can annotate their copy (the
+    app adds "path") without leaking into other callers. Failed probes are
+    not cached.
+    """
+    signature = file_signature(input_path)
+    if signature is not None:
+        with _metadata_cache_lock:
+            cached = _metadata_cache.get(signature)
+            if cached is not None:
+                _metadata_cache.move_to_end(signature)
+                return dict(cached)
+
+    meta = _probe_video_metadata(input_path)
+    if meta is None or signature is None:
+        return meta
+    with _metadata_cache_lock:
+        _metadata_cache[signature] = meta
+        _metadata_cache.move_to_end(signature)
+        while len(_metadata_cache) > METADATA_CACHE_SIZE:
+            _metadata_cache.popitem(last=False)
+    return dict(meta)
+
+
+def _probe_video_metadata(input_path):
     """
     Returns a dictionary containing duration, audio presence,
-    original bitrate, file size, the video stream's width/height, and fps.
+    original bitrate, file size, the container's start_time (the first
+    timestamp, often nonzero in MPEG-TS and camera/OBS recordings), the
+    video stream's width/height, and fps,
+    plus the video/audio codec names and the audio stream's bitrate (None
+    when the container doesn't report one) for the stream-copy planner.
     """
     try:
         cmd = [
             "ffprobe",
             "-v", "error",
-            "-show_entries", "format=duration,size,bit_rate:stream=codec_type,width,height,avg_frame_rate",
+            "-show_entries", "format=duration,size,bit_rate,start_time:stream=codec_type,codec_name,bit_rate,width,height,avg_frame_rate",
             "-of", "json",
             input_path
         ]
@@ -37,10 +92,19 @@ def get_video_metadata(input_path):
         fmt = data["format"]
         duration = float(fmt.get("duration", 0))
         size_bytes = float(fmt.get("size", 0))
+        try:
+            start_time = float(fmt.get("start_time", 0))
+        except (TypeError, ValueError):
+            start_time = 0.0
 
         streams = data.get("streams", [])
         has_audio = any(s.get("codec_type") == "audio" for s in streams)
         video_stream = next((s for s in streams if s.get("codec_type") == "video"), None)
+        audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+        try:
+            audio_bitrate = float(audio_stream["bit_rate"]) if audio_stream else None
+        except (KeyError, TypeError, ValueError):
+            audio_bitrate = None
         width = video_stream.get("width") if video_stream else None
         height = video_stream.get("height") if video_stream else None
         fps = _parse_fps(video_stream.get("avg_frame_rate")) if video_stream else None
@@ -53,11 +117,15 @@ def get_video_metadata(input_path):
         return {
             "duration": duration,
             "size_bytes": size_bytes,
+            "start_time": start_time,
             "bitrate": bitrate,
             "has_audio": has_audio,
             "width": width,
             "height": height,
             "fps": fps,
+            "video_codec": video_stream.get("codec_name") if video_stream else None,
+            "audio_codec": audio_stream.get("codec_name") if audio_stream else None,
+            "audio_bitrate": audio_bitrate,
         }
     except Exception as e:
         print(f"Error probing video: {e}")
@@ -149,50 +217,169 @@ def pick_auto_fps_cap(source_fps, source_width, source_height, video_bitrate_bps
     return cap if bpp < QUALITY_BPP_TARGET / 2 else 0
 
 
-def get_trim_bitrate(input_path, start, end, work_dir):
+def iter_packets(input_path, read_interval=None, select_streams=None):
     """
-    Performs a temporary Stream Copy trim to measure the EXACT bitrate
-    of the specific section the user selected.
-    This prevents inflating a simple scene (like a black screen) to a high bitrate.
+    Stream (codec_type, pts_seconds, size_bytes, is_keyframe) for every packet
+    in the file, straight from ffprobe's stdout.
+
+    Demux only — nothing is decoded and nothing is written to disk. Packets
+    without a usable timestamp (pts and dts both N/A) are skipped.
+
+    ffprobe reports absolute container timestamps; pts here are relative to
+    the container's start_time, the same timeline as ffmpeg's -ss/-to and
+    the UI's trim fields. read_interval=(start, end), in those relative
+    seconds, lets ffprobe seek near start instead of reading from the top
+    of the file; it may still return a few packets just outside the
+    interval, so callers filter.
+    """
+    meta = get_video_metadata(input_path)
+    offset = (meta or {}).get("start_time") or 0.0
+    cmd = ["ffprobe", "-v", "error"]
+    if select_streams:
+        cmd += ["-select_streams", select_streams]
+    if read_interval:
+        start, end = read_interval
+        cmd += ["-read_intervals", f"{start + offset}%{end + offset}"]
+    cmd += [
+        "-show_entries", "packet=codec_type,pts_time,dts_time,size,flags",
+        "-of", "compact=p=0",
+        input_path
+    ]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    assert process.stdout is not None
+    try:
+        for line in process.stdout:
+            fields = dict(part.split("=", 1) for part in line.strip().split("|") if "=" in part)
+            ts = fields.get("pts_time", "N/A")
+            if ts == "N/A":
+                ts = fields.get("dts_time", "N/A")
+            try:
+                pts = float(ts)
+                size = int(fields["size"])
+            except (KeyError, ValueError):
+                continue
+            yield fields.get("codec_type"), pts - offset, size, "K" in fields.get("flags", "")
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
 
-    work_dir must be a per-job directory so concurrent calls don't clobber each other.
 
-    Bitrate is computed from the trimmed file's size and the requested duration
-    (size * 8 / duration). This is an approximation — file size includes container
-    overhead — but well within the precision needed to drive the size cap, and
-    saves a redundant ffprobe call.
+def get_keyframe_times(input_path):
     """
-    temp_check_file = os.path.join(work_dir, "temp_bitrate_check.mp4")
-    duration = float(end) - float(start)
-    if duration <= 0:
-        return None
+    Returns the sorted pts (seconds) of every keyframe in the first video
+    stream, or [] if the probe fails.
 
+    Reads packet flags only — ffprobe demuxes but never decodes, so this is
+    cheap even on long 4K sources. Encoders already place keyframes on scene
+    cuts, so these double as the natural split points for segmented encodes.
+    """
     try:
-        cmd = [
-            "ffmpeg", "-y",
-            "-ss", str(start),
-            "-to", str(end),
-            "-i", input_path,
-            "-c", "copy",
-            "-map", "0",
-            "-avoid_negative_ts", "make_zero",
-            temp_check_file
-        ]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return sorted(pts for _, pts, _, key in iter_packets(input_path, select_streams="v:0") if key)
+    except OSError:
+        return []
+
+
+def plan_segments(keyframes, start, end, count, min_seconds):
+    """
+    Split [start, end] into at most `count` chunks whose inner boundaries sit
+    on keyframes. Returns a list of (chunk_start, chunk_end) tuples covering
+    the range exactly.
+
+    Boundaries are snapped to the keyframe nearest each evenly spaced ideal
+    cut, so chunks stay roughly equal in length (which keeps the worker pool
+    balanced). Chunks shorter than min_seconds are merged into their
+    neighbour — two-pass rate control needs some runway to converge.
+    """
+    duration = end - start
+    if count <= 1 or duration <= 0:
+        return [(start, end)]
+
+    inner = [k for k in keyframes if start + min_seconds <= k <= end - min_seconds]
+    cuts = []
+    if inner:
+        step = duration / count
+        for i in range(1, count):
+            ideal = start + i * step
+            nearest = min(inner, key=lambda k: abs(k - ideal))
+            if (not cuts or nearest - cuts[-1] >= min_seconds) and nearest not in cuts:
+                cuts.append(nearest)
+
+    bounds = [start, *cuts, end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def pick_preview_windows(keyframes, start, end, count, seconds):
+    """
+    Choose up to `count` windows of `seconds` each inside [start, end] for a
+    preview encode. Returns a list of (window_start, window_end) tuples.
+
+    Windows are spread evenly through the range (early, middle, late, ...)
+    so they sample different content, and each starts on the keyframe
+    nearest its ideal position so the encode can seek without decoding
+    ahead. With no keyframes in range (e.g. the probe failed) windows start
+    at their ideal positions, which costs some decoding but still samples
+    the whole range. Short ranges get fewer windows, down to one covering
+    everything.
+    """
+    duration = end - start
+    if duration <= seconds:
+        return [(start, end)]
+    count = max(1, min(count, int(duration // seconds)))
+    latest = end - seconds
+    candidates = [k for k in keyframes if start <= k <= latest]
+    windows = []
+    for i in range(count):
+        ideal = start + (i + 0.5) * duration / count - seconds / 2
+        if candidates:
+            nearest = min(candidates, key=lambda k: abs(k - ideal))
+        else:
+            nearest = min(max(ideal, start), latest)
+        if windows and nearest < windows[-1][1]:
+            continue
+        windows.append((nearest, nearest + seconds))
+    return windows
 
-        if not os.path.exists(temp_check_file):
-            return None
-        size_bytes = os.path.getsize(temp_check_file)
-        return (size_bytes * 8) / duration
 
-    except Exception:
+def get_trim_stream_bytes(input_path, start, end):
+    """
+    Sum packet payload bytes per stream type for packets whose timestamp
+    falls in [start, end). Returns {"video": bytes, "audio": bytes} (other
+    stream types are ignored), or None if ffprobe failed.
+    """
+    totals = {"video": 0, "audio": 0}
+    seen = False
+    try:
+        for codec_type, pts, size, _ in iter_packets(input_path, read_interval=(start, end)):
+            seen = True
+            if codec_type in totals and start <= pts < end:
+                totals[codec_type] += size
+    except OSError:
         return None
-    finally:
-        if os.path.exists(temp_check_file):
-            try:
-                os.remove(temp_check_file)
-            except OSError:
-                pass
+    return totals if seen else None
+
+
+def get_trim_bitrate(input_path, start, end):
+    """
+    Measures the EXACT bitrate of the specific section the user selected.
+    This prevents inflating a simple scene (like a black screen) to a high bitrate.
+
+    Streams packet sizes and timestamps from ffprobe and adds up the bytes
+    in [start, end) in memory — no stream-copy trim, nothing written to disk.
+    Returns the combined video+audio bitrate (bits/sec), the same figure the
+    old stream-copy probe reported minus its container overhead.
+    """
+    duration = float(end) - float(start)
+    if duration <= 0:
+        return None
+
+    totals = get_trim_stream_bytes(input_path, float(start), float(end))
+    if not totals:
+        return None
+    size_bytes = totals["video"] + totals["audio"]
+    if size_bytes <= 0:
+        return None
+    return (size_bytes * 8) / duration
 
 def compute_bitrate_plan(target_mb, duration, has_audio, remove_audio, source_bitrate_cap):
     """
@@ -205,7 +392,10 @@ def compute_bitrate_plan(target_mb, duration, has_audio, remove_audio, source_bi
     if duration is None or duration <= 0 or target_mb is None or target_mb <= 0:
         return None
 
-    safety_buffer = 0.90 if target_mb <= 20 else 0.95
+    # Headroom for container overhead and rate-control error. The
+    # compressor's closed-loop size correction catches overshoots, so this
+    # only needs to keep correction reruns rare.
+    safety_buffer = 0.95 if target_mb <= 20 else 0.97
     total_bits_allowed = target_mb * 1024 * 1024 * safety_buffer * 8
 
     if remove_audio or not has_audio:
@@ -226,13 +416,65 @@ def compute_bitrate_plan(target_mb, duration, has_audio, remove_audio, source_bi
     return video_bitrate, audio_bitrate
 
 
-def estimate_video_bitrate(meta, target_mb, remove_audio, duration):
-    """Thin wrapper for the UI summary; returns the video bitrate only."""
-    plan = compute_bitrate_plan(
-        target_mb=target_mb,
-        duration=duration,
-        has_audio=bool(meta and meta.get("has_audio")),
-        remove_audio=remove_audio,
-        source_bitrate_cap=meta.get("bitrate") if meta else None,
+def fit_crf_for_bitrate(samples, target_bitrate, crf_range):
+    """
+    Fit log(bitrate) = a + slope * crf to (crf, bitrate_bps) samples by least
+    squares and solve for the CRF that lands on target_bitrate.
+
+    Bitrate falls roughly exponentially with CRF (x264/x265 about halve it
+    every 6 steps), so the log-linear fit holds well across the probed span.
+    Returns (crf, slope) with crf clamped to crf_range and rounded to 0.1, or
+    None with fewer than two usable samples or a fit that isn't decreasing.
+    """
+    points = [(float(crf), math.log(bitrate)) for crf, bitrate in samples if bitrate and bitrate > 0]
+    if len({crf for crf, _ in points}) < 2 or not target_bitrate or target_bitrate <= 0:
+        return None
+    mean_crf = sum(crf for crf, _ in points) / len(points)
+    mean_log = sum(log for _, log in points) / len(points)
+    slope = (
+        sum((crf - mean_crf) * (log - mean_log) for crf, log in points)
+        / sum((crf - mean_crf) ** 2 for crf, _ in points)
     )
-    return plan[0] if plan else None
\ No newline at end of file
+    if slope >= 0:
+        return None
+    crf = mean_crf + (math.log(target_bitrate) - mean_log) / slope
+    low, high = crf_range
+    return round(min(max(crf, low), high), 1), slope
+
+
+def fragmented_mp4_ready_bytes(path):
+    """
+    Length of the playable prefix of a fragmented MP4 that is still being
+    written: the init segment (ftyp + moov) plus every complete moof + mdat
+    pair after it. Returns 0 until the init segment is on disk.
+
+    Walks top-level box headers only (8-16 bytes per box), so it's cheap to
+    call on every request while an encode is running. A box whose declared
+    size runs past the current end of file is still being written and ends
+    the walk.
+    """
+    try:
+        size = os.path.getsize(path)
+        f = open(path, "rb")
+    except OSError:
+        return 0
+    ready = 0
+    offset = 0
+    seen_moov = False
+    with f:
+        while offset + 8 <= size:
+            f.seek(offset)
+            header = f.read(16)
+            box_size = int.from_bytes(header[:4], "big")
+            box_type = header[4:8]
+            if box_size == 1 and len(header) == 16:
+                box_size = int.from_bytes(header[8:16], "big")
+            if box_size < 8 or offset + box_size > size:
+                break
+            offset += box_size
+            if box_type == b"moov":
+                seen_moov = True
+                ready = offset
+            elif box_type == b"mdat" and seen_moov:
+                ready = offset
+    return ready